@@ -1,15 +1,73 @@
 #!/usr/bin/env python
+"""
+Run the problem detector on all screenshots in the testsuite folder.
+Each filename must start with the expected error code, e.g.
+602_Problembericht_senden.png. Prints mismatches and throughput.
+"""
+
 import os
-import commands
-
-for png in os.listdir('testsuite'):
-    pipe = [
-        'pngtopnm testsuite/%s' % png,
-        './ppmfg',
-        './pbmgrep 6??_*.pbm',
-        ]
-    status, output = commands.getstatusoutput(' | '.join(pipe))
-    if png.split('.')[0] not in output:
-        print png
-        print 'status', status
-        print output
+import sys
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'pypng', 'lib'))
+sys.path.insert(0, os.path.join(here, '..', 'shotserver',
+                                'shotserver04', 'screenshots'))
+import png
+import detector
+
+
+def rgb_rows(rows, planes):
+    """Drop alpha channel or expand greyscale, like storage.py."""
+    for row in rows:
+        if planes == 3:
+            yield row
+        elif planes == 4:
+            del row[3::4]
+            yield row
+        else:
+            grey = row[::planes]
+            rgb = grey * 3
+            for plane in range(3):
+                rgb[plane::3] = grey
+            yield rgb
+
+
+def main():
+    started = time.time()
+    index = detector.load_features(here)
+    print '%d features loaded in %.3f seconds' % (
+        len(index), time.time() - started)
+    folder = os.path.join(here, 'testsuite')
+    pixels = 0
+    seconds = 0.0
+    failed = 0
+    filenames = os.listdir(folder)
+    filenames.sort()
+    for filename in filenames:
+        if not filename.endswith('.png'):
+            continue
+        reader = png.Reader(filename=os.path.join(folder, filename))
+        width, height, rows, metadata = reader.read_rows()
+        if reader.bps == 2:
+            raise SystemExit("%s: 16-bit samples not supported" % filename)
+        rows = list(rgb_rows(rows, reader.planes))
+        started = time.time()
+        check = detector.Detector(width, height, index)
+        for row in rows:
+            check.add_row(row)
+        check.close()
+        seconds += time.time() - started
+        pixels += width * height
+        code, message = detector.problem_from_filename(filename)
+        if check.result is None or check.result[0] != code:
+            failed += 1
+            print filename
+            print 'result', check.result
+    if seconds:
+        print '%d failed, %.1f megapixels in %.2f seconds (%.2f MP/s)' % (
+            failed, pixels / 1e6, seconds, pixels / 1e6 / seconds)
+
+
+if __name__ == '__main__':
+    main()
@@ -59,8 +59,14 @@ import sys
 import zlib
 import struct
 import math
+import threading
 from array import array
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 _adam7 = ((0, 0, 8, 8),
           (4, 0, 8, 8),
@@ -70,6 +76,11 @@ _adam7 = ((0, 0, 8, 8),
           (1, 0, 2, 2),
           (0, 1, 1, 2))
 
+FILTER_ADAPTIVE = 'adaptive'
+UNFILTER_ROUNDS = 4 # vectorized rounds before falling back to a loop
+DECOMPRESS_ROWS = 8 # decompress at most this many rows at a time
+FILTER_TYPES = (0, 1, 2, 3, 4, FILTER_ADAPTIVE)
+
 
 def interleave_planes(ipixels, apixels, ipsize, apsize):
     """
@@ -96,6 +107,325 @@ def interleave_planes(ipixels, apixels, ipsize, apsize):
     return out
 
 
+def paeth_predictor(a, b, c):
+    """
+    http://www.w3.org/TR/PNG/#9Filter-type-4-Paeth
+
+    >>> [paeth_predictor(a, b, c) for a, b, c in [(1, 2, 3), (3, 2, 1)]]
+    [1, 3]
+    """
+    p = a + b - c
+    pa = abs(p - a)
+    pb = abs(p - b)
+    pc = abs(p - c)
+    if pa <= pb and pa <= pc:
+        return a
+    elif pb <= pc:
+        return b
+    return c
+
+
+def filter_scanline(filter_type, line, previous, bpp):
+    """
+    Apply a PNG filter to one scanline, one byte at a time. The
+    previous scanline is None for the first row (of each pass).
+    Return an array without the filter type byte.
+
+    >>> filter_scanline(1, array('B', [1, 2, 3, 4]), None, 1)
+    array('B', [1, 1, 1, 1])
+    >>> filter_scanline(4, array('B', [9, 9]), array('B', [1, 5]), 1)
+    array('B', [8, 0])
+    """
+    length = len(line)
+    if previous is None:
+        previous = [0] * length
+    result = array('B', line)
+    if filter_type == 0:
+        return result
+    for i in range(length):
+        x = line[i]
+        b = previous[i]
+        if i >= bpp:
+            a = line[i - bpp]
+            c = previous[i - bpp]
+        else:
+            a = c = 0
+        if filter_type == 1:
+            x -= a
+        elif filter_type == 2:
+            x -= b
+        elif filter_type == 3:
+            x -= (a + b) >> 1
+        else:
+            x -= paeth_predictor(a, b, c)
+        result[i] = x & 0xff
+    return result
+
+
+def unfilter_scanline(filter_type, line, previous, bpp):
+    """
+    Reverse a PNG filter for one scanline (without the filter type
+    byte). The previous scanline must already be unfiltered, or None
+    for the first row (of each pass). Return an array, which may be
+    the same as the line argument.
+
+    >>> unfilter_scanline(1, array('B', [1, 1, 1, 1]), None, 1)
+    array('B', [1, 2, 3, 4])
+    >>> unfilter_scanline(4, array('B', [8, 0]), array('B', [1, 5]), 1)
+    array('B', [9, 9])
+    """
+    if filter_type == 0:
+        return line
+    if filter_type > 4:
+        raise Error("unknown filter type %d" % filter_type)
+    if previous is None:
+        # http://www.w3.org/TR/PNG/#9Filter-types
+        # Bytes above the first row are zero.
+        if filter_type == 2:
+            return line
+        if filter_type == 4:
+            filter_type = 1 # Paeth predictor is always the left byte
+        elif filter_type == 3:
+            previous = array('B', [0]) * len(line)
+    if numpy is not None:
+        return unfilter_numpy(filter_type, line, previous, bpp)
+    result = line.tolist()
+    if previous is not None:
+        previous = previous.tolist()
+    unfilter_python(filter_type, result, previous, bpp)
+    return array('B', result)
+
+
+def unfilter_python(filter_type, result, above, bpp, start=0):
+    """
+    Reverse a PNG filter in a list of bytes, one byte at a time. The
+    bytes before start must already be unfiltered.
+    """
+    length = len(result)
+    first = max(start, bpp)
+    if filter_type == 1:
+        for i in range(first, length):
+            result[i] = (result[i] + result[i - bpp]) & 0xff
+    elif filter_type == 2:
+        for i in range(start, length):
+            result[i] = (result[i] + above[i]) & 0xff
+    elif filter_type == 3:
+        for i in range(start, bpp):
+            result[i] = (result[i] + (above[i] >> 1)) & 0xff
+        for i in range(first, length):
+            result[i] = (result[i] +
+                         ((result[i - bpp] + above[i]) >> 1)) & 0xff
+    else:
+        # Paeth: left and upper left are zero, so the prediction is b
+        for i in range(start, bpp):
+            result[i] = (result[i] + above[i]) & 0xff
+        for i in range(first, length):
+            a = result[i - bpp]
+            b = above[i]
+            c = above[i - bpp]
+            pa = b - c
+            pb = a - c
+            pc = pa + pb
+            if pa < 0:
+                pa = -pa
+            if pb < 0:
+                pb = -pb
+            if pc < 0:
+                pc = -pc
+            if pa <= pb and pa <= pc:
+                result[i] = (result[i] + a) & 0xff
+            elif pb <= pc:
+                result[i] = (result[i] + b) & 0xff
+            else:
+                result[i] = (result[i] + c) & 0xff
+
+
+def unfilter_numpy(filter_type, line, previous, bpp):
+    """
+    Reverse a PNG filter with array operations on the whole row.
+
+    Sub is a running sum and Up is a simple sum. Paeth depends on the
+    unfiltered byte to the left, so it is solved by iteration, with
+    the row above as the first guess. Each round fixes at least one
+    more pixel, often the whole row on screenshots. After
+    UNFILTER_ROUNDS, the rest is done one byte at a time, like
+    Average, where changes spread too far for iteration to pay off.
+    """
+    x = numpy.frombuffer(line.tostring(), numpy.uint8)
+    if filter_type == 1 and len(line) % bpp == 0:
+        # Running sum for each color plane, wraps around at 256
+        x = x.reshape(len(line) / bpp, bpp)
+        return array('B', x.cumsum(axis=0, dtype=numpy.uint8).tostring())
+    if filter_type == 2:
+        b = numpy.frombuffer(previous.tostring(), numpy.uint8)
+        return array('B', (x + b).tostring())
+    if filter_type != 4:
+        result = line.tolist()
+        if previous is not None:
+            previous = previous.tolist()
+        unfilter_python(filter_type, result, previous, bpp)
+        return array('B', result)
+    x = x.astype(numpy.int16)
+    b = numpy.frombuffer(previous.tostring(), numpy.uint8).astype(numpy.int16)
+    c = numpy.zeros_like(b)
+    c[bpp:] = b[:-bpp]
+    pa = numpy.abs(b - c)
+    a = numpy.zeros_like(b)
+    result = (x + b) & 0xff
+    for dummy in range(UNFILTER_ROUNDS):
+        a[bpp:] = result[:-bpp]
+        pb = numpy.abs(a - c)
+        pc = numpy.abs(a + b - c - c)
+        predicted = (x + numpy.where((pa <= pb) & (pa <= pc), a,
+                                     numpy.where(pb <= pc, b, c))) & 0xff
+        changed = numpy.flatnonzero(predicted != result)
+        result = predicted
+        if not len(changed):
+            return array('B', result.astype(numpy.uint8).tostring())
+    # Everything before the first change is final
+    start = int(changed[0])
+    values = result[:start].tolist() + line[start:].tolist()
+    unfilter_python(filter_type, values, previous.tolist(), bpp, start)
+    return array('B', values)
+
+
+def filter_score(line):
+    """
+    Sum of absolute values as signed bytes, the usual heuristic for
+    choosing a filter: small differences compress well.
+    """
+    total = 0
+    for x in line:
+        if x < 128:
+            total += x
+        else:
+            total += 256 - x
+    return total
+
+
+def filter_rows_python(filter_type, rows, previous, bpp):
+    """
+    Filter a list of scanlines, return a string with the filter type
+    byte before each row. Slow, used if NumPy is not installed.
+    """
+    data = array('B')
+    for line in rows:
+        if filter_type == FILTER_ADAPTIVE:
+            best = None
+            for candidate in range(5):
+                filtered = filter_scanline(candidate, line, previous, bpp)
+                score = filter_score(filtered)
+                if best is None or score < best[0]:
+                    best = (score, candidate, filtered)
+            score, chosen, filtered = best
+        else:
+            chosen = filter_type
+            filtered = filter_scanline(chosen, line, previous, bpp)
+        data.append(chosen)
+        data.extend(filtered)
+        previous = line
+    return data.tostring()
+
+
+def filter_rows_numpy(filter_type, rows, previous, bpp):
+    """
+    Filter a list of scanlines of the same length with array
+    operations on all rows at once, because the filters only depend
+    on the unfiltered bytes. Return a string with the filter type
+    byte before each row.
+    """
+    height = len(rows)
+    width = len(rows[0])
+    raw = ''.join([array('B', line).tostring() for line in rows])
+    x = numpy.frombuffer(raw, numpy.uint8).reshape(height, width)
+    x = x.astype(numpy.int16)
+    b = numpy.zeros_like(x) # above
+    if previous is not None:
+        b[0] = numpy.frombuffer(array('B', previous).tostring(), numpy.uint8)
+    b[1:] = x[:-1]
+    a = numpy.zeros_like(x) # left
+    a[:, bpp:] = x[:, 0:-bpp]
+    c = numpy.zeros_like(x) # upper left
+    c[:, bpp:] = b[:, 0:-bpp]
+    pa = numpy.abs(b - c)
+    pb = numpy.abs(a - c)
+    pc = numpy.abs(a + b - c - c)
+    paeth = numpy.where((pa <= pb) & (pa <= pc), a,
+                        numpy.where(pb <= pc, b, c))
+    predictors = [0, a, b, (a + b) >> 1, paeth]
+    if filter_type == FILTER_ADAPTIVE:
+        filtered = numpy.empty((5, height, width), numpy.uint8)
+        for candidate, predictor in enumerate(predictors):
+            filtered[candidate] = (x - predictor) & 0xff
+        signed = filtered.view(numpy.int8).astype(numpy.int16)
+        scores = numpy.abs(signed).sum(axis=2)
+        chosen = scores.argmin(axis=0) # lowest filter type if equal
+        filtered = filtered[chosen, numpy.arange(height)]
+    else:
+        chosen = filter_type
+        filtered = (x - predictors[filter_type]) & 0xff
+    result = numpy.empty((height, width + 1), numpy.uint8)
+    result[:, 0] = chosen
+    result[:, 1:] = filtered
+    return result.tostring()
+
+
+def zlib_header(level):
+    """
+    Two bytes at the start of a zlib stream.
+    http://www.ietf.org/rfc/rfc1950.txt
+
+    >>> [zlib_header(level) for level in (1, -1, 9)]
+    ['x\\x01', 'x\\x9c', 'x\\xda']
+    """
+    if level == -1:
+        level = 6
+    if level < 2:
+        flevel = 0
+    elif level < 6:
+        flevel = 1
+    elif level == 6:
+        flevel = 2
+    else:
+        flevel = 3
+    cmf = 0x78 # deflate with 32K window
+    flg = flevel << 6
+    flg += (31 - (cmf * 256 + flg) % 31) % 31
+    return chr(cmf) + chr(flg)
+
+
+class DeflateThread(threading.Thread):
+    """
+    Compress one segment of image data in the background, as raw
+    deflate blocks ending with a full flush, so that it doesn't
+    depend on other segments. zlib releases the interpreter lock.
+    """
+
+    def __init__(self, level, data):
+        threading.Thread.__init__(self)
+        self.level = level
+        self.data = data
+        self.result = None
+        self.error = None
+
+    def run(self):
+        try:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                          -zlib.MAX_WBITS)
+            self.result = (compressor.compress(self.data) +
+                           compressor.flush(zlib.Z_FULL_FLUSH))
+        except Exception, error:
+            self.error = error
+        self.data = None
+
+    def get(self):
+        """Wait until finished, return compressed data."""
+        self.join()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
 class Error(Exception):
     pass
 
@@ -114,7 +444,9 @@ class Writer:
                  bytes_per_sample=1,
                  compression=None,
                  interlaced=False,
-                 chunk_limit=2**20):
+                 chunk_limit=2**20,
+                 filter_type=0,
+                 workers=1):
         """
         Create a PNG encoder object.
 
@@ -128,6 +460,9 @@ class Writer:
         bytes_per_sample - 8-bit or 16-bit input data
         compression - zlib compression level (1-9)
         chunk_limit - write multiple IDAT chunks to save memory
+        filter_type - 0 to 4 for the same PNG filter on each row, or
+                      'adaptive' to choose the best filter for each row
+        workers - compress this many segments in parallel threads
 
         If specified, the transparent and background parameters must
         be a tuple with three integer values for red, green, blue, or
@@ -146,6 +481,12 @@ class Writer:
         if bytes_per_sample < 1 or bytes_per_sample > 2:
             raise ValueError("bytes per sample must be 1 or 2")
 
+        if filter_type not in FILTER_TYPES:
+            raise ValueError("filter type must be 0 to 4 or 'adaptive'")
+
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+
         if transparent is not None:
             if greyscale:
                 if type(transparent) is not int:
@@ -183,6 +524,8 @@ class Writer:
         self.compression = compression
         self.chunk_limit = chunk_limit
         self.interlaced = interlaced
+        self.filter_type = filter_type
+        self.workers = workers
 
         if self.greyscale:
             self.color_depth = 1
@@ -217,6 +560,125 @@ class Writer:
         """
         Write a PNG image to the output file.
         """
+        self.write_preamble(outfile)
+
+        # http://www.w3.org/TR/PNG/#11IDAT
+        if self.workers > 1:
+            compressed = self.compress_parallel(self.filter_blocks(scanlines))
+        else:
+            compressed = self.compress(self.filter_blocks(scanlines))
+        for data in compressed:
+            if len(data):
+                self.write_chunk(outfile, 'IDAT', data)
+
+        # http://www.w3.org/TR/PNG/#11IEND
+        self.write_chunk(outfile, 'IEND', '')
+
+    def compression_level(self):
+        """Get the zlib compression level."""
+        if self.compression is None:
+            return zlib.Z_DEFAULT_COMPRESSION
+        return self.compression
+
+    def compress(self, blocks):
+        """
+        Compress filtered image data in one zlib stream.
+        """
+        compressor = zlib.compressobj(self.compression_level())
+        for data in blocks:
+            yield compressor.compress(data)
+        yield compressor.flush()
+
+    def compress_parallel(self, blocks):
+        """
+        Compress filtered image data in independent segments, in
+        parallel threads. The segments are joined at full flush
+        boundaries, so the result is still one zlib stream.
+        """
+        level = self.compression_level()
+        yield zlib_header(level)
+        checksum = zlib.adler32('')
+        running = []
+        for data in blocks:
+            checksum = zlib.adler32(data, checksum)
+            thread = DeflateThread(level, data)
+            thread.start()
+            running.append(thread)
+            if len(running) >= self.workers:
+                yield running.pop(0).get()
+        for thread in running:
+            yield thread.get()
+        # Empty final block, then the checksum
+        yield '\x03\x00' + struct.pack('!I', checksum & 0xffffffff)
+
+    def pass_heights(self):
+        """
+        Number of scanlines in each interlace pass.
+
+        >>> Writer(5, 5, interlaced=True).pass_heights()
+        [1, 1, 1, 2, 1, 3, 2]
+        """
+        if not self.interlaced:
+            return [self.height]
+        heights = []
+        for xstart, ystart, xstep, ystep in _adam7:
+            if xstart < self.width:
+                heights.append(len(range(ystart, self.height, ystep)))
+            else:
+                heights.append(0)
+        return heights
+
+    def filter_blocks(self, scanlines):
+        """
+        Filter scanlines and yield blocks of about chunk_limit bytes,
+        with the filter type byte before each row.
+        """
+        if self.filter_type == 0:
+            data = array('B')
+            for scanline in scanlines:
+                data.append(0)
+                data.extend(scanline)
+                if len(data) > self.chunk_limit:
+                    yield data.tostring()
+                    data = array('B')
+            if len(data):
+                yield data.tostring()
+            return
+        if numpy is None:
+            filter_rows = filter_rows_python
+        else:
+            filter_rows = filter_rows_numpy
+        bpp = self.psize # bytes per complete pixel, at least 1
+        passes = self.pass_heights()
+        remaining = 0
+        previous = None # unfiltered row above, None at start of pass
+        rows = []
+        size = 0
+        for scanline in scanlines:
+            while not remaining:
+                if rows:
+                    yield filter_rows(self.filter_type, rows, previous, bpp)
+                    rows = []
+                    size = 0
+                if not passes:
+                    raise ValueError("too many scanlines")
+                remaining = passes.pop(0)
+                previous = None
+            rows.append(scanline)
+            size += len(scanline) + 1
+            remaining -= 1
+            if size > self.chunk_limit:
+                yield filter_rows(self.filter_type, rows, previous, bpp)
+                previous = rows[-1]
+                rows = []
+                size = 0
+        if rows:
+            yield filter_rows(self.filter_type, rows, previous, bpp)
+
+    def write_preamble(self, outfile):
+        """
+        Write the PNG signature and all chunks before the image data.
+        """
         # http://www.w3.org/TR/PNG/#5PNG-file-signature
         outfile.write(struct.pack("8B", 137, 80, 78, 71, 13, 10, 26, 10))
 
@@ -253,34 +715,6 @@ class Writer:
             self.write_chunk(outfile, 'gAMA',
                              struct.pack("!L", int(self.gamma * 100000)))
 
-        # http://www.w3.org/TR/PNG/#11IDAT
-        if self.compression is not None:
-            compressor = zlib.compressobj(self.compression)
-        else:
-            compressor = zlib.compressobj()
-
-        data = array('B')
-        for scanline in scanlines:
-            data.append(0)
-            data.extend(scanline)
-            if len(data) > self.chunk_limit:
-                compressed = compressor.compress(data.tostring())
-                if len(compressed):
-                    # print >> sys.stderr, len(data), len(compressed)
-                    self.write_chunk(outfile, 'IDAT', compressed)
-                data = array('B')
-        if len(data):
-            compressed = compressor.compress(data.tostring())
-        else:
-            compressed = ''
-        flushed = compressor.flush()
-        if len(compressed) or len(flushed):
-            # print >> sys.stderr, len(data), len(compressed), len(flushed)
-            self.write_chunk(outfile, 'IDAT', compressed + flushed)
-
-        # http://www.w3.org/TR/PNG/#11IEND
-        self.write_chunk(outfile, 'IEND', '')
-
     def write_array(self, outfile, pixels):
         """
         Encode a pixel array to PNG and write output file.
@@ -406,10 +840,10 @@ class _readable:
         self.offset = 0
 
     def read(self, n):
-        r = buf[offset:offset+n]
+        r = self.buf[self.offset:self.offset+n]
         if isinstance(r, array):
             r = r.tostring()
-        offset += n
+        self.offset += n
         return r
 
 
@@ -478,214 +912,138 @@ class Reader:
                              % (tag, a, b))
         return tag, data
 
-    def _reconstruct_sub(self, offset, xstep, ystep):
-        """
-        Reverse sub filter.
-        """
-        pixels = self.pixels
-        a_offset = offset
-        offset += self.psize * xstep
-        if xstep == 1:
-            for index in range(self.psize, self.row_bytes):
-                x = pixels[offset]
-                a = pixels[a_offset]
-                pixels[offset] = (x + a) & 0xff
-                offset += 1
-                a_offset += 1
-        else:
-            byte_step = self.psize * xstep
-            for index in range(byte_step, self.row_bytes, byte_step):
-                for i in range(self.psize):
-                    x = pixels[offset + i]
-                    a = pixels[a_offset + i]
-                    pixels[offset + i] = (x + a) & 0xff
-                offset += self.psize * xstep
-                a_offset += self.psize * xstep
-
-    def _reconstruct_up(self, offset, xstep, ystep):
-        """
-        Reverse up filter.
-        """
-        pixels = self.pixels
-        b_offset = offset - (self.row_bytes * ystep)
-        if xstep == 1:
-            for index in range(self.row_bytes):
-                x = pixels[offset]
-                b = pixels[b_offset]
-                pixels[offset] = (x + b) & 0xff
-                offset += 1
-                b_offset += 1
-        else:
-            for index in range(0, self.row_bytes, xstep * self.psize):
-                for i in range(self.psize):
-                    x = pixels[offset + i]
-                    b = pixels[b_offset + i]
-                    pixels[offset + i] = (x + b) & 0xff
-                offset += self.psize * xstep
-                b_offset += self.psize * xstep
-
-    def _reconstruct_average(self, offset, xstep, ystep):
-        """
-        Reverse average filter.
-        """
-        pixels = self.pixels
-        a_offset = offset - (self.psize * xstep)
-        b_offset = offset - (self.row_bytes * ystep)
-        if xstep == 1:
-            for index in range(self.row_bytes):
-                x = pixels[offset]
-                if index < self.psize:
-                    a = 0
-                else:
-                    a = pixels[a_offset]
-                if b_offset < 0:
-                    b = 0
-                else:
-                    b = pixels[b_offset]
-                pixels[offset] = (x + ((a + b) >> 1)) & 0xff
-                offset += 1
-                a_offset += 1
-                b_offset += 1
-        else:
-            for index in range(0, self.row_bytes, self.psize * xstep):
-                for i in range(self.psize):
-                    x = pixels[offset+i]
-                    if index < self.psize:
-                        a = 0
-                    else:
-                        a = pixels[a_offset + i]
-                    if b_offset < 0:
-                        b = 0
-                    else:
-                        b = pixels[b_offset + i]
-                    pixels[offset + i] = (x + ((a + b) >> 1)) & 0xff
-                offset += self.psize * xstep
-                a_offset += self.psize * xstep
-                b_offset += self.psize * xstep
-
-    def _reconstruct_paeth(self, offset, xstep, ystep):
-        """
-        Reverse Paeth filter.
-        """
-        pixels = self.pixels
-        a_offset = offset - (self.psize * xstep)
-        b_offset = offset - (self.row_bytes * ystep)
-        c_offset = b_offset - (self.psize * xstep)
-        # There's enough inside this loop that it's probably not worth
-        # optimising for xstep == 1
-        for index in range(0, self.row_bytes, self.psize * xstep):
-            for i in range(self.psize):
-                x = pixels[offset+i]
-                if index < self.psize:
-                    a = c = 0
-                    b = pixels[b_offset+i]
-                else:
-                    a = pixels[a_offset+i]
-                    b = pixels[b_offset+i]
-                    c = pixels[c_offset+i]
-                p = a + b - c
-                pa = abs(p - a)
-                pb = abs(p - b)
-                pc = abs(p - c)
-                if pa <= pb and pa <= pc:
-                    pr = a
-                elif pb <= pc:
-                    pr = b
-                else:
-                    pr = c
-                pixels[offset+i] = (x + pr) & 0xff
-            offset += self.psize * xstep
-            a_offset += self.psize * xstep
-            b_offset += self.psize * xstep
-            c_offset += self.psize * xstep
-
-    # N.B. PNG files with 'up', 'average' or 'paeth' filters on the
-    # first line of a pass are legal. The code above for 'average'
-    # deals with this case explicitly. For up we map to the null
-    # filter and for paeth we map to the sub filter.
-
-    def reconstruct_line(self, filter_type, first_line, offset, xstep, ystep):
-        """
-        Reverse the filtering for a scanline.
-        """
-        # print >> sys.stderr, "Filter type %s, first_line=%s" % (
-        #                      filter_type, first_line)
-        filter_type += (first_line << 8)
-        if filter_type == 1 or filter_type == 0x101 or filter_type == 0x104:
-            self._reconstruct_sub(offset, xstep, ystep)
-        elif filter_type == 2:
-            self._reconstruct_up(offset, xstep, ystep)
-        elif filter_type == 3 or filter_type == 0x103:
-            self._reconstruct_average(offset, xstep, ystep)
-        elif filter_type == 4:
-            self._reconstruct_paeth(offset, xstep, ystep)
-        return
-
     def deinterlace(self, scanlines):
         """
         Read pixel data and remove interlacing.
         """
-        # print >> sys.stderr, ("Reading interlaced, w=%s, r=%s, planes=%s," +
-        #     " bpp=%s") % (self.width, self.height, self.planes, self.bps)
-        a = array('B')
-        self.pixels = a
-        # Make the array big enough
-        temp = scanlines[0:self.width*self.height*self.psize]
-        a.extend(temp)
+        psize = self.psize
+        pixels = array('B', [0]) * (self.row_bytes * self.height)
         source_offset = 0
         for xstart, ystart, xstep, ystep in _adam7:
-            # print >> sys.stderr, "Adam7: start=%s,%s step=%s,%s" % (
-            #     xstart, ystart, xstep, ystep)
-            filter_first_line = 1
+            if xstart >= self.width:
+                continue
+            # Note we want the ceiling of (width - xstart) / xstep
+            row_len = psize * ((self.width - xstart + xstep - 1) / xstep)
+            previous = None
             for y in range(ystart, self.height, ystep):
-                if xstart >= self.width:
-                    continue
                 filter_type = scanlines[source_offset]
                 source_offset += 1
+                line = scanlines[source_offset:source_offset + row_len]
+                source_offset += row_len
+                line = unfilter_scanline(filter_type, line, previous, psize)
+                previous = line
+                offset = y * self.row_bytes + xstart * psize
                 if xstep == 1:
-                    offset = y * self.row_bytes
-                    a[offset:offset+self.row_bytes] = \
-                        scanlines[source_offset:source_offset + self.row_bytes]
-                    source_offset += self.row_bytes
-                else:
-                    # Note we want the ceiling of (width - xstart) / xtep
-                    row_len = self.psize * (
-                        (self.width - xstart + xstep - 1) / xstep)
-                    offset = y * self.row_bytes + xstart * self.psize
-                    end_offset = (y+1) * self.row_bytes
-                    skip = self.psize * xstep
-                    for i in range(self.psize):
-                        a[offset+i:end_offset:skip] = \
-                            scanlines[source_offset + i:
-                                      source_offset + row_len:
-                                      self.psize]
-                    source_offset += row_len
-                if filter_type:
-                    self.reconstruct_line(filter_type, filter_first_line,
-                                          offset, xstep, ystep)
-                filter_first_line = 0
-        return a
+                    pixels[offset:offset + row_len] = line
+                    continue
+                end_offset = (y + 1) * self.row_bytes
+                skip = psize * xstep
+                for i in range(psize):
+                    pixels[offset + i:end_offset:skip] = line[i::psize]
+        return pixels
 
     def read_flat(self, scanlines):
         """
         Read pixel data without de-interlacing.
         """
-        a = array('B')
-        self.pixels = a
-        offset = 0
+        pixels = array('B')
+        row_bytes = self.row_bytes
+        previous = None
         source_offset = 0
-        filter_first_line = 1
         for y in range(self.height):
             filter_type = scanlines[source_offset]
             source_offset += 1
-            a.extend(scanlines[source_offset: source_offset + self.row_bytes])
-            if filter_type:
-                self.reconstruct_line(filter_type, filter_first_line,
-                                      offset, 1, 1)
-            filter_first_line = 0
-            offset += self.row_bytes
-            source_offset += self.row_bytes
-        return a
+            line = scanlines[source_offset:source_offset + row_bytes]
+            source_offset += row_bytes
+            previous = unfilter_scanline(filter_type, line, previous,
+                                         self.psize)
+            pixels.extend(previous)
+        return pixels
+
+    def validate_signature(self):
+        """
+        Read the PNG signature and make sure it is valid.
+        """
+        signature = self.file.read(8)
+        if (signature != struct.pack("8B", 137, 80, 78, 71, 13, 10, 26, 10)):
+            raise Error("PNG file has invalid header")
+
+    def next_chunk(self):
+        """
+        Read the next chunk, and convert chunk errors to png.Error.
+        """
+        try:
+            return self.read_chunk()
+        except ValueError, e:
+            raise Error('Chunk error: ' + e.args[0])
+
+    def process_chunk(self, tag, data, image_metadata):
+        """
+        Process a chunk that contains image parameters or metadata.
+        """
+        # print >> sys.stderr, tag, len(data)
+        if tag == 'IHDR': # http://www.w3.org/TR/PNG/#11IHDR
+            (width, height, bits_per_sample, color_type,
+             compression_method, filter_method,
+             interlaced) = struct.unpack("!2I5B", data)
+            bps = bits_per_sample / 8
+            if bps == 0:
+                raise Error("unsupported pixel depth")
+            if bps > 2 or bits_per_sample != (bps * 8):
+                raise Error("invalid pixel depth")
+            if color_type == 0:
+                greyscale = True
+                has_alpha = False
+                planes = 1
+            elif color_type == 2:
+                greyscale = False
+                has_alpha = False
+                planes = 3
+            elif color_type == 4:
+                greyscale = True
+                has_alpha = True
+                planes = 2
+            elif color_type == 6:
+                greyscale = False
+                has_alpha = True
+                planes = 4
+            else:
+                raise Error("unknown PNG colour type %s" % color_type)
+            if compression_method != 0:
+                raise Error("unknown compression method")
+            if filter_method != 0:
+                raise Error("unknown filter method")
+            self.bps = bps
+            self.planes = planes
+            self.psize = bps * planes
+            self.width = width
+            self.height = height
+            self.row_bytes = width * self.psize
+            self.greyscale = greyscale
+            self.has_alpha = has_alpha
+            self.interlaced = interlaced
+        elif tag == 'bKGD':
+            if self.greyscale:
+                image_metadata["background"] = struct.unpack("!1H", data)
+            else:
+                image_metadata["background"] = struct.unpack("!3H", data)
+        elif tag == 'tRNS':
+            if self.greyscale:
+                image_metadata["transparent"] = struct.unpack("!1H", data)
+            else:
+                image_metadata["transparent"] = struct.unpack("!3H", data)
+        elif tag == 'gAMA':
+            image_metadata["gamma"] = (
+                struct.unpack("!L", data)[0]) / 100000.0
+
+    def update_metadata(self, image_metadata):
+        """
+        Add image parameters from the IHDR chunk to the metadata.
+        """
+        image_metadata["greyscale"] = self.greyscale
+        image_metadata["has_alpha"] = self.has_alpha
+        image_metadata["bytes_per_sample"] = self.bps
+        image_metadata["interlaced"] = self.interlaced
 
     def read(self):
         """
@@ -694,83 +1052,119 @@ class Reader:
         This function is a very early prototype with limited flexibility
         and excessive use of memory.
         """
-        signature = self.file.read(8)
-        if (signature != struct.pack("8B", 137, 80, 78, 71, 13, 10, 26, 10)):
-            raise Error("PNG file has invalid header")
+        self.validate_signature()
         compressed = []
         image_metadata = {}
         while True:
-            try:
-                tag, data = self.read_chunk()
-            except ValueError, e:
-                raise Error('Chunk error: ' + e.args[0])
-
-            # print >> sys.stderr, tag, len(data)
-            if tag == 'IHDR': # http://www.w3.org/TR/PNG/#11IHDR
-                (width, height, bits_per_sample, color_type,
-                 compression_method, filter_method,
-                 interlaced) = struct.unpack("!2I5B", data)
-                bps = bits_per_sample / 8
-                if bps == 0:
-                    raise Error("unsupported pixel depth")
-                if bps > 2 or bits_per_sample != (bps * 8):
-                    raise Error("invalid pixel depth")
-                if color_type == 0:
-                    greyscale = True
-                    has_alpha = False
-                    planes = 1
-                elif color_type == 2:
-                    greyscale = False
-                    has_alpha = False
-                    planes = 3
-                elif color_type == 4:
-                    greyscale = True
-                    has_alpha = True
-                    planes = 2
-                elif color_type == 6:
-                    greyscale = False
-                    has_alpha = True
-                    planes = 4
-                else:
-                    raise Error("unknown PNG colour type %s" % color_type)
-                if compression_method != 0:
-                    raise Error("unknown compression method")
-                if filter_method != 0:
-                    raise Error("unknown filter method")
-                self.bps = bps
-                self.planes = planes
-                self.psize = bps * planes
-                self.width = width
-                self.height = height
-                self.row_bytes = width * self.psize
-            elif tag == 'IDAT': # http://www.w3.org/TR/PNG/#11IDAT
+            tag, data = self.next_chunk()
+            if tag == 'IDAT': # http://www.w3.org/TR/PNG/#11IDAT
                 compressed.append(data)
-            elif tag == 'bKGD':
-                if greyscale:
-                    image_metadata["background"] = struct.unpack("!1H", data)
-                else:
-                    image_metadata["background"] = struct.unpack("!3H", data)
-            elif tag == 'tRNS':
-                if greyscale:
-                    image_metadata["transparent"] = struct.unpack("!1H", data)
-                else:
-                    image_metadata["transparent"] = struct.unpack("!3H", data)
-            elif tag == 'gAMA':
-                image_metadata["gamma"] = (
-                    struct.unpack("!L", data)[0]) / 100000.0
             elif tag == 'IEND': # http://www.w3.org/TR/PNG/#11IEND
                 break
+            else:
+                self.process_chunk(tag, data, image_metadata)
         scanlines = array('B', zlib.decompress(''.join(compressed)))
-        if interlaced:
+        if self.interlaced:
             pixels = self.deinterlace(scanlines)
         else:
             pixels = self.read_flat(scanlines)
-        image_metadata["greyscale"] = greyscale
-        image_metadata["has_alpha"] = has_alpha
-        image_metadata["bytes_per_sample"] = bps
-        image_metadata["interlaced"] = interlaced
-        return width, height, pixels, image_metadata
+        self.update_metadata(image_metadata)
+        return self.width, self.height, pixels, image_metadata
 
+    def read_rows(self):
+        """
+        Read a PNG file incrementally, return width, height, an iterator
+        over the rows of pixels, and image metadata.
+
+        Only the chunks up to the first IDAT chunk are read here.
+        The image data is decompressed and unfiltered while the rows are
+        requested, keeping only two rows in memory, so that very tall
+        images don't need much RAM. Interlaced images are decoded in
+        one piece and then split into rows.
+        """
+        self.validate_signature()
+        image_metadata = {}
+        while True:
+            tag, data = self.next_chunk()
+            if tag == 'IDAT':
+                break
+            if tag == 'IEND':
+                raise Error("PNG file has no image data")
+            self.process_chunk(tag, data, image_metadata)
+        self.update_metadata(image_metadata)
+        if self.interlaced:
+            rows = self.iter_interlaced(data)
+        else:
+            rows = self.iter_flat(data)
+        return self.width, self.height, rows, image_metadata
+
+    def iter_idat(self, data):
+        """
+        Iterate over the contents of all IDAT chunks, starting with
+        data that was already read.
+        """
+        yield data
+        while True:
+            tag, data = self.next_chunk()
+            if tag == 'IDAT':
+                yield data
+            elif tag == 'IEND':
+                break
+
+    def iter_decompressed(self, data, max_length):
+        """
+        Decompress the contents of all IDAT chunks in pieces of at
+        most max_length bytes, so that a small file with a lot of
+        highly compressed data can't fill the memory.
+        """
+        decompressor = zlib.decompressobj()
+        for data in self.iter_idat(data):
+            while data:
+                yield decompressor.decompress(data, max_length)
+                data = decompressor.unconsumed_tail
+        yield decompressor.flush()
+
+    def iter_interlaced(self, data):
+        """
+        Decode an interlaced image in one piece and iterate over rows.
+        """
+        # All seven passes together have less than 2 * height + 7 rows
+        limit = (self.row_bytes + 1) * (2 * self.height + 7)
+        pieces = []
+        total = 0
+        for piece in self.iter_decompressed(data, limit):
+            total += len(piece)
+            if total > limit:
+                raise Error("PNG file has too much image data")
+            pieces.append(piece)
+        pixels = self.deinterlace(array('B', ''.join(pieces)))
+        for offset in range(0, len(pixels), self.row_bytes):
+            yield pixels[offset:offset + self.row_bytes]
+
+    def iter_flat(self, data):
+        """
+        Decompress and unfilter one row at a time.
+        """
+        line_bytes = self.row_bytes + 1
+        previous = None
+        buf = ''
+        y = 0
+        for piece in self.iter_decompressed(data,
+                                            DECOMPRESS_ROWS * line_bytes):
+            buf += piece
+            offset = 0
+            while len(buf) - offset >= line_bytes and y < self.height:
+                filter_type = ord(buf[offset])
+                line = array('B', buf[offset + 1:offset + line_bytes])
+                offset += line_bytes
+                previous = unfilter_scanline(filter_type, line, previous,
+                                             self.psize)
+                y += 1
+                yield previous
+            if y == self.height:
+                return # Ignore extra data after the last row
+            buf = buf[offset:]
+        raise Error("PNG file has only %d of %d rows" % (y, self.height))
 
 def test_suite(options):
     """
@@ -934,7 +1328,9 @@ def test_suite(options):
                     gamma=options.gamma,
                     has_alpha=options.test_alpha,
                     compression=options.compression,
-                    interlaced=options.interlace)
+                    interlaced=options.interlace,
+                    filter_type=options.filter,
+                    workers=options.workers)
     writer.write_array(sys.stdout, pixels)
 
 
@@ -1004,6 +1400,12 @@ def _main():
     parser.add_option("-c", "--compression",
                       action="store", type="int", metavar="level",
                       help="zlib compression level (0-9)")
+    parser.add_option("-f", "--filter",
+                      action="store", type="string", metavar="type",
+                      help="PNG filter type (0-4 or adaptive)")
+    parser.add_option("-j", "--workers",
+                      action="store", type="int", metavar="count",
+                      default=1, help="compress in parallel threads")
     parser.add_option("-T", "--test",
                       default=False, action="store_true",
                       help="create a test image")
@@ -1028,6 +1430,10 @@ def _main():
     (options, args) = parser.parse_args()
 
     # Convert options
+    if options.filter is None:
+        options.filter = 0
+    elif options.filter != FILTER_ADAPTIVE:
+        options.filter = int(options.filter)
     if options.transparent is not None:
         options.transparent = color_triple(options.transparent)
     if options.background is not None:
@@ -1056,7 +1462,9 @@ def _main():
                     background=options.background,
                     has_alpha=options.alpha is not None,
                     gamma=options.gamma,
-                    compression=options.compression)
+                    compression=options.compression,
+                    filter_type=options.filter,
+                    workers=options.workers)
     if options.alpha is not None:
         pgmfile = open(options.alpha, 'rb')
         awidth, aheight = read_pnm_header(pgmfile, 'P5')
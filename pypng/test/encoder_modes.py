@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+"""
+Usage: encoder_modes.py [-j workers] [-c level] screenshot.ppm ...
+
+Encode PPM files with different filter and compression modes, print
+throughput (megabytes of raw pixel data per second) and output size.
+Each result is decoded again to make sure that it is correct, and the
+decoder throughput is printed too.
+
+"""
+
+
+__revision__ = '$Rev$'
+
+
+import os
+import sys
+import time
+from optparse import OptionParser
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+import png
+
+
+def read_ppm(filename):
+    """
+    Read a PPM file, return width, height and pixels.
+    """
+    infile = open(filename, 'rb')
+    width, height = png.read_pnm_header(infile)
+    pixels = png.array('B')
+    pixels.fromfile(infile, 3 * width * height)
+    infile.close()
+    return width, height, pixels
+
+
+def encode(width, height, pixels, **kwargs):
+    """
+    Encode pixels to PNG, return elapsed seconds and PNG data.
+    """
+    outfile = StringIO()
+    writer = png.Writer(width, height, **kwargs)
+    started = time.time()
+    writer.write_array(outfile, pixels)
+    seconds = time.time() - started
+    return seconds, outfile.getvalue()
+
+
+def check(data, pixels):
+    """
+    Make sure that the PNG data decodes to the same pixels, return
+    elapsed seconds.
+    """
+    started = time.time()
+    reader = png.Reader(pixels=data)
+    width, height, rows, metadata = reader.read_rows()
+    decoded = png.array('B')
+    for row in rows:
+        decoded.extend(row)
+    seconds = time.time() - started
+    if decoded != pixels:
+        raise ValueError("decoded pixels are different")
+    return seconds
+
+
+def main():
+    parser = OptionParser(usage="%prog [options] screenshot.ppm ...")
+    parser.add_option('-j', '--workers', type='int', default=4,
+                      help="threads for parallel modes (default 4)")
+    parser.add_option('-c', '--compression', type='int',
+                      help="zlib compression level (default 6)")
+    options, args = parser.parse_args()
+    if not args:
+        parser.error("no input files")
+    modes = [
+        ('filter 0', 0, 1),
+        ('filter 0, parallel', 0, options.workers),
+        ('adaptive', png.FILTER_ADAPTIVE, 1),
+        ('adaptive, parallel', png.FILTER_ADAPTIVE, options.workers),
+        ('sub', 1, 1),
+        ('up', 2, 1),
+        ('average', 3, 1),
+        ('paeth', 4, 1),
+        ]
+    if png.numpy is None:
+        print "NumPy is not installed, filtering will be slow."
+    for filename in args:
+        width, height, pixels = read_ppm(filename)
+        megabytes = len(pixels) / 1e6
+        print '%s: %dx%d, %.1f MB' % (filename, width, height, megabytes)
+        for name, filter_type, workers in modes:
+            seconds, data = encode(width, height, pixels,
+                                   compression=options.compression,
+                                   filter_type=filter_type, workers=workers)
+            decode_seconds = check(data, pixels)
+            print '  %-20s %6.2f MB/s %10d bytes, decode %6.2f MB/s' % (
+                name, megabytes / max(seconds, 1e-6), len(data),
+                megabytes / max(decode_seconds, 1e-6))
+
+
+if __name__ == '__main__':
+    main()
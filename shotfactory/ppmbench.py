@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# browsershots.org - Test your web design in different browsers
+# Copyright (C) 2007 Johann C. Rocholl <johann@browsershots.org>
+#
+# Browsershots is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Browsershots is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compare speed and results of the Python and NumPy versions of
+hashmatch.find_offset on recorded PPM pairs, and of the band search
+around the expected offset (which is taken from the full search).
+
+Usage: ppmbench.py [-r repeat] [-t tolerance] top1.ppm bottom1.ppm ...
+"""
+
+__revision__ = "$Rev$"
+__date__ = "$Date$"
+__author__ = "$Author$"
+
+import sys
+import time
+from optparse import OptionParser
+from shotfactory04.image import hashmatch
+
+
+def measure(function, repeat, *args):
+    """Return result and best time in seconds."""
+    best = None
+    for index in range(repeat):
+        started = time.time()
+        result = function(*args)
+        seconds = time.time() - started
+        if best is None or seconds < best:
+            best = seconds
+    return result, best
+
+
+def main():
+    parser = OptionParser(usage="%prog [options] top.ppm bottom.ppm ...")
+    parser.add_option('-r', '--repeat', type='int', default=3,
+                      help="best of REPEAT runs (default 3)")
+    parser.add_option('-t', '--tolerance', type='int', default=40,
+                      help="band search window (default +-40 pixels)")
+    options, args = parser.parse_args()
+    if not args or len(args) % 2:
+        parser.error("need pairs of PPM files")
+    if hashmatch.numpy is None:
+        sys.exit("NumPy is not installed.")
+    totals = [0.0, 0.0, 0.0]
+    mismatches = 0
+    for index in range(0, len(args), 2):
+        width, height1, pixels1 = hashmatch.read_ppm(args[index])
+        width2, height2, pixels2 = hashmatch.read_ppm(args[index + 1])
+        assert width == width2
+        results = []
+        for number, function in enumerate([hashmatch.find_offset_python,
+                                           hashmatch.find_offset_numpy]):
+            offset, seconds = measure(function, options.repeat,
+                width, height1, pixels1, height2, pixels2)
+            totals[number] += seconds
+            results.append((offset, seconds))
+        (python, python_seconds), (numpy, numpy_seconds) = results
+        window = (numpy - options.tolerance, numpy + options.tolerance)
+        band, band_seconds = measure(hashmatch.find_band_offset,
+            options.repeat, width, height1, pixels1, height2, pixels2,
+            window)
+        totals[2] += band_seconds
+        mismatch = python != numpy or band not in (0, numpy)
+        if mismatch:
+            mismatches += 1
+        print '%s %s: python %d (%.3fs) numpy %d (%.3fs) band %d (%.3fs)%s' % (
+            args[index], args[index + 1],
+            python, python_seconds, numpy, numpy_seconds,
+            band, band_seconds, ('', ' MISMATCH')[mismatch])
+    print 'total: python %.3fs numpy %.3fs speedup %.1fx, %d mismatches' % (
+        totals[0], totals[1], totals[0] / max(totals[1], 1e-6), mismatches)
+    print 'band search: %.3fs, speedup %.1fx over numpy' % (
+        totals[2], totals[1] / max(totals[2], 1e-6))
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
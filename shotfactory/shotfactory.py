@@ -30,11 +30,24 @@ import time
 import re
 import socket
 import platform
+import copy
+import shutil
 import traceback
+import threading
 import xmlrpclib
 
 DEFAULT_SERVER_URL = 'http://api.browsershots.org/'
 DEFAULT_PASSWORD_FILE = '.passwd'
+LOCK_SECONDS = 300 # requests.poll locks a request for five minutes
+LONG_POLL_MIN_WAIT = 10 # seconds, longer polls don't need error_sleep
+ERROR_SLEEP = 60 # seconds, unless the server sends a retry hint
+MIN_RETRY, MAX_RETRY = 5, 900 # seconds, limits for retry hints
+retry_hint_search = re.compile(r'try again in (\d+) seconds').search
+PIPELINE_MAX_AGE = 120 # seconds, finish slow uploads before next poll
+SLOT_START_DELAY = 10 # seconds between starting worker slots
+SLOT_SKELETON = ('.vnc', '.mozilla', '.iceweasel', '.opera', '.kde',
+                 '.gnome2', '.galeon', '.flock', '.kazehakase',
+                 '.netscape', '.phoenix', '.wine')
 
 # Security: allow only alphanumeric browser commands
 # Optionally within a subfolder, relative to working directory
@@ -56,9 +69,24 @@ def log(message, extra=None):
     logfile.close()
 
 
-def sleep():
+def sleep(seconds=None):
     """Sleep a while to wait for new requests."""
-    time.sleep(60)
+    time.sleep(seconds or ERROR_SLEEP)
+
+
+def retry_hint(message):
+    """
+    Get the retry time from an overload message, or None.
+
+    >>> retry_hint("Overloaded. Please try again in 37 seconds.")
+    37
+    >>> retry_hint("Overloaded. Please try again in a minute.")
+    >>> retry_hint("Please try again in 3600 seconds.")
+    900
+    """
+    match = retry_hint_search(message)
+    if match:
+        return max(MIN_RETRY, min(MAX_RETRY, int(match.group(1))))
 
 
 def can_reuse_vnc_server(options, config, previous):
@@ -109,9 +137,10 @@ def can_reuse_browser(options, gui, config, previous):
         return True
 
 
-def browsershot(options, server, config, password):
+def open_browser(options, server, config):
     """
-    Process a screenshot request and upload the resulting PNG file.
+    Start the browser for a screenshot request, or reuse the running
+    one. Return the GUI wrapper.
     """
     browser_module = config['browser'].lower().replace('-', '_')
     if browser_module == 'internet explorer':
@@ -146,25 +175,80 @@ def browsershot(options, server, config, password):
         gui.reset_browser()
         gui.start_browser(config, url, options)
         options.reuse_count = 1
+    return gui
 
-    # Make screenshots
-    pngfilename = '%s.png' % config['request']
-    if os.path.exists(pngfilename):
-        os.remove(pngfilename)
-    gui.browsershot(pngfilename)
 
+def capture_pages(options, gui, config):
+    """
+    Make screenshots, return the offsets between pages.
+    """
+    offsets = gui.capture_pages()
     if not options.reuse_browser:
         gui.close()
     options.previous = config
+    return offsets
+
 
-    # Upload PNG file
+def save_and_upload(server, gui, config, offsets):
+    """
+    Encode the captured pages and upload the resulting PNG file.
+    """
+    pngfilename = '%s.png' % config['request']
+    if os.path.exists(pngfilename):
+        os.remove(pngfilename)
+    gui.save_png(pngfilename, offsets)
     bytes = server.upload_png(config, pngfilename)
     if os.path.exists(pngfilename):
         os.remove(pngfilename)
     return bytes
 
 
-def error_sleep(message):
+def browsershot(options, server, config, password):
+    """
+    Process a screenshot request and upload the resulting PNG file.
+    """
+    gui = open_browser(options, server, config)
+    offsets = capture_pages(options, gui, config)
+    return save_and_upload(server, gui, config, offsets)
+
+
+class Uploader(threading.Thread):
+    """
+    Encode and upload a screenshot in the background, while the next
+    request is polled and its browser is loading the page.
+    """
+
+    def __init__(self, server, gui, config, offsets, polled):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.server = server
+        self.gui = gui
+        self.config = config
+        self.offsets = offsets
+        self.polled = polled
+        self.bytes = None
+        self.error = None
+
+    def run(self):
+        """Save and upload, keep any exception for the main thread."""
+        try:
+            if time.time() - self.polled > LOCK_SECONDS:
+                print "Request %s is older than the server lock." % (
+                    self.config['request'])
+            self.bytes = save_and_upload(
+                self.server, self.gui, self.config, self.offsets)
+        except:
+            self.error = sys.exc_info()
+
+    def result(self):
+        """Wait until done, return uploaded bytes or raise the error."""
+        self.join()
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.bytes
+
+
+def error_sleep(message, seconds=None):
     """
     Log error message, sleep a while.
     """
@@ -177,7 +261,7 @@ def error_sleep(message):
     print message
     if not message.startswith('204 '):
         log(message)
-    sleep()
+    sleep(seconds)
 
 
 def systemload():
@@ -232,7 +316,7 @@ def _main():
                       help="tcp port number used by VNC server for incoming connections (default: 5902)")
     parser.add_option('-w', '--wait', type='int',
                       metavar='<seconds>', default=30,
-                      help="wait while page is loading (default: 30)")
+                      help="maximum wait while page is loading (default: 30)")
     parser.add_option('-l', '--load-limit', type='float',
                       metavar='<limit>', default=1.0,
                       help="system load limit (default: 1.0)")
@@ -255,6 +339,16 @@ def _main():
                       help="restart browser only after <max> requests")
     parser.add_option('-W', '--reuse-wait', type='int', metavar='<seconds>',
                       help="shorter wait time when reusing (default: --wait)")
+    parser.add_option('-t', '--fixed-wait', action='store_true',
+                      help="always wait, use if pages are captured too early")
+    parser.add_option('-a', '--pipeline', action='store_true',
+                      help="encode and upload while the next page loads")
+    parser.add_option('-n', '--slots', type='int', metavar='<count>',
+                      default=1,
+                      help="run browsers on several displays (default: 1)")
+    parser.add_option('-S', '--slot-root', metavar='<directory>',
+                      default='slots',
+                      help="home folders for slots (default: slots)")
     (options, args) = parser.parse_args()
     options.revision = revision
 
@@ -269,6 +363,11 @@ def _main():
         options.reuse_count = 0
     if not options.reuse_wait:
         options.reuse_wait = options.wait
+    if options.slots < 1:
+        parser.error("--slots must be at least 1")
+    if options.slots > 1 and platform.system() not in (
+        'Linux', 'FreeBSD', 'OpenBSD', 'NetBSD'):
+        parser.error("--slots is only supported with X11")
 
     if options.queue and (options.output or options.resize_output):
         options.server = None
@@ -317,33 +416,93 @@ def _main():
         if options.verbose:
             server.debug_factory_features()
 
-    options.previous = None
-    upload_log = []
+    upload_log = UploadLog()
+    if options.slots > 1:
+        run_slots(options, server, upload_log)
+    else:
+        options.previous = None
+        run_loop(options, server, upload_log)
+
+
+class UploadLog:
+    """
+    Recent uploads for the --upload-limit check, shared by all slots.
+    """
+
+    def __init__(self):
+        self.entries = []
+        self.lock = threading.Lock()
+
+    def add(self, bytes):
+        """Record an upload."""
+        self.lock.acquire()
+        try:
+            self.entries.append((time.time(), bytes))
+        finally:
+            self.lock.release()
+
+    def bytes_per_hour(self):
+        """Estimate upload rate from the last hour, or None."""
+        self.lock.acquire()
+        try:
+            one_hour_ago = time.time() - 3600
+            self.entries = [log for log in self.entries
+                            if log[0] > one_hour_ago]
+            if not self.entries:
+                return None
+            bytes_uploaded = sum([log[1] for log in self.entries])
+            seconds = max(60, time.time() - self.entries[0][0])
+            return bytes_uploaded / seconds * 3600
+        finally:
+            self.lock.release()
+
+
+def run_loop(options, server, upload_log):
+    """
+    Poll for requests, make and upload screenshots, forever.
+    """
+    uploader = None
     while True:
+        poll_started = None
         try:
+            if uploader is not None and (not uploader.isAlive() or
+                time.time() - uploader.polled > PIPELINE_MAX_AGE):
+                # Don't lock another request while this upload is slow
+                finished, uploader = uploader, None
+                upload_log.add(finished.result())
             load = systemload()
             if load > options.load_limit:
                 error_sleep("system load %.2f exceeds limit %.2f, sleeping" %
                             (load, options.load_limit))
                 continue
-            one_hour_ago = time.time() - 3600
-            upload_log = [log for log in upload_log if log[0] > one_hour_ago]
-            if upload_log:
-                bytes_uploaded = sum([log[1] for log in upload_log])
-                seconds = max(60, time.time() - upload_log[0][0])
-                bytes_per_hour = bytes_uploaded / seconds * 3600
-                if bytes_per_hour > options.upload_limit * 1024 * 1024:
-                    error_sleep(' '.join((
+            bytes_per_hour = upload_log.bytes_per_hour()
+            if (bytes_per_hour is not None and
+                bytes_per_hour > options.upload_limit * 1024 * 1024):
+                error_sleep(' '.join((
 "estimated %.2f MB per hour" % (bytes_per_hour / 1024.0 / 1024.0),
 "exceeds upload limit %.2f MB, sleeping" % options.upload_limit)))
-                    continue
+                continue
             print '=' * 30, time.strftime('%H:%M:%S'), '=' * 30
+            poll_started = time.time()
             config = server.poll()
+            polled = time.time()
             print config
             if config['command'] and not safe_command(config['command']):
                 raise RuntimeError("unsafe command '%s'" % config['command'])
-            bytes = browsershot(options, server, config, options.password)
-            upload_log.append((time.time(), bytes))
+            if not options.pipeline:
+                bytes = browsershot(options, server, config, options.password)
+                upload_log.add(bytes)
+                continue
+            gui = open_browser(options, server, config)
+            offsets = capture_pages(options, gui, config)
+            # Only one upload at a time
+            finished = uploader
+            if finished is not None:
+                finished.join()
+            uploader = Uploader(server, gui, config, offsets, polled)
+            uploader.start()
+            if finished is not None:
+                upload_log.add(finished.result())
         except socket.gaierror, (errno, message):
             error_sleep("Socket gaierror: " + message)
         except socket.timeout:
@@ -357,12 +516,68 @@ def _main():
         except xmlrpclib.ProtocolError:
             error_sleep("XML-RPC protocol error.")
         except xmlrpclib.Fault, fault:
-            error_sleep("%d %s" % (fault.faultCode, fault.faultString))
+            if (fault.faultCode == 204 and poll_started is not None and
+                time.time() - poll_started > LONG_POLL_MIN_WAIT):
+                # The server has been waiting for new requests already
+                print "%d %s" % (fault.faultCode, fault.faultString)
+                continue
+            error_sleep("%d %s" % (fault.faultCode, fault.faultString),
+                        retry_hint(fault.faultString))
         except RuntimeError, message:
             if options.verbose:
                 traceback.print_exc()
             error_sleep(str(message))
 
 
+def prepare_slot_home(home):
+    """
+    Create the home folder for a worker slot, with copies of the VNC
+    settings and browser profiles from the real home folder. Existing
+    slot folders are left alone, so they can be customized.
+    """
+    if not os.path.exists(home):
+        os.makedirs(home)
+        for name in SLOT_SKELETON:
+            source = os.path.join(os.environ['HOME'], name)
+            if os.path.isdir(source):
+                shutil.copytree(source, os.path.join(home, name), True)
+            elif os.path.exists(source):
+                shutil.copy2(source, os.path.join(home, name))
+    tmpdir = os.path.join(home, 'tmp')
+    if not os.path.exists(tmpdir):
+        os.mkdir(tmpdir)
+    return tmpdir
+
+
+def run_slots(options, server, upload_log):
+    """
+    Run several worker slots in threads, each with its own display,
+    home folder (browser profiles) and temp folder. They share the
+    server session and the load and upload limits.
+    """
+    host, display = options.display.rsplit(':', 1)
+    threads = []
+    for slot in range(options.slots):
+        slot_options = copy.copy(options)
+        slot_options.display = '%s:%d' % (host, int(display) + slot)
+        if options.rfbport:
+            slot_options.rfbport = options.rfbport + slot
+        slot_options.home = os.path.abspath(
+            os.path.join(options.slot_root, 'slot%d' % slot))
+        slot_options.tmpdir = prepare_slot_home(slot_options.home)
+        slot_options.previous = None
+        print "Slot %d on display %s in %s" % (
+            slot, slot_options.display, slot_options.home)
+        thread = threading.Thread(target=run_loop,
+                                  args=(slot_options, server, upload_log))
+        thread.setDaemon(True)
+        thread.start()
+        threads.append(thread)
+        time.sleep(SLOT_START_DELAY)
+    while True:
+        # Join with timeout, so that KeyboardInterrupt works
+        for thread in threads:
+            thread.join(1.0)
+
 if __name__ == '__main__':
     _main()
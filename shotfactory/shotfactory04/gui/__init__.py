@@ -25,9 +25,23 @@ __author__ = "$Author$"
 import time
 import os
 import shutil
-from array import array
 from glob import glob
-from shotfactory04.image import hashmatch, png
+from shotfactory04.image import hashmatch, png, frames
+from shotfactory04.image.frames import similar
+from shotfactory04.gui import calibration
+
+DEBUG_VERBOSITY = 3 # save page captures to PPM files
+PNG_WORKERS = 2 # threads for PNG compression
+SETTLE_INTERVAL = 0.5 # seconds between screen grabs while a page loads
+SETTLE_FRAMES = 3 # similar grabs in a row mean the page is ready
+SETTLE_TOLERANCE = 0.02 # fraction of sampled rows that may still change
+SETTLE_MIN_FRACTION = 0.25 # of the timeout, always wait at least this long
+SCROLL_INTERVAL = 0.1 # seconds between screen grabs after scrolling
+SCROLL_TIMEOUT = 1.5 # seconds, e.g. if the page didn't scroll at all
+SCROLL_FIXED_WAIT = 0.5 # seconds, without capture_frame or --fixed-wait
+OFFSET_TOLERANCE = 40 # pixels around the calibrated offset between pages
+
+wait_stats = {'waits': 0, 'seconds': 0.0, 'saved': 0.0}
 
 
 class Gui:
@@ -60,8 +74,17 @@ class Gui:
         if hasattr(options, 'verbose'):
             self.verbose = options.verbose
         self.max_pages = options.max_pages
+        # Worker slots (--slots) have their own home and temp folders
+        self.home = getattr(options, 'home', None) or os.environ.get('HOME')
+        self.tmpdir = getattr(options, 'tmpdir', None)
+        self.shared_host = (getattr(options, 'slots', 0) or 0) > 1
+        self.fixed_wait = getattr(options, 'fixed_wait', False)
+        self.debug = (getattr(options, 'verbose', 0) or 0) >= DEBUG_VERBOSITY
         self.top_skip = 0
         self.bottom_skip = 0
+        self.pages = []
+        self.calibration_key = calibration.calibration_key(
+            self.__class__.__module__, config, self.width, self.height)
 
     def delete_if_exists(self, pattern):
         """
@@ -109,6 +132,142 @@ class Gui:
                 "%s has maxval %d, but only maxval 255 is supported" %
                 (maxval, filename))
 
+    def capture(self, page_number):
+        """
+        Take a screenshot into a frame buffer. If the platform can't
+        capture to memory, read a temporary PPM file instead.
+        """
+        frame = frames.pool.get(self.width, self.height)
+        filename = self.page_filename(page_number)
+        try:
+            if hasattr(self, 'capture_frame'):
+                self.capture_frame(frame)
+                if self.debug:
+                    frame.save_ppm(filename)
+            else:
+                self.screenshot(filename)
+                self.check_screenshot(filename)
+                frame.load_ppm(filename)
+                if not self.debug:
+                    os.unlink(filename)
+        except:
+            frames.pool.put(frame)
+            raise
+        return frame
+
+    def can_settle(self):
+        """Check if waits can end when the screen stops changing."""
+        return not self.fixed_wait and hasattr(self, 'capture_frame')
+
+    def screen_signature(self):
+        """
+        Get row hashes of the current screen, for wait_until_ready.
+        Return None if the screen can't be captured to memory.
+        """
+        if not self.can_settle():
+            return None
+        frame = frames.pool.get(self.width, self.height)
+        try:
+            try:
+                self.capture_frame(frame)
+                return frame.row_hashes()
+            except RuntimeError, error:
+                print error
+                return None
+        finally:
+            frames.pool.put(frame)
+
+    def wait_until_ready(self, timeout, baseline=None):
+        """
+        Wait until the screen has changed from the baseline signature
+        (taken before loading the page) and then stopped changing, but
+        not longer than timeout seconds. Always wait at least a fraction
+        of the timeout, because some pages pause before they load more
+        content. Fall back to a fixed sleep if the screen can't be
+        captured to memory, or with --fixed-wait if pages are still
+        captured too early.
+        """
+        started = time.time()
+        minimum = timeout * SETTLE_MIN_FRACTION
+        if baseline is None and self.can_settle():
+            baseline = []
+        if baseline is None:
+            time.sleep(timeout)
+            return timeout
+        frame = frames.pool.get(self.width, self.height)
+        try:
+            previous = None
+            stable = 1
+            while time.time() - started < timeout:
+                try:
+                    self.capture_frame(frame)
+                except RuntimeError, error:
+                    print error
+                    time.sleep(max(0, timeout - (time.time() - started)))
+                    break
+                signature = frame.row_hashes()
+                if previous is not None and similar(
+                    previous, signature, SETTLE_TOLERANCE):
+                    stable += 1
+                    if (stable >= SETTLE_FRAMES and
+                        time.time() - started >= minimum):
+                        break
+                elif similar(baseline, signature, SETTLE_TOLERANCE):
+                    previous = None # The page hasn't started loading
+                    stable = 1
+                else:
+                    previous = signature # The page is still changing
+                    stable = 1
+                time.sleep(min(SETTLE_INTERVAL,
+                               max(0, timeout - (time.time() - started))))
+        finally:
+            frames.pool.put(frame)
+        seconds = time.time() - started
+        wait_stats['waits'] += 1
+        wait_stats['seconds'] += seconds
+        wait_stats['saved'] += timeout - seconds
+        print "Ready after %.1f of %.1f seconds (saved %.0f in %d waits)." % (
+            seconds, timeout, wait_stats['saved'], wait_stats['waits'])
+        return seconds
+
+    def capture_settled(self, page_number, previous):
+        """
+        Take a screenshot after scrolling, as soon as the screen is
+        different from the previous page and has stopped moving.
+        """
+        if not self.can_settle():
+            time.sleep(SCROLL_FIXED_WAIT)
+            return self.capture(page_number)
+        baseline = previous.row_hashes()
+        started = time.time()
+        frame = frames.pool.get(self.width, self.height)
+        try:
+            last = None
+            while True:
+                self.capture_frame(frame)
+                signature = frame.row_hashes()
+                if (last is not None and
+                    similar(last, signature, SETTLE_TOLERANCE) and
+                    not similar(baseline, signature, SETTLE_TOLERANCE)):
+                    break
+                if time.time() - started > SCROLL_TIMEOUT:
+                    break
+                last = signature
+                time.sleep(SCROLL_INTERVAL)
+            if self.debug:
+                frame.save_ppm(self.page_filename(page_number))
+        except:
+            frames.pool.put(frame)
+            raise
+        self.scroll_seconds += time.time() - started
+        return frame
+
+    def release_pages(self):
+        """Return all page frames to the pool."""
+        for frame in self.pages:
+            frames.pool.put(frame)
+        self.pages = []
+
     def reset_browser(self):
         """Delete cache, history, cookies, previous sessions..."""
         raise NotImplementedError(
@@ -125,7 +284,10 @@ class Gui:
             "%s.scroll_bottom() is not implemented" % self.__class__)
 
     def screenshot(self, filename):
-        """Take a screenshot and save it to a PPM file."""
+        """
+        Take a screenshot and save it to a PPM file. Platforms that
+        can capture to memory implement capture_frame(frame) instead.
+        """
         raise NotImplementedError(
             "%s.screenshot(filename) is not implemented" % self.__class__)
 
@@ -134,36 +296,54 @@ class Gui:
         Take screenshots and scroll down between them.
         """
         good_offset = height / 2 - 40 # Constant browser chrome
-        filename = self.page_filename(1)
-        pixels_per_line = 100
-        scroll_lines = max(1, good_offset / pixels_per_line)
+        known = calibration.cache.get(self.calibration_key)
+        pixels_per_line, steps, expected = known or (100, 1, 0)
+        scroll_lines = max(1, min(good_offset / pixels_per_line, 40))
+        if known and not hasattr(self, 'scroll_down'):
+            expected = scroll_lines * pixels_per_line
+        if known and self.verbose:
+            print "Calibrated: %d pixels/keypress, %d steps/page" % (
+                pixels_per_line, steps)
+        learned = None
         offsets = []
         top_pages = self.max_pages
         if top_pages > 2:
             top_pages -= 1 # enable jump to last page
         for page in range(2, top_pages + 1):
-            previous = filename
-            filename = self.page_filename(page)
+            previous = self.pages[-1]
             attempts = 1
             if hasattr(self, 'scroll_attempts'):
                 attempts = self.scroll_attempts
+            window = None
+            if expected:
+                window = (expected - OFFSET_TOLERANCE,
+                          expected + OFFSET_TOLERANCE)
+            presses = 0
             for attempt in range(attempts):
                 if hasattr(self, 'scroll_down'):
-                    self.scroll_down(good_offset)
+                    for dummy in range(attempt and 1 or steps):
+                        self.scroll_down(good_offset)
+                        presses += 1
                 else:
                     for dummy in range(scroll_lines):
                         self.down()
-                time.sleep(0.5)
-                self.screenshot(filename)
-                self.check_screenshot(filename)
-                offset = hashmatch.find_offset(previous, filename)
+                frame = self.capture_settled(page, previous)
+                offset = hashmatch.find_frame_offset(previous, frame, window)
                 if offset:
                     break
                 if attempt + 1 < attempts:
-                    os.rename(filename, previous)
+                    # Replace the previous page with the new capture
+                    self.pages[-1] = frame
+                    frames.pool.put(previous)
+                    previous = frame
+            self.pages.append(frame)
             if not offset:
                 break
             offsets.append(offset)
+            if learned:
+                # This page scrolled too, so the previous page wasn't
+                # cut short at the bottom, and its scroll step is good.
+                calibration.cache.put(self.calibration_key, *learned)
 
             apparently = offset / scroll_lines
             if apparently == 0:
@@ -176,17 +356,23 @@ class Gui:
                 if self.verbose:
                     print "%d pixels/keypress, %d keypresses/scroll" % (
                         pixels_per_line, scroll_lines)
+            if hasattr(self, 'scroll_down'):
+                steps = presses
+                expected = 0
+                if not attempt:
+                    expected = offset # all presses between two captures
+            elif apparently:
+                expected = scroll_lines * pixels_per_line
+            learned = (pixels_per_line, steps, expected)
         else:
             if top_pages == self.max_pages:
                 return offsets
             self.scroll_bottom()
-            time.sleep(0.5)
-            previous2 = previous
-            previous = filename
-            filename = self.page_filename(self.max_pages)
-            self.screenshot(filename)
-            self.check_screenshot(filename)
-            offset = hashmatch.find_offset(previous, filename)
+            previous2 = self.pages[-2]
+            previous = self.pages[-1]
+            frame = self.capture_settled(self.max_pages, previous)
+            self.pages.append(frame)
+            offset = hashmatch.find_frame_offset(previous, frame)
             if offset:
                 # Need enough overlap to avoid browser chrome between pages.
                 offset = min(offset, height - 200)
@@ -194,7 +380,7 @@ class Gui:
                 offsets.append(offset)
             else:
                 # Check that it's not the same bottom page as before.
-                if not hashmatch.find_offset(previous2, filename):
+                if not hashmatch.find_frame_offset(previous2, frame):
                     # Bottom page, just tack it on.
                     offsets.append(height - 200)
         return offsets
@@ -207,7 +393,6 @@ class Gui:
         # print "offsets: ", offsets
         # print "overlaps:", overlaps
         total = 0
-        row_bytes = 3 * self.width
         for index in range(0, len(overlaps) + 1):
             top = 0
             bottom = 0
@@ -222,40 +407,53 @@ class Gui:
             bottom = self.height - bottom
             segment = bottom - top
             total += segment
-            filename = self.page_filename(index+1)
-            print filename, top, bottom, segment, total
-            infile = open(filename, 'rb')
-            hashmatch.read_ppm_header(infile)
-            infile.seek(top*row_bytes, 1)
-            for dummy in range(top, bottom):
-                scanline = array('B')
-                scanline.fromfile(infile, row_bytes)
-                yield scanline
-            infile.close()
+            frame = self.pages[index]
+            print self.page_filename(index+1), top, bottom, segment, total
+            for y in range(top, bottom):
+                yield frame.scanline(y)
 
     def browsershot(self, pngfilename = 'browsershot.png'):
         """
         Take a number of screenshots and merge them into one tall image.
         """
+        self.save_png(pngfilename, self.capture_pages())
+
+    def capture_pages(self):
+        """
+        Take a number of screenshots and return the offsets between
+        them. The pages stay in memory until save_png, so the browser
+        is free for the next request while the image is encoded.
+        """
         if hasattr(self, 'focus_browser'):
             self.focus_browser()
-        # Screenshot of the first page.
-        filename = self.page_filename(1)
-        self.screenshot(filename)
-        self.check_screenshot(filename)
-        # Scroll down and take more screenshots.
-        offsets = self.scroll_pages(self.height)
-        total = self.height + sum(offsets) - self.top_skip - self.bottom_skip
-        # Create PNG file.
-        outfile = file(pngfilename, 'wb')
-        writer = png.Writer(self.width, total)
-        writer.write(outfile, self.scanlines(offsets))
-        outfile.close()
-        # Delete all page screenshots.
-        for page in range(1, len(offsets) + 3):
-            filename = self.page_filename(page)
-            if os.path.exists(filename):
-                os.unlink(filename)
+        try:
+            # Screenshot of the first page.
+            self.pages = [self.capture(1)]
+            # Scroll down and take more screenshots.
+            self.scroll_seconds = 0.0
+            offsets = self.scroll_pages(self.height)
+        except:
+            self.release_pages()
+            raise
+        if self.can_settle() and len(self.pages) > 1:
+            print "Scrolled %d pages in %.1f seconds (fixed waits: %.1f)." % (
+                len(self.pages) - 1, self.scroll_seconds,
+                SCROLL_FIXED_WAIT * (len(self.pages) - 1))
+        return offsets
+
+    def save_png(self, pngfilename, offsets):
+        """
+        Merge the captured pages into one tall PNG file.
+        """
+        try:
+            total = (self.height + sum(offsets)
+                     - self.top_skip - self.bottom_skip)
+            outfile = file(pngfilename, 'wb')
+            writer = png.Writer(self.width, total, workers=PNG_WORKERS)
+            writer.write(outfile, self.scanlines(offsets))
+            outfile.close()
+        finally:
+            self.release_pages()
 
 
 def overlap_top(overlap):
@@ -0,0 +1,133 @@
+# browsershots.org - Test your web design in different browsers
+# Copyright (C) 2007 Johann C. Rocholl <johann@browsershots.org>
+#
+# Browsershots is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Browsershots is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Remember how far each browser scrolls per keypress.
+
+Gui.scroll_pages learns the pixels per keypress from the offset
+between pages. The results are saved in a small text file in the
+factory's working folder, one line per browser module, version and
+screen size, so that the next screenshot can scroll the right amount
+and expect the right offset from the first page on.
+"""
+
+__revision__ = "$Rev$"
+__date__ = "$Date$"
+__author__ = "$Author$"
+
+import os
+import threading
+
+CALIBRATION_FILENAME = 'scroll-calibration.txt'
+
+
+class CalibrationCache:
+    """
+    Learned scroll steps, shared by all worker slots.
+
+    Each entry is a tuple (pixels_per_line, steps, offset): pixels
+    per down keypress, scroll actions per page, and the resulting
+    offset between pages in pixels (0 if unknown).
+    """
+
+    def __init__(self, filename=CALIBRATION_FILENAME):
+        self.filename = filename
+        self.entries = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Read saved entries, ignore lines that can't be parsed."""
+        self.entries = {}
+        if not os.path.exists(self.filename):
+            return
+        for line in open(self.filename):
+            parts = line.split()
+            if len(parts) != 4:
+                continue
+            try:
+                values = tuple([int(part) for part in parts[1:]])
+            except ValueError:
+                continue
+            if min(values[:2]) > 0 and values[2] >= 0:
+                self.entries[parts[0]] = values
+
+    def save(self):
+        """Write all entries to a temp file, then replace the old file."""
+        temp = self.filename + '.tmp'
+        outfile = open(temp, 'w')
+        keys = self.entries.keys()
+        keys.sort()
+        for key in keys:
+            outfile.write('%s %d %d %d\n' % ((key, ) + self.entries[key]))
+        outfile.close()
+        if os.name == 'nt' and os.path.exists(self.filename):
+            os.remove(self.filename) # rename doesn't replace on Windows
+        os.rename(temp, self.filename)
+
+    def get(self, key):
+        """Get the entry for a browser and screen size, or None."""
+        self.lock.acquire()
+        try:
+            if self.entries is None:
+                self.load()
+            return self.entries.get(key)
+        finally:
+            self.lock.release()
+
+    def put(self, key, pixels_per_line, steps, offset):
+        """Save a confirmed entry, if it has changed."""
+        values = (pixels_per_line, steps, offset)
+        if min(values[:2]) <= 0 or offset < 0:
+            return
+        self.lock.acquire()
+        try:
+            if self.entries is None:
+                self.load()
+            if self.entries.get(key) == values:
+                return
+            self.entries[key] = values
+            try:
+                self.save()
+            except (IOError, OSError), error:
+                print "Could not save scroll calibration:", error
+        finally:
+            self.lock.release()
+
+
+def calibration_key(module_name, config, width, height):
+    """
+    Make a cache key without spaces.
+
+    >>> calibration_key('shotfactory04.gui.linux.firefox',
+    ...     {'version': '3.0 beta 5', 'major': 3, 'minor': 0}, 1024, 768)
+    'linux.firefox-3.0_beta_5-1024x768'
+    >>> calibration_key('shotfactory04.gui.linux.opera',
+    ...     {'major': 9, 'minor': 5}, 800, 600)
+    'linux.opera-9.5-800x600'
+    """
+    module_name = '.'.join(module_name.split('.')[-2:])
+    version = config.get('version') or '%s.%s' % (
+        config.get('major'), config.get('minor'))
+    return '%s-%s-%dx%d' % (
+        module_name, '_'.join(str(version).split()), width, height)
+
+
+cache = CalibrationCache()
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -79,7 +79,7 @@ class Gui(base.Gui):
                 retry -= 1
             if not retry:
                 raise RuntimeError("AppleScript for Camino failed")
-        time.sleep(options.wait)
+        self.wait_until_ready(options.wait)
         return True
 
     def down(self):
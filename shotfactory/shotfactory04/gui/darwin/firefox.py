@@ -78,7 +78,7 @@ class Gui(base.Gui):
                 retry -= 1
             if not retry:
                 raise RuntimeError("AppleScript for Firefox failed")
-        time.sleep(options.wait)
+        self.wait_until_ready(options.wait)
         return True
 
     def down(self):
@@ -26,6 +26,7 @@ __author__ = "$Author$"
 import os
 import time
 from shotfactory04 import gui as base
+from shotfactory04.gui import x11
 
 
 class Gui(base.Gui):
@@ -33,10 +34,17 @@ class Gui(base.Gui):
     Special functions for the X11 screen.
     """
 
+    def __init__(self, config, options):
+        """Open the X11 connection later, after the screen is ready."""
+        base.Gui.__init__(self, config, options)
+        self.x11_connection = None
+        self.x11_failed = x11.xdisplay is None
+
     def prepare_screen(self):
         """
         Start a VNC server with requested resolution.
         """
+        self.close_x11()
         command = ('vncserver %s -geometry %dx%d -depth %d -dpi %d'
                    % (self.display, self.width, self.height,
                       self.bpp, self.dpi))
@@ -55,16 +63,59 @@ class Gui(base.Gui):
             self.force_quit_vnc_server()
             raise RuntimeError("could not start vncserver")
         # Move the mouse cursor out of the way
-        self.shell('xte "mousemove 400 0"')
+        self.xte('mousemove 400 0')
+
+    def connect_x11(self):
+        """
+        Get the persistent connection to my display, or None if
+        python-xlib is not installed or the connection failed.
+        """
+        if self.x11_connection is None and not self.x11_failed:
+            try:
+                self.x11_connection = x11.Connection(self.display)
+            except x11.ERRORS, error:
+                print "X11 connection failed, using xte and xwd:", error
+                self.x11_failed = True
+        return self.x11_connection
+
+    def close_x11(self):
+        """Close the connection to my display, if it's open."""
+        if self.x11_connection is not None:
+            try:
+                self.x11_connection.close()
+            except x11.ERRORS:
+                pass
+        self.x11_connection = None
+        self.x11_failed = x11.xdisplay is None
+
+    def xte(self, *commands):
+        """
+        Send keyboard and mouse events, with the same command syntax
+        as the xte program. Without python-xlib, all commands are run
+        by a single xte process.
+        """
+        connection = self.connect_x11()
+        if connection is not None:
+            try:
+                connection.xte(*commands)
+                return
+            except x11.ERRORS, error:
+                print "X11 input failed, using xte:", error
+                self.close_x11()
+                self.x11_failed = True
+        self.shell('xte %s' % ' '.join(['"%s"' % command
+                                        for command in commands]))
 
     def force_quit_vnc_server(self):
         """
         Try to kill old VNC server on my display.
         """
         print "Trying to kill old VNC server"
+        self.close_x11()
         self.shell('vncserver -kill %s' % self.display)
         time.sleep(3)
-        self.shell('killall -q -9 vncserver')
+        if not self.shared_host:
+            self.shell('killall -q -9 vncserver')
         host, numeric = self.display.rsplit(':', 1)
         numeric = int(numeric)
         self.delete_if_exists('/tmp/.X%d-lock' % numeric)
@@ -73,6 +124,9 @@ class Gui(base.Gui):
     def shell(self, command):
         """Run a shell command on my display."""
         command = 'DISPLAY=%s %s' % (self.display, command)
+        if self.shared_host:
+            command = 'HOME="%s" TMPDIR="%s" %s' % (
+                self.home, self.tmpdir, command)
         if self.verbose < 3:
             if command.endswith('&'):
                 command = command[:-1].rstrip() + ' >/dev/null 2>/dev/null &'
@@ -84,39 +138,35 @@ class Gui(base.Gui):
 
     def scroll_top(self):
         """Scroll to the top."""
-        self.shell('xte "key Home"')
+        self.xte('key Home')
 
     def scroll_bottom(self):
         """Scroll to the bottom."""
-        self.shell('xte "key End"')
+        self.xte('key End')
 
     def pageup(self):
         """Scroll up by one screen page."""
-        self.shell('xte "key Page_Up"')
+        self.xte('key Page_Up')
 
     def pagedown(self):
         """Scroll down by one screen page."""
-        self.shell('xte "key Page_Down"')
+        self.xte('key Page_Down')
 
     def up(self):
         """Scroll up by one line."""
-        self.shell('xte "key Up"')
+        self.xte('key Up')
 
     def down(self):
         """Scroll down by one line."""
-        self.shell('xte "key Down"')
+        self.xte('key Down')
 
     def close_window(self):
         """Close the active window."""
-        self.shell('xte "keydown Alt_L"')
-        self.shell('xte "key F4"')
-        self.shell('xte "keyup Alt_L"')
+        self.xte('keydown Alt_L', 'key F4', 'keyup Alt_L')
 
     def maximize(self):
         """Maximize the active window."""
-        self.shell('xte "keydown Alt_L"')
-        self.shell('xte "key F10"')
-        self.shell('xte "keyup Alt_L"')
+        self.xte('keydown Alt_L', 'key F10', 'keyup Alt_L')
 
     def screenshot(self, filename):
         """
@@ -126,27 +176,58 @@ class Gui(base.Gui):
         if error:
             raise RuntimeError("screenshot failed")
 
+    def capture_frame(self, frame):
+        """
+        Read the full screen into a frame buffer, over the X11
+        connection if possible, otherwise through a pipe from xwd and
+        xwdtopnm instead of a temporary file.
+        """
+        connection = self.connect_x11()
+        if connection is not None and connection.channels is not None:
+            try:
+                connection.capture(frame)
+                return
+            except x11.ERRORS, error:
+                print "X11 capture failed, using xwd:", error
+                self.close_x11()
+                self.x11_failed = True
+        command = 'DISPLAY=%s xwd -root -silent | xwdtopnm 2>/dev/null' % (
+            self.display)
+        if self.verbose >= 3:
+            print command
+        pipe = os.popen(command, 'rb')
+        try:
+            frame.read_ppm(pipe, 'xwd screenshot')
+        finally:
+            error = pipe.close()
+        if error:
+            raise RuntimeError("screenshot failed")
+
     def start_browser(self, config, url, options):
         """
         Start browser and load website.
         """
         command = config['command'] or config['browser'].lower()
         command = '%s "%s" &' % (command, url)
+        baseline = self.screen_signature()
         print "Running", command
         error = self.shell(command)
         if error:
             raise RuntimeError("could not start the browser")
-        print "Sleeping %d seconds while page is loading." % options.wait
-        time.sleep(options.wait - 10)
+        print "Waiting up to %d seconds while page is loading." % options.wait
+        self.wait_until_ready(options.wait - 10, baseline)
         self.maximize()
-        time.sleep(10)
+        self.wait_until_ready(10)
 
     def close(self):
         """
         Shut down the VNC server.
         """
+        self.close_x11()
         self.shell('vncserver -kill %s' % self.display)
         time.sleep(1)
+        if self.shared_host:
+            return # don't kill helpers for the other slots
         self.shell('killall -q -9 nspluginviewer')
         self.shell('killall -q -9 klauncher')
         self.shell('killall -q -9 dcopserver')
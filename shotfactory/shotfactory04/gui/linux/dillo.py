@@ -40,13 +40,10 @@ class Gui(base.Gui):
     def maximize(self):
         """Maximize the active window."""
         self.focus_browser()
-        self.shell('xte "keydown Alt_L"')
-        self.shell('xte "key F10"')
-        self.shell('xte "keyup Alt_L"')
+        self.xte('keydown Alt_L', 'key F10', 'keyup Alt_L')
 
     def focus_browser(self):
         """
         Focus on the browser window.
         """
-        self.shell('xte "mousemove 200 4"')
-        self.shell('xte "mouseclick 1"')
+        self.xte('mousemove 200 4', 'mouseclick 1')
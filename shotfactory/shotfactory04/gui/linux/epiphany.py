@@ -24,7 +24,6 @@ __author__ = "$Author$"
 
 
 import os
-import time
 from shotfactory04.gui import linux as base
 
 
@@ -37,7 +36,7 @@ class Gui(base.Gui):
         """
         Delete browser cache and crash dialog.
         """
-        home = os.environ['HOME']
+        home = self.home
         self.delete_if_exists(os.path.join(
             home, '.gnome2', 'epiphany', 'mozilla', '*', 'Cache'))
         self.delete_if_exists(os.path.join(
@@ -51,12 +50,13 @@ class Gui(base.Gui):
         """
         command = config['command'] or config['browser'].lower()
         command = '%s -n "%s"' % (command, url)
+        baseline = self.screen_signature()
         print "Running", command
         error = self.shell(command)
         if error:
             raise RuntimeError("could not load new URL in the browser")
-        print "Sleeping %d seconds while page is loading." % (
+        print "Waiting up to %d seconds while page is loading." % (
             options.reuse_wait)
-        time.sleep(options.reuse_wait / 2.0)
+        self.wait_until_ready(options.reuse_wait / 2.0, baseline)
         self.maximize()
-        time.sleep(options.reuse_wait / 2.0)
+        self.wait_until_ready(options.reuse_wait / 2.0)
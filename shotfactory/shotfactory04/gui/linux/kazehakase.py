@@ -36,7 +36,7 @@ class Gui(base.Gui):
         """
         Delete browser cache.
         """
-        home = os.environ['HOME']
+        home = self.home
         self.delete_if_exists(os.path.join(
             home, '.kazehakase', 'mozilla', '*', 'Cache'))
         self.delete_if_exists(os.path.join(
@@ -50,7 +50,4 @@ class Gui(base.Gui):
         """
         Focus on the browser window.
         """
-        self.shell('xte "mousemove 200 4"')
-        self.shell('xte "mouseclick 1"')
-        self.shell('xte "key Tab"')
-        self.shell('xte "key Tab"')
+        self.xte('mousemove 200 4', 'mouseclick 1', 'key Tab', 'key Tab')
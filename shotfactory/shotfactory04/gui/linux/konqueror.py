@@ -36,5 +36,5 @@ class Gui(base.Gui):
         """
         Delete browser cache.
         """
-        home = os.environ['HOME']
+        home = self.home
         self.delete_if_exists(os.path.join(home, '.kde', 'cache-*'))
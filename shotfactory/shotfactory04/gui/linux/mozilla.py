@@ -36,7 +36,7 @@ class Gui(base.Gui):
         """
         Delete crash dialog and browser cache.
         """
-        home = os.environ['HOME']
+        home = self.home
         for profile_name in ('default', 'mozilla*'):
             self.delete_if_exists(os.path.join(
                 home, '.mozilla', profile_name, '*', 'Cache'))
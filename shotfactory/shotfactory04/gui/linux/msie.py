@@ -36,7 +36,7 @@ class Gui(base.Gui):
         """
         Delete browser cache.
         """
-        home = os.environ['HOME']
+        home = self.home
         self.delete_if_exists(os.path.join(
             home, '.ies4linux', '*', 'drive_c', 'windows',
             'profiles', '*', '*', 'Temporary Internet Files'))
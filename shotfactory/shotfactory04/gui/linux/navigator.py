@@ -36,7 +36,7 @@ class Gui(base.Gui):
         """
         Delete crash dialog and browser cache.
         """
-        home = os.environ['HOME']
+        home = self.home
         self.delete_if_exists(os.path.join(home, '.netscape', 'cache'))
         self.delete_if_exists(os.path.join(home, '.netscape', 'history.dat'))
         self.delete_if_exists(os.path.join(home, '.netscape', 'cookies'))
@@ -55,12 +55,13 @@ class Gui(base.Gui):
         """
         command = config['command'] or config['browser'].lower()
         command = '%s -remote "OpenURL(%s,new-tab)"' % (command, url)
+        baseline = self.screen_signature()
         print "Running", command
         error = self.shell(command)
         if error:
             raise RuntimeError("could not load new URL in the browser")
-        print "Sleeping %d seconds while page is loading." % (
+        print "Waiting up to %d seconds while page is loading." % (
             options.reuse_wait)
-        time.sleep(options.reuse_wait / 2.0)
+        self.wait_until_ready(options.reuse_wait / 2.0, baseline)
         self.maximize()
-        time.sleep(options.reuse_wait / 2.0)
+        self.wait_until_ready(options.reuse_wait / 2.0)
@@ -24,7 +24,6 @@ __author__ = "$Author$"
 
 
 import os
-import time
 from shotfactory04.gui import linux as base
 from shotfactory04.inifile import IniFile
 
@@ -38,7 +37,7 @@ class Gui(base.Gui):
         """
         Reset crashed state and delete browser cache.
         """
-        home = os.environ['HOME']
+        home = self.home
         self.delete_if_exists(os.path.join(home, '.opera', 'lock'))
         self.delete_if_exists(os.path.join(home, '.opera', 'cache4'))
         self.delete_if_exists(os.path.join(home, '.opera', 'opcache'))
@@ -56,8 +55,7 @@ class Gui(base.Gui):
         """
         Focus on the browser window.
         """
-        self.shell('xte "mousemove 400 4"')
-        self.shell('xte "mouseclick 1"')
+        self.xte('mousemove 400 4', 'mouseclick 1')
 
     def reuse_browser(self, config, url, options):
         """
@@ -65,12 +63,13 @@ class Gui(base.Gui):
         """
         command = config['command'] or config['browser'].lower()
         command = '%s -remote "openURL(%s,new-tab)"' % (command, url)
+        baseline = self.screen_signature()
         print "Running", command
         error = self.shell(command)
         if error:
             raise RuntimeError("could not load new URL in the browser")
-        print "Sleeping %d seconds while page is loading." % (
+        print "Waiting up to %d seconds while page is loading." % (
             options.reuse_wait)
-        time.sleep(options.reuse_wait / 2.0)
+        self.wait_until_ready(options.reuse_wait / 2.0, baseline)
         self.maximize()
-        time.sleep(options.reuse_wait / 2.0)
+        self.wait_until_ready(options.reuse_wait / 2.0)
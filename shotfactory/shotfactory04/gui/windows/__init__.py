@@ -61,13 +61,22 @@ class Gui(base.Gui):
         im.save(outfile, 'PPM')
         outfile.close()
 
+    def capture_frame(self, frame):
+        """Copy the full screen into a frame buffer."""
+        import ImageGrab
+        im = ImageGrab.grab()
+        if im.mode != 'RGB':
+            im = im.convert('RGB')
+        frame.fromstring(im.size, im.tostring())
+
     def start_browser(self, config, url, options):
         """Start browser and load website."""
         command = config['command']
+        baseline = self.screen_signature()
         print 'running', command
         os.spawnl(os.P_DETACH, command, os.path.basename(command), url)
-        print "Sleeping %d seconds while page is loading." % options.wait
-        time.sleep(options.wait)
+        print "Waiting up to %d seconds while page is loading." % options.wait
+        self.wait_until_ready(options.wait, baseline)
 
     def close(self):
         """Close the browser."""
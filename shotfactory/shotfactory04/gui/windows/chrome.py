@@ -23,7 +23,6 @@ __date__ = "$Date$"
 __author__ = "$Author$"
 
 import os
-import time
 import win32gui
 import win32con
 from win32com.shell import shellcon
@@ -52,6 +51,7 @@ class Gui(windows.Gui):
         if not command:
             appdata = shell.SHGetFolderPath(0, shellcon.CSIDL_LOCAL_APPDATA, 0, 0)
             command = appdata + '\Google\Chrome\Application\chrome.exe'
+        baseline = self.screen_signature()
         print 'running', command
         try:
             import subprocess
@@ -59,10 +59,10 @@ class Gui(windows.Gui):
             os.spawnl(os.P_DETACH, command, os.path.basename(command), url)
         else:
             subprocess.Popen([command, url])
-        print "Sleeping %d seconds while page is loading." % options.wait
-        time.sleep(options.wait - 10)
+        print "Waiting up to %d seconds while page is loading." % options.wait
+        self.wait_until_ready(options.wait - 10, baseline)
         self.maximize()
-        time.sleep(10)
+        self.wait_until_ready(10)
 
     def maximize(self):
         """Maximize the browser window."""
@@ -53,6 +53,7 @@ class Gui(windows.Gui):
         Start browser and load website.
         """
         command = config['command'] or r'c:\progra~1\k-meleon\k-meleon.exe'
+        baseline = self.screen_signature()
         print 'running', command
         try:
             import subprocess
@@ -60,8 +61,8 @@ class Gui(windows.Gui):
             os.spawnl(os.P_DETACH, command, os.path.basename(command), url)
         else:
             subprocess.Popen([command, url])
-        print "Sleeping %d seconds while page is loading." % options.wait
-        time.sleep(options.wait)
+        print "Waiting up to %d seconds while page is loading." % options.wait
+        self.wait_until_ready(options.wait, baseline)
 
     def find_scrollable(self):
         """
@@ -78,6 +78,7 @@ class Gui(windows.Gui):
         """
         self.check_version_override(config['major'], config['minor'])
         command = config['command'] or r'c:\progra~1\intern~1\iexplore.exe'
+        baseline = self.screen_signature()
         print 'running', command
         try:
             import subprocess
@@ -85,8 +86,8 @@ class Gui(windows.Gui):
             os.spawnl(os.P_DETACH, command, os.path.basename(command), url)
         else:
             subprocess.Popen([command, url])
-        print "Sleeping %d seconds while page is loading." % options.wait
-        time.sleep(options.wait)
+        print "Waiting up to %d seconds while page is loading." % options.wait
+        self.wait_until_ready(options.wait, baseline)
 
     def find_scrollable(self):
         """
@@ -0,0 +1,173 @@
+# browsershots.org - Test your web design in different browsers
+# Copyright (C) 2007 Johann C. Rocholl <johann@browsershots.org>
+#
+# Browsershots is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Browsershots is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Screen capture and keyboard / mouse input for X11 over one persistent
+connection, with python-xlib and the XTEST extension. This replaces a
+pipe from xwd for every page and an xte process for every keypress.
+"""
+
+__revision__ = "$Rev$"
+__date__ = "$Date$"
+__author__ = "$Author$"
+
+import socket
+from array import array
+
+try:
+    from Xlib import X, XK, error as xerror
+    from Xlib import display as xdisplay
+    from Xlib.ext import xtest
+    ERRORS = (xerror.DisplayError, xerror.ConnectionClosedError,
+              xerror.XError, socket.error, RuntimeError)
+except ImportError:
+    xdisplay = None
+    ERRORS = (RuntimeError, )
+
+# Byte index of color channels in 32-bit little-endian pixels
+CHANNEL_MASKS = {0xff: 0, 0xff00: 1, 0xff0000: 2}
+MOUSE_BUTTONS = (1, 2, 3, 4, 5)
+
+
+class Connection:
+    """
+    Persistent connection to an X11 display.
+    """
+
+    def __init__(self, name):
+        if xdisplay is None:
+            raise RuntimeError("python-xlib is not installed")
+        self.name = name
+        self.display = xdisplay.Display(name)
+        if not self.display.has_extension('XTEST'):
+            self.display.close()
+            raise RuntimeError("display %s has no XTEST extension" % name)
+        self.screen = self.display.screen()
+        self.root = self.screen.root
+        self.channels = self.pixel_channels()
+        self.keycodes = {}
+
+    def close(self):
+        """Close the connection."""
+        self.display.close()
+
+    def pixel_channels(self):
+        """
+        Get the byte index of red, green and blue in each pixel, or
+        None if the screen doesn't have 32 bits per pixel.
+        """
+        depth = self.screen.root_depth
+        bits = [pixmap_format.bits_per_pixel
+                for pixmap_format in self.display.display.info.pixmap_formats
+                if pixmap_format.depth == depth]
+        if bits != [32]:
+            return None
+        for allowed in self.screen.allowed_depths:
+            for visual in allowed.visuals:
+                if visual.visual_id == self.screen.root_visual:
+                    return channel_indexes(
+                        (visual.red_mask, visual.green_mask, visual.blue_mask),
+                        self.display.display.info.image_byte_order)
+        return None
+
+    def capture(self, frame):
+        """
+        Copy the full screen into a frame buffer.
+        """
+        if self.channels is None:
+            raise RuntimeError("display %s has an unsupported pixel format"
+                               % self.name)
+        frame.check_size('display %s' % self.name,
+                         self.screen.width_in_pixels,
+                         self.screen.height_in_pixels)
+        image = self.root.get_image(0, 0, frame.width, frame.height,
+                                    X.ZPixmap, 0xffffffff)
+        data = array('B', image.data)
+        if len(data) != 4 * frame.width * frame.height:
+            raise RuntimeError("display %s sent %d bytes, expected %d" %
+                               (self.name, len(data),
+                                4 * frame.width * frame.height))
+        red, green, blue = self.channels
+        pixels = frame.pixels
+        pixels[0::3] = data[red::4]
+        pixels[1::3] = data[green::4]
+        pixels[2::3] = data[blue::4]
+
+    def keycode(self, name):
+        """Get the keycode for a key name like Page_Down."""
+        if name not in self.keycodes:
+            keysym = XK.string_to_keysym(name)
+            keycode = keysym and self.display.keysym_to_keycode(keysym)
+            if not keycode:
+                raise RuntimeError("no key %s on display %s" %
+                                   (name, self.name))
+            self.keycodes[name] = keycode
+        return self.keycodes[name]
+
+    def xte(self, *commands):
+        """
+        Run commands with the same syntax as the xte program, e.g.
+        'key Page_Down', 'keydown Alt_L', 'mousemove 400 0' or
+        'mouseclick 1'.
+        """
+        for command in commands:
+            parts = command.split()
+            action = parts[0]
+            if action in ('key', 'keydown', 'keyup') and len(parts) == 2:
+                keycode = self.keycode(parts[1])
+                if action != 'keyup':
+                    xtest.fake_input(self.display, X.KeyPress, keycode)
+                if action != 'keydown':
+                    xtest.fake_input(self.display, X.KeyRelease, keycode)
+            elif action == 'mousemove' and len(parts) == 3:
+                xtest.fake_input(self.display, X.MotionNotify,
+                                 x=int(parts[1]), y=int(parts[2]))
+            elif (action in ('mouseclick', 'mousedown', 'mouseup') and
+                  len(parts) == 2 and int(parts[1]) in MOUSE_BUTTONS):
+                button = int(parts[1])
+                if action != 'mouseup':
+                    xtest.fake_input(self.display, X.ButtonPress, button)
+                if action != 'mousedown':
+                    xtest.fake_input(self.display, X.ButtonRelease, button)
+            else:
+                raise ValueError("unsupported xte command '%s'" % command)
+        self.display.sync()
+
+
+def channel_indexes(masks, byte_order):
+    """
+    Get the byte index of each color channel in 32-bit pixels.
+
+    >>> channel_indexes((0xff0000, 0xff00, 0xff), 0)
+    (2, 1, 0)
+    >>> channel_indexes((0xff0000, 0xff00, 0xff), 1)
+    (1, 2, 3)
+    >>> channel_indexes((0xf800, 0x7e0, 0x1f), 0)
+    """
+    indexes = []
+    for mask in masks:
+        if mask not in CHANNEL_MASKS:
+            return None
+        index = CHANNEL_MASKS[mask]
+        if byte_order == 1: # MSBFirst
+            index = 3 - index
+        indexes.append(index)
+    return tuple(indexes)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
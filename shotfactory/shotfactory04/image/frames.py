@@ -0,0 +1,178 @@
+# browsershots.org - Test your web design in different browsers
+# Copyright (C) 2007 Johann C. Rocholl <johann@browsershots.org>
+#
+# Browsershots is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Browsershots is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+In-memory frame buffers for screen captures.
+
+Each captured page is kept as 24-bit RGB pixels in a Frame, so that
+overlap matching and the PNG writer don't need to read PPM files.
+Frames are recycled through a small pool, because every screenshot
+request needs several frames of the same size. The pool is shared
+with the background encoder in pipelined mode, so it has a lock.
+"""
+
+__revision__ = "$Rev$"
+__date__ = "$Date$"
+__author__ = "$Author$"
+
+import threading
+from array import array
+from shotfactory04.image import hashmatch
+
+POOL_SIZE = 8 # idle frames kept for the next screenshot
+ROW_SKIP = 8 # sample every 8th scanline for row_hashes
+
+
+class Frame:
+    """
+    Pixel buffer for one screen capture.
+    """
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.row_bytes = 3 * width
+        self.pixels = array('B', [0]) * (self.row_bytes * height)
+
+    def check_size(self, name, width, height):
+        """Make sure the capture has the expected size."""
+        if width != self.width or height != self.height:
+            raise RuntimeError(
+                "%s has %dx%d pixels, not the requested size %dx%d" %
+                (name, width, height, self.width, self.height))
+
+    def read_ppm(self, infile, name='screenshot'):
+        """
+        Read a PPM image from a file or pipe into this frame.
+        """
+        magic, width, height, maxval = hashmatch.read_ppm_header(infile)
+        if magic != 'P6':
+            raise RuntimeError("%s isn't a PPM file with 24 bpp" % name)
+        if maxval != 255:
+            raise RuntimeError(
+                "%s has maxval %d, but only maxval 255 is supported" %
+                (name, maxval))
+        self.check_size(name, width, height)
+        bytes = infile.readinto(self.pixels)
+        if bytes < len(self.pixels):
+            raise RuntimeError("%s has only %d of %d bytes" %
+                               (name, bytes, len(self.pixels)))
+
+    def load_ppm(self, filename):
+        """Read a PPM file into this frame."""
+        infile = open(filename, 'rb')
+        try:
+            self.read_ppm(infile, filename)
+        finally:
+            infile.close()
+
+    def fromstring(self, size, data, name='screenshot'):
+        """Copy RGB pixel data (e.g. from PIL) into this frame."""
+        width, height = size
+        self.check_size(name, width, height)
+        if len(data) != len(self.pixels):
+            raise RuntimeError("%s has %d bytes, expected %d" %
+                               (name, len(data), len(self.pixels)))
+        self.pixels = array('B', data)
+
+    def save_ppm(self, filename):
+        """Write this frame to a PPM file, for debugging."""
+        outfile = open(filename, 'wb')
+        outfile.write('P6\n%d %d\n255\n' % (self.width, self.height))
+        self.pixels.tofile(outfile)
+        outfile.close()
+
+    def scanline(self, y):
+        """Get one row of RGB pixels."""
+        start = y * self.row_bytes
+        return self.pixels[start:start + self.row_bytes]
+
+    def row_hashes(self, row_skip=ROW_SKIP):
+        """
+        Hash every few scanlines, as a cheap low-resolution
+        signature for checking if the screen is still changing.
+        """
+        data = self.pixels.tostring()
+        return [hash(data[start:start + self.row_bytes])
+                for start in range(0, len(data), row_skip * self.row_bytes)]
+
+
+class FramePool:
+    """
+    Recycle frame buffers of the same size.
+
+    >>> pool = FramePool(1)
+    >>> frame = pool.get(4, 3)
+    >>> len(frame.pixels)
+    36
+    >>> pool.put(frame)
+    >>> pool.get(4, 3) is frame
+    True
+    >>> pool.get(4, 3) is frame
+    False
+    """
+
+    def __init__(self, size=POOL_SIZE):
+        self.size = size
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def get(self, width, height):
+        """Get a frame buffer, recycled if possible."""
+        self.lock.acquire()
+        try:
+            for index, frame in enumerate(self.idle):
+                if frame.width == width and frame.height == height:
+                    return self.idle.pop(index)
+        finally:
+            self.lock.release()
+        return Frame(width, height)
+
+    def put(self, frame):
+        """Return a frame buffer to the pool when it's no longer used."""
+        self.lock.acquire()
+        try:
+            if len(self.idle) < self.size:
+                self.idle.append(frame)
+        finally:
+            self.lock.release()
+
+
+def similar(hashes1, hashes2, tolerance):
+    """
+    Check if two lists of row hashes are the same, except for at most
+    a fraction of rows (e.g. a blinking text cursor).
+
+    >>> similar([1, 2, 3, 4], [1, 2, 3, 5], 0.25)
+    True
+    >>> similar([1, 2, 3, 4], [1, 2, 0, 5], 0.25)
+    False
+    """
+    if len(hashes1) != len(hashes2):
+        return False
+    changed = 0
+    for index in range(len(hashes1)):
+        if hashes1[index] != hashes2[index]:
+            changed += 1
+    return changed <= tolerance * len(hashes1)
+
+
+pool = FramePool()
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
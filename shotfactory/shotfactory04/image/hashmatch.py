@@ -16,6 +16,14 @@
 
 """
 Efficient overlap matching for tall screenshots.
+
+If NumPy is installed, find_offset hashes all column strips of both
+frames at once and counts the votes with array operations. Otherwise
+it falls back to the pure Python version with dicts of markers.
+
+If the scroll distance is known in advance, find_band_offset matches
+only a narrow band of rows, and the full search is needed only if
+the votes in the band are ambiguous.
 """
 
 __revision__ = "$Rev$"
@@ -24,7 +32,18 @@ __author__ = "$Author$"
 
 import re
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 STEP = 3*64
+HASH_ROWS = 256 # rows per block in slice_hashes, to limit memory use
+BAND_ROWS = 96 # rows of the second frame for find_band_offset
+MIN_BAND_ROWS = 16 # smaller overlap bands need a full search
+AMBIGUOUS_RATIO = 0.5 # runner-up votes relative to the winner
+CHECK_ROWS = 32 # sample rows to confirm the overlap of a band match
+CHECK_RATIO = 0.75 # fraction of sample rows that must be the same
 header_match = re.compile(r'(P\d) (\d+) (\d+) (\d+)').match
 
 
@@ -35,6 +54,8 @@ def read_ppm_header(infile):
     header = []
     while True:
         line = infile.readline()
+        if not line:
+            raise SyntaxError("unexpected end of PPM header")
         sharp = line.find('#')
         if sharp > -1:
             line = line[:sharp]
@@ -110,10 +131,11 @@ def match_markers(pixels, start, height, row_skip, positions, votes):
             votes[offset] = votes_get(offset, 0) + 1
 
 
-def winner(votes, minimum):
+def winner(votes, minimum, window=None):
     """
     Get the offset with the most votes, but 0 only if no other option exists.
     All entries with less than minimum votes will be ignored.
+    If window is (low, high), offsets in that range are preferred.
     >>> winner({0:0, 1:1, 2:2, 3:3}, 1)
     3
     >>> winner({0:100, 1:1, 2:2, 3:3}, 1)
@@ -124,7 +146,18 @@ def winner(votes, minimum):
     0
     >>> winner({}, 1)
     0
+    >>> winner({10:5, 50:4}, 1, (40, 60))
+    50
+    >>> winner({10:5, 70:4}, 1, (40, 60))
+    10
     """
+    if window is not None:
+        low, high = window
+        result = winner(dict([(offset, count)
+                              for offset, count in votes.items()
+                              if low <= offset <= high]), minimum)
+        if result:
+            return result
     maximum = minimum - 1
     result = 0
     for offset, count in votes.items():
@@ -134,34 +167,245 @@ def winner(votes, minimum):
     return result
 
 
+def read_ppm(filename):
+    """
+    Read a PPM file and return width, height and pixel data.
+    """
+    infile = open(filename, 'rb')
+    magic, width, height, maxval = read_ppm_header(infile)
+    assert magic == 'P6'
+    assert maxval == 255
+    pixels = infile.read()
+    infile.close()
+    return width, height, pixels
+
+
 def find_offset(filename1, filename2):
     """
     Find the best vertical match between two PPM files.
     Return the offset in pixels.
     """
-    infile1 = open(filename1, 'rb')
-    infile2 = open(filename2, 'rb')
-    header1 = read_ppm_header(infile1)
-    header2 = read_ppm_header(infile2)
-    assert header1[0] == header2[0] == 'P6'
-    assert header1[3] == header2[3] == 255
-    assert header1[1] == header2[1]
-    width = header1[1]
-    height1 = header1[2]
-    height2 = header2[2]
-
-    pixels1 = infile1.read()
-    pixels2 = infile2.read()
-    # print width*height1*3, len(pixels1), width*height2*3, len(pixels2)
+    width1, height1, pixels1 = read_ppm(filename1)
+    width2, height2, pixels2 = read_ppm(filename2)
+    assert width1 == width2
+    if numpy is None:
+        return find_offset_python(width1, height1, pixels1, height2, pixels2)
+    else:
+        return find_offset_numpy(width1, height1, pixels1, height2, pixels2)
+
+
+def find_frame_offset(frame1, frame2, window=None):
+    """
+    Find the best vertical match between two in-memory frames.
+    Return the offset in pixels. The optional window (low, high) is
+    the range of expected offsets, e.g. from scroll calibration.
+    """
+    assert frame1.width == frame2.width
+    if window is not None:
+        offset = find_band_offset(frame1.width,
+            frame1.height, frame1.pixels, frame2.height, frame2.pixels,
+            window)
+        if offset:
+            return offset
+    if numpy is None:
+        return find_offset_python(frame1.width,
+            frame1.height, frame1.pixels.tostring(),
+            frame2.height, frame2.pixels.tostring(), window)
+    else:
+        return find_offset_numpy(frame1.width,
+            frame1.height, frame1.pixels, frame2.height, frame2.pixels,
+            window)
+
+
+def find_band_offset(width, height1, pixels1, height2, pixels2, window,
+                     band_rows=BAND_ROWS):
+    """
+    Match a band of rows from the second frame only against the rows
+    of the first frame where it must appear if the offset is within
+    window (low, high). Return 0 if there aren't enough votes, if
+    the winner isn't clear, or if the rest of the overlap doesn't
+    match, e.g. on repetitive pages. Then a full search is needed.
+    """
+    low, high = window
+    low = max(low, 1)
+    row_skip = 3*width
+    # Rows of the second frame that are visible in the first frame
+    # for all offsets in the window, take a band from the middle
+    visible = min(height1 - high, height2)
+    if low > high or visible < MIN_BAND_ROWS:
+        return 0
+    start = max(0, (visible - band_rows) // 2)
+    stop = min(visible, start + band_rows)
+    top = start + low - 1
+    bottom = min(height1, stop + high + 1)
+    band1 = pixels1[top*row_skip:bottom*row_skip]
+    band2 = pixels2[start*row_skip:stop*row_skip]
+    if numpy is None:
+        if not isinstance(band1, str):
+            band1 = band1.tostring()
+            band2 = band2.tostring()
+        votes = votes_python(width, bottom - top, band1, stop - start, band2)
+    else:
+        votes = votes_numpy(width, bottom - top, band1, stop - start, band2)
+    counts = []
+    for offset, count in votes.items():
+        offset += top - start
+        if low <= offset <= high:
+            counts.append((count, offset))
+    counts.sort()
+    counts.reverse()
+    if not counts or counts[0][0] < 3*width/STEP:
+        return 0
+    if len(counts) > 1 and counts[1][0] > AMBIGUOUS_RATIO * counts[0][0]:
+        return 0
+    offset = counts[0][1]
+    if not check_overlap(width, height1, pixels1, height2, pixels2, offset):
+        return 0
+    return offset
+
 
+def check_overlap(width, height1, pixels1, height2, pixels2, offset):
+    """
+    Compare sample rows across the whole overlap at this offset.
+
+    >>> pixels = ''.join([chr(y) * 6 for y in range(100)])
+    >>> check_overlap(2, 60, pixels[:360], 60, pixels[240:600], 40)
+    True
+    >>> check_overlap(2, 60, pixels[:360], 60, pixels[240:600], 41)
+    False
+    """
+    row_skip = 3*width
+    rows = min(height1 - offset, height2)
+    if rows <= 0:
+        return False
+    samples = min(rows, CHECK_ROWS)
+    same = 0
+    for index in range(samples):
+        y = index * rows // samples
+        start1 = (y + offset) * row_skip
+        start2 = y * row_skip
+        if (pixels1[start1:start1 + row_skip] ==
+            pixels2[start2:start2 + row_skip]):
+            same += 1
+    return same >= CHECK_RATIO * samples
+
+
+def votes_python(width, height1, pixels1, height2, pixels2):
+    """
+    Collect votes for each offset with dicts of markers.
+    """
     row_skip = 3*width
     votes = {}
     for start in range(0, row_skip, STEP):
         positions = build_hash(pixels1, start, height1, row_skip)
         match_markers(pixels2, start, height2, row_skip, positions, votes)
+    return votes
+
+
+def find_offset_python(width, height1, pixels1, height2, pixels2,
+                       window=None):
+    """
+    Find the best vertical match with dicts of markers.
+    """
+    votes = votes_python(width, height1, pixels1, height2, pixels2)
     # debug_values(votes, minimum = 1)
-    return winner(votes, 3*width/STEP)
+    return winner(votes, 3*width/STEP, window)
+
+
+if numpy is not None:
+    _random = numpy.random.RandomState(STEP)
+    # Random odd multipliers for the slice hash, one per 64-bit word
+    HASH_FACTORS = numpy.frombuffer(_random.bytes(STEP), numpy.uint64) | 1
+    PAIR_FACTOR, SHORT_FACTOR = \
+        numpy.frombuffer(_random.bytes(16), numpy.uint64) | 1
+    del _random
+
+
+def slice_hashes(width, height, pixels):
+    """
+    Hash the STEP bytes at the start of each column strip in each
+    row, like the slices in build_hash. Return an array with one row
+    of hashes per pixel row, and one column per strip.
+    """
+    row_skip = 3*width
+    strips = (row_skip + STEP - 1) // STEP
+    size = max(len(pixels), height*row_skip) + STEP
+    data = numpy.zeros(size, numpy.uint8)
+    data[:len(pixels)] = numpy.frombuffer(pixels, numpy.uint8)
+    windows = numpy.lib.stride_tricks.as_strided(data,
+        shape=(height, strips, STEP), strides=(row_skip, STEP, 1))
+    hashes = numpy.empty((height, strips), numpy.uint64)
+    for top in range(0, height, HASH_ROWS):
+        block = numpy.ascontiguousarray(windows[top:top+HASH_ROWS])
+        words = block.view(numpy.uint64)
+        hashes[top:top+HASH_ROWS] = (words * HASH_FACTORS).sum(axis=2)
+    # Slices at the end of the data are shorter, not padded with zeros
+    starts = (numpy.arange(height)[:, numpy.newaxis]*row_skip +
+              numpy.arange(strips)*STEP)
+    missing = numpy.clip(starts + STEP - len(pixels), 0, STEP)
+    hashes += missing.astype(numpy.uint64) * SHORT_FACTOR
+    return hashes
+
 
+def marker_hashes(width, height, pixels):
+    """
+    Hash each pair of slices (previous row and this row), like the
+    markers in build_hash, for rows 1 to height-1.
+    """
+    hashes = slice_hashes(width, height, pixels)
+    return hashes[:-1]*PAIR_FACTOR + hashes[1:]
+
+
+def votes_numpy(width, height1, pixels1, height2, pixels2):
+    """
+    Collect votes for each offset with vectorized marker hashes.
+    The votes are the same as in votes_python, unless two different
+    markers have the same 64-bit hash.
+    """
+    markers1 = marker_hashes(width, height1, pixels1)
+    markers2 = marker_hashes(width, height2, pixels2)
+    rows2 = numpy.arange(1, height2)
+    offsets = []
+    for strip in range(markers1.shape[1]):
+        # Unique markers in the first frame, and their positions
+        column = markers1[:, strip]
+        order = numpy.argsort(column, kind='mergesort')
+        keys = column[order]
+        first = numpy.ones(len(keys), bool)
+        first[1:] = keys[1:] != keys[:-1]
+        last = numpy.ones(len(keys), bool)
+        last[:-1] = first[1:]
+        unique = first & last
+        keys = keys[unique]
+        positions = order[unique] + 1
+        if not len(keys):
+            continue
+        # Look up all markers of the second frame
+        column = markers2[:, strip]
+        found = numpy.searchsorted(keys, column)
+        found[found == len(keys)] = 0
+        matches = keys[found] == column
+        offsets.append(positions[found[matches]] - rows2[matches])
+    if not offsets:
+        return {}
+    offsets = numpy.concatenate(offsets)
+    values, first_index, counts = numpy.unique(offsets,
+        return_index=True, return_counts=True)
+    # Insert in the same order as the dict in votes_python,
+    # so that winner breaks ties the same way
+    votes = {}
+    for index in numpy.argsort(first_index):
+        votes[int(values[index])] = int(counts[index])
+    return votes
+
+
+def find_offset_numpy(width, height1, pixels1, height2, pixels2,
+                      window=None):
+    """
+    Find the best vertical match with vectorized marker hashes.
+    """
+    votes = votes_numpy(width, height1, pixels1, height2, pixels2)
+    return winner(votes, 3*width/STEP, window)
 
 if __name__ == '__main__':
     import doctest
@@ -23,36 +23,86 @@ __date__ = "$Date$"
 __author__ = "$Author$"
 
 import xmlrpclib
+import httplib
 import socket
 import time
+import threading
 from md5 import md5
 from sha import sha
 from shotfactory04.servers import Server
 
+UPLOAD_CHUNK_SIZE = 1024 * 1024 # bytes per screenshots.uploadChunk
+UPLOAD_RETRIES = 3 # attempts per chunk after network errors
+UPLOAD_RETRY_DELAY = 5 # seconds
+NONCE_PREFETCH = 2 # challenges to request along with other calls
+NONCE_LIFETIME = 300 # seconds, the server accepts nonces for 10 minutes
+LONG_POLL_SECONDS = 60 # wait for new requests in requests.longPoll
+SESSION_FAULTS = (401, 408) # session token rejected or expired
 
-class ProxyTransport(xmlrpclib.Transport):
+
+class KeepAliveTransport(xmlrpclib.Transport):
     """
-    Support for HTTP proxy.
+    Send all requests from the same thread over one persistent
+    HTTP/1.1 connection, maybe through an HTTP proxy.
     """
 
-    def __init__(self, proxy):
+    def __init__(self, proxy=None):
         if hasattr(xmlrpclib.Transport, '__init__'):
             xmlrpclib.Transport.__init__(self)
         self.proxy = proxy
+        self.local = threading.local()
 
-    def make_connection(self, host):
-        """Make a connection through the proxy."""
-        self.realhost = host
-        import httplib
-        return httplib.HTTP(self.proxy)
+    def close(self):
+        """Close the persistent connection of this thread."""
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            connection.close()
+        self.local.connection = None
 
-    def send_request(self, connection, handler, request_body):
-        """Send a request through the proxy."""
-        connection.putrequest("POST", 'http://%s%s' % (self.realhost, handler))
+    def request(self, host, handler, request_body, verbose=0):
+        """
+        Send an XML-RPC request and return the unmarshalled response.
+        If the server has closed the idle connection, try again with
+        a new one.
+        """
+        peer = self.proxy or host
+        for attempt in range(2):
+            reused = (getattr(self.local, 'connection', None) is not None
+                      and self.local.peer == peer)
+            if not reused:
+                self.close()
+                self.local.connection = httplib.HTTPConnection(peer)
+                self.local.peer = peer
+            try:
+                return self.post(host, handler, request_body)
+            except (socket.error, httplib.HTTPException):
+                self.close()
+                if not reused:
+                    raise
 
-    def send_host(self, connection, host):
-        """Send the stored real host as a HTTP header."""
-        connection.putheader('Host', self.realhost)
+    def post(self, host, handler, request_body):
+        """Send one request over the connection of this thread."""
+        url = handler
+        if self.proxy:
+            url = 'http://%s%s' % (host, handler)
+        connection = self.local.connection
+        connection.request('POST', url, request_body, {
+            'Host': host,
+            'User-Agent': self.user_agent,
+            'Content-Type': 'text/xml',
+            'Content-Length': str(len(request_body)),
+            })
+        response = connection.getresponse()
+        data = response.read()
+        if response.will_close:
+            self.close()
+        if response.status != 200:
+            raise xmlrpclib.ProtocolError(host + handler,
+                response.status, response.reason, response.msg)
+        parser, unmarshaller = self.getparser()
+        parser.feed(data)
+        parser.close()
+        return unmarshaller.close()
 
 
 class XMLRPCServer(Server):
@@ -68,15 +118,100 @@ class XMLRPCServer(Server):
         self.password = options.password
 
         socket.setdefaulttimeout(180.0)
-        if options.proxy:
-            transport = ProxyTransport(options.proxy)
-        else:
-            transport = xmlrpclib.Transport()
+        transport = KeepAliveTransport(options.proxy)
         transport.user_agent = self.get_user_agent()
         self.server = xmlrpclib.Server(self.xmlrpc_url, transport)
         challenge = self.server.nonces.challenge(self.factory)
         encrypted = self.encrypt_password(challenge)
         self.server.nonces.verify(self.factory, encrypted)
+        # Use session tokens if the server supports them
+        self.session_token = None
+        self.session_expires = 0
+        self.challenges = [] # prefetched (timestamp, challenge)
+        self.challenges_lock = threading.Lock()
+        methods = self.server.system.listMethods()
+        self.use_sessions = 'nonces.session' in methods
+        # Upload large files in chunks if the server supports it
+        self.use_chunks = 'screenshots.uploadFinish' in methods
+        # Wait on the server for new requests if it supports it
+        self.use_long_poll = 'requests.longPoll' in methods
+
+    def start_session(self):
+        """
+        Authenticate once and get a session token from the server.
+        """
+        challenge = self.server.nonces.challenge(self.factory)
+        encrypted = self.encrypt_password(challenge)
+        session = self.server.nonces.session(self.factory, encrypted)
+        self.session_token = session['token']
+        # Get a new token a minute before the old one expires.
+        self.session_expires = time.time() + session['expires'] - 60
+
+    def authenticate(self):
+        """
+        Get a session token, or encrypt the password with a new nonce
+        if the server doesn't support sessions.
+        """
+        if self.use_sessions:
+            if time.time() > self.session_expires:
+                self.start_session()
+            return self.session_token
+        return self.encrypt_password(self.get_challenge())
+
+    def get_challenge(self):
+        """
+        Get a prefetched nonce challenge, or a new one if there's no
+        fresh one left.
+        """
+        self.challenges_lock.acquire()
+        try:
+            while self.challenges:
+                fetched, challenge = self.challenges.pop(0)
+                if time.time() < fetched + NONCE_LIFETIME:
+                    return challenge
+        finally:
+            self.challenges_lock.release()
+        return self.server.nonces.challenge(self.factory)
+
+    def call(self, method_name, *args):
+        """
+        Call an XML-RPC method with authentication and print the
+        latency. Without session tokens, nonce challenges for the
+        next calls are requested in the same system.multicall, to
+        save round trips. If the server rejects the session token,
+        get a new one and try again once.
+        """
+        call_started = time.time()
+        try:
+            encrypted = self.authenticate()
+            params = (self.factory, encrypted) + args
+            if self.use_sessions:
+                method = getattr(self.server, method_name)
+                try:
+                    return method(*params)
+                except xmlrpclib.Fault, fault:
+                    if fault.faultCode not in SESSION_FAULTS:
+                        raise
+                    print "Session token rejected:", fault.faultString
+                self.session_expires = 0
+                params = (self.factory, self.authenticate()) + args
+                return method(*params)
+            calls = [{'methodName': method_name, 'params': params}]
+            for index in range(NONCE_PREFETCH - len(self.challenges)):
+                calls.append({'methodName': 'nonces.challenge',
+                              'params': (self.factory, )})
+            results = self.server.system.multicall(calls)
+            fetched = time.time()
+            for result in results[1:]:
+                if isinstance(result, list):
+                    self.challenges.append((fetched, result[0]))
+            if isinstance(results[0], dict):
+                raise xmlrpclib.Fault(results[0]['faultCode'],
+                                      results[0]['faultString'])
+            return results[0][0]
+        finally:
+            print '%s latency: %.2f seconds' % (
+                method_name, time.time() - call_started)
 
     def encrypt_password(self, challenge):
         """
@@ -96,8 +231,7 @@ class XMLRPCServer(Server):
         """
         Get the URL for this screenshot request.
         """
-        challenge = self.server.nonces.challenge(self.factory)
-        encrypted = self.encrypt_password(challenge)
+        encrypted = self.authenticate()
         return '/'.join((self.server_url, 'redirect',
             self.factory, encrypted, str(config['request']), ''))
 
@@ -105,22 +239,65 @@ class XMLRPCServer(Server):
         """
         Upload PNG file to server.
         """
+        if self.use_chunks:
+            return self.upload_chunks(config, pngfilename)
         binary_file = file(pngfilename, 'rb')
         binary_data = binary_file.read()
         binary = xmlrpclib.Binary(binary_data)
         binary_file.close()
 
-        challenge = self.server.nonces.challenge(self.factory)
-        encrypted = self.encrypt_password(challenge)
         upload_started = time.time()
-        self.server.screenshots.upload(
-            self.factory, encrypted, int(config['request']), binary)
+        self.call('screenshots.upload', int(config['request']), binary)
         seconds = time.time() - upload_started
         bytes = len(binary_data) * 8 / 6 # base64 encoding
         print "Uploaded %d bytes in %.2f seconds (%.2f kbps)." % (
             bytes, seconds, 8 * bytes / seconds / 1000.0)
         return bytes
 
+    def upload_chunks(self, config, pngfilename):
+        """
+        Upload PNG file to server in chunks, so that only one chunk
+        must be in memory at a time.
+        """
+        request = int(config['request'])
+        checksum = md5()
+        offset = 0
+        upload_started = time.time()
+        binary_file = file(pngfilename, 'rb')
+        try:
+            while True:
+                data = binary_file.read(UPLOAD_CHUNK_SIZE)
+                if not data:
+                    break
+                checksum.update(data)
+                offset = self.upload_chunk(request, offset, data)
+        finally:
+            binary_file.close()
+        self.call('screenshots.uploadFinish',
+                  request, offset, checksum.hexdigest())
+        seconds = time.time() - upload_started
+        bytes = offset * 8 / 6 # base64 encoding
+        print "Uploaded %d bytes in %.2f seconds (%.2f kbps)." % (
+            bytes, seconds, 8 * bytes / seconds / 1000.0)
+        return bytes
+
+    def upload_chunk(self, request, offset, data):
+        """
+        Send one chunk, and send it again after network errors.
+        Return the offset for the next chunk.
+        """
+        binary = xmlrpclib.Binary(data)
+        for attempt in range(UPLOAD_RETRIES):
+            try:
+                return self.call('screenshots.uploadChunk',
+                                 request, offset, binary)
+            except (socket.error, httplib.HTTPException,
+                    xmlrpclib.ProtocolError), error:
+                if attempt == UPLOAD_RETRIES - 1:
+                    raise
+                print "Upload error at offset %d: %s" % (offset, error)
+                time.sleep(UPLOAD_RETRY_DELAY)
+
     def debug_factory_features(self):
         """
         Print the SQL WHERE clause for a given factory, with linebreaks.
@@ -145,14 +322,9 @@ class XMLRPCServer(Server):
 
     def poll(self):
         """
-        Get the next screenshot request from the server.
+        Get the next screenshot request from the server. With long
+        polls, the server waits until a matching request is submitted.
         """
-        challenge = self.server.nonces.challenge(self.factory)
-        encrypted = self.encrypt_password(challenge)
-        poll_start = time.time()
-        try:
-            config = self.server.requests.poll(self.factory, encrypted)
-        finally:
-            poll_latency = time.time() - poll_start
-            print 'server poll latency: %.2f seconds' % poll_latency
-        return config
+        if self.use_long_poll:
+            return self.call('requests.longPoll', LONG_POLL_SECONDS)
+        return self.call('requests.poll')
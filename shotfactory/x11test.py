@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# browsershots.org - Test your web design in different browsers
+# Copyright (C) 2007 Johann C. Rocholl <johann@browsershots.org>
+#
+# Browsershots is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Browsershots is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Check screen capture and key input over the X11 connection on a
+headless Xvfb display, and compare capture speed with xwd.
+
+Usage: x11test.py [-d :99] [-g 1024x768] [-r repeat]
+"""
+
+__revision__ = "$Rev$"
+__date__ = "$Date$"
+__author__ = "$Author$"
+
+import os
+import sys
+import time
+import signal
+from optparse import OptionParser
+from shotfactory04.gui import x11
+from shotfactory04.image import frames
+
+COLOR = (0x33, 0x66, 0x99) # fill color for the capture check
+STARTUP_TIMEOUT = 10 # seconds to wait for Xvfb
+
+
+def start_xvfb(display, width, height):
+    """Start Xvfb and wait until it accepts connections."""
+    pid = os.spawnlp(os.P_NOWAIT, 'Xvfb', 'Xvfb', display, '-screen', '0',
+                     '%dx%dx24' % (width, height), '-nolisten', 'tcp')
+    started = time.time()
+    while time.time() - started < STARTUP_TIMEOUT:
+        try:
+            return pid, x11.Connection(display)
+        except x11.ERRORS:
+            time.sleep(0.2)
+    os.kill(pid, signal.SIGTERM)
+    sys.exit("Xvfb didn't start on display %s" % display)
+
+
+def check_capture(connection, width, height):
+    """Fill the screen with a color and make sure it's captured."""
+    mask = connection.channels
+    if mask is None:
+        sys.exit("Unsupported pixel format.")
+    pixel = 0
+    for index, value in zip(mask, COLOR):
+        if connection.display.display.info.image_byte_order == 1:
+            index = 3 - index
+        pixel |= value << (8 * index)
+    gc = connection.root.create_gc(foreground=pixel)
+    connection.root.fill_rectangle(gc, 0, 0, width, height)
+    connection.display.sync()
+    frame = frames.Frame(width, height)
+    connection.capture(frame)
+    expected = list(COLOR) * 4
+    for offset in (0, 3 * (width * height / 2), len(frame.pixels) - 12):
+        if list(frame.pixels[offset:offset + 12]) != expected:
+            sys.exit("Captured pixels at %d are %s, expected %s" % (
+                offset, list(frame.pixels[offset:offset + 12]), expected))
+    print "Capture OK"
+    return frame
+
+
+def check_keys(connection, display):
+    """Send a key to a focused window and wait for the event."""
+    listener = x11.xdisplay.Display(display)
+    root = listener.screen().root
+    window = root.create_window(0, 0, 100, 100, 0,
+                                listener.screen().root_depth,
+                                event_mask=x11.X.KeyPressMask)
+    window.map()
+    listener.sync()
+    window.set_input_focus(x11.X.RevertToParent, x11.X.CurrentTime)
+    listener.sync()
+    connection.xte('key Page_Down')
+    keycode = connection.keycode('Page_Down')
+    started = time.time()
+    while time.time() - started < STARTUP_TIMEOUT:
+        while listener.pending_events():
+            event = listener.next_event()
+            if event.type == x11.X.KeyPress and event.detail == keycode:
+                listener.close()
+                print "Key input OK"
+                return
+        time.sleep(0.05)
+    sys.exit("Key press didn't arrive.")
+
+
+def measure(function, repeat):
+    """Return best time in seconds."""
+    best = None
+    for index in range(repeat):
+        started = time.time()
+        function()
+        seconds = time.time() - started
+        if best is None or seconds < best:
+            best = seconds
+    return best
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('-d', '--display', default=':99',
+                      help="display for Xvfb (default :99)")
+    parser.add_option('-g', '--geometry', default='1024x768',
+                      help="screen size (default 1024x768)")
+    parser.add_option('-r', '--repeat', type='int', default=5,
+                      help="best of REPEAT captures (default 5)")
+    options, args = parser.parse_args()
+    if x11.xdisplay is None:
+        sys.exit("python-xlib is not installed.")
+    width, height = [int(part) for part in options.geometry.split('x')]
+    pid, connection = start_xvfb(options.display, width, height)
+    try:
+        frame = check_capture(connection, width, height)
+        check_keys(connection, options.display)
+        seconds = measure(lambda: connection.capture(frame), options.repeat)
+        print "X11 capture: %.3f seconds" % seconds
+        command = 'DISPLAY=%s xwd -root -silent | xwdtopnm 2>/dev/null' % (
+            options.display)
+
+        def xwd_capture():
+            """Capture through a pipe, like the fallback code."""
+            pipe = os.popen(command, 'rb')
+            frame.read_ppm(pipe, 'xwd screenshot')
+            if pipe.close():
+                raise RuntimeError("xwd failed")
+        try:
+            seconds = measure(xwd_capture, options.repeat)
+            print "xwd capture: %.3f seconds" % seconds
+        except RuntimeError, error:
+            print "xwd capture failed:", error
+        connection.close()
+    finally:
+        os.kill(pid, signal.SIGTERM)
+
+
+if __name__ == '__main__':
+    main()
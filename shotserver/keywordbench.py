@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# browsershots.org - Test your web design in different browsers
+# Copyright (C) 2007 Johann C. Rocholl <johann@browsershots.org>
+#
+# Browsershots is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Browsershots is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compare speed and results of one substring search per keyword and
+the single-pass KeywordScanner, for the profanity and shock site
+keyword lists from settings.py, on a corpus of saved HTML pages.
+
+With -e, each list is extended with random extra keywords, to see
+how both methods scale with longer lists.
+
+Usage: keywordbench.py [-r repeat] [-e extra] page1.html page2.html ...
+"""
+
+__revision__ = "$Rev$"
+__date__ = "$Date$"
+__author__ = "$Author$"
+
+import os
+os.environ['DJANGO_SETTINGS_MODULE'] = 'shotserver04.settings'
+import sys
+import time
+import random
+from optparse import OptionParser
+from django.conf import settings
+from shotserver04.websites.utils import KeywordScanner, MAX_RESPONSE_SIZE
+
+
+def substring_counts(keyword_lists, content):
+    """The old method: lowercase and search once per keyword."""
+    content = content.lower()
+    return [len([keyword for keyword in keywords if keyword in content])
+            for keywords in keyword_lists]
+
+
+def random_keywords(count):
+    """Make random lowercase keywords."""
+    return [''.join([random.choice('abcdefghijklmnopqrstuvwxyz')
+                     for index in range(random.randint(4, 10))])
+            for keyword in range(count)]
+
+
+def measure(function, repeat, *args):
+    """Return result and best time in seconds."""
+    best = None
+    for index in range(repeat):
+        started = time.time()
+        result = function(*args)
+        seconds = time.time() - started
+        if best is None or seconds < best:
+            best = seconds
+    return result, best
+
+
+def main():
+    parser = OptionParser(usage="%prog [options] page.html ...")
+    parser.add_option('-r', '--repeat', type='int', default=5,
+                      help="best of REPEAT runs (default 5)")
+    parser.add_option('-e', '--extra', type='int', default=0,
+                      help="add EXTRA random keywords to each list")
+    options, args = parser.parse_args()
+    if not args:
+        parser.error("need HTML files")
+    random.seed(0)
+    keyword_lists = [
+        settings.PROFANITIES_LIST + random_keywords(options.extra),
+        settings.SHOCKSITE_KEYWORDS_LIST + random_keywords(options.extra)]
+    started = time.time()
+    scanner = KeywordScanner(*keyword_lists)
+    print "%d keywords compiled in %.3f seconds" % (
+        sum([len(keywords) for keywords in keyword_lists]),
+        time.time() - started)
+    totals = [0.0, 0.0]
+    total_bytes = 0
+    mismatches = 0
+    for filename in args:
+        content = open(filename, 'rb').read(MAX_RESPONSE_SIZE)
+        try:
+            content = content.decode('utf8')
+        except UnicodeDecodeError:
+            content = content.decode('latin1')
+        total_bytes += len(content)
+        expected, substring_seconds = measure(
+            substring_counts, options.repeat, keyword_lists, content)
+        result, scanner_seconds = measure(
+            scanner.count, options.repeat, content)
+        totals[0] += substring_seconds
+        totals[1] += scanner_seconds
+        if result != expected:
+            mismatches += 1
+            print "%s: substring %s, scanner %s" % (
+                filename, expected, result)
+    print "%d pages, %d characters" % (len(args), total_bytes)
+    print "substring: %.3f seconds" % totals[0]
+    print "scanner:   %.3f seconds" % totals[1]
+    if mismatches:
+        sys.exit("%d pages with different counts" % mismatches)
+
+
+if __name__ == '__main__':
+    main()
@@ -23,10 +23,13 @@ __date__ = "$Date$"
 __author__ = "$Author$"
 
 from django.db import models
+from django.db.models.signals import post_save, post_delete
 from django.utils.translation import ugettext_lazy as _
 from django.utils.text import capfirst
 from django.utils.safestring import mark_safe
 from shotserver04.factories.models import Factory
+from shotserver04.factories.models import forget_capabilities
+from shotserver04.factories.models import capabilities_changed
 from shotserver04.features.models import Javascript, Java, Flash
 from shotserver04.common import granular_update
 
@@ -125,7 +128,17 @@ class Browser(models.Model):
         verbose_name_plural = _('browsers')
         ordering = ('user_agent', )
 
-    update_fields = granular_update.update_fields
+    def update_fields(self, **kwargs):
+        """
+        Update selected fields in the database. Forget the factory's
+        cached capabilities if the browser was activated, deactivated
+        or blocked because of an error.
+        """
+        granular_update.update_fields(self, **kwargs)
+        if 'active' in kwargs or 'last_error' in kwargs:
+            forget_capabilities(self.factory_id)
+
+    update_fields.alters_data = True
 
     def __unicode__(self):
         return u'%s %s' % (self.browser_group.name, self.version)
@@ -154,3 +167,7 @@ class Browser(models.Model):
             value = capfirst(_("activate"))
         return mark_safe(u'<input type="submit" name="%s" value="%s" />' %
                          (name, value))
+
+
+post_save.connect(capabilities_changed, sender=Browser)
+post_delete.connect(capabilities_changed, sender=Browser)
@@ -35,7 +35,7 @@ from django.utils.translation import ugettext_lazy, ugettext as _
 from django.utils.safestring import mark_safe
 from django.conf import settings
 from shotserver04.common import error_page, results
-from shotserver04.factories.models import Factory
+from shotserver04.factories.models import Factory, forget_capabilities
 from shotserver04.browsers.models import Browser
 from shotserver04.browsers import agents
 
@@ -289,3 +289,4 @@ AND NOT EXISTS(SELECT 1 FROM requests_request
     cursor.execute("""
 UPDATE browsers_browser SET active = FALSE
 WHERE """ + where, params)
+    forget_capabilities(data['factory'].id)
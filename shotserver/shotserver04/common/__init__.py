@@ -35,6 +35,7 @@ POLL_TIMEOUT = 10 # minutes since last poll for active factory
 ERROR_TIMEOUT = 10 # minutes blocked after browser error
 
 MAX_ATTEMPTS = 10 # for @serializable
+LOCK_FREE = True # claim and close requests with conditional UPDATE
 
 
 def lock_timeout():
@@ -102,7 +103,7 @@ def serializable(func):
                 serialize_error = "serialize access" in str(error).lower()
                 if attempt == MAX_ATTEMPTS or not serialize_error:
                     raise
-                # sys.stdout.write('!') # For test_overload.py
+                serializable.retries += 1 # For test_overload.py
             except:
                 transaction.rollback()
                 raise
@@ -111,6 +112,41 @@ def serializable(func):
     wrapper.__doc__ = func.__doc__
     return wrapper
 
+serializable.retries = 0
+
+
+def read_committed(func):
+    """
+    Decorator that runs a function in its own transaction, with the
+    PostgreSQL transaction isolation level read committed. Use this
+    for conditional UPDATE statements that find out by themselves if
+    a concurrent transaction was faster, so there is nothing to retry.
+    """
+
+    @transaction.commit_manually
+    def wrapper(*args, **kwargs):
+        """
+        Set the transaction isolation level to read committed, then
+        run the wrapped function and commit.
+        """
+        if transaction.is_dirty():
+            transaction.commit()
+        else:
+            transaction.rollback()
+        cursor = connection.cursor()
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL READ COMMITTED")
+        try:
+            result = func(*args, **kwargs)
+        except:
+            transaction.rollback()
+            raise
+        transaction.commit()
+        return result
+
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
 
 def result_page(http_request, result_class, result_title, result_message,
                 *extra_messages):
@@ -0,0 +1,184 @@
+# browsershots.org - Test your web design in different browsers
+# Copyright (C) 2007 Johann C. Rocholl <johann@browsershots.org>
+#
+# Browsershots is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Browsershots is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Admission control for screenshot factory polls.
+
+The server keeps track of polls, uploads and waiting long polls in
+progress, the average database time per poll, and the system load.
+If any of them is over capacity, some polls are rejected with Fault
+503 and a randomized retry hint that grows with the overload, so
+that factories spread out their next polls instead of coming back
+all at the same time.
+"""
+
+__revision__ = "$Rev$"
+__date__ = "$Date$"
+__author__ = "$Author$"
+
+import os
+import time
+import random
+import threading
+from xmlrpclib import Fault
+from django.conf import settings
+
+MAX_IN_FLIGHT = 20 # polls and uploads at the same time, per process
+MAX_WAITING = 10 # long polls waiting at the same time, per process
+TARGET_LATENCY = 0.5 # seconds of database time per poll, on average
+ACCEPTABLE_SERVER_LOAD = 8.0 # system load average
+LATENCY_WEIGHT = 0.1 # moving average weight of the latest poll
+BASE_RETRY = 30 # seconds, retry hint when just over capacity
+MAX_RETRY = 600 # seconds
+JITTER = 0.5 # randomize retry hints by plus or minus 50 percent
+RETRY_FORMAT = "The server is currently overloaded. " + \
+    "Please try again in %d seconds."
+
+
+class AdmissionController:
+    """
+    Decide if the server has capacity for another factory poll.
+    """
+
+    def __init__(self, max_in_flight=MAX_IN_FLIGHT,
+                 target_latency=TARGET_LATENCY,
+                 acceptable_load=ACCEPTABLE_SERVER_LOAD,
+                 max_waiting=MAX_WAITING):
+        self.max_in_flight = max_in_flight
+        self.max_waiting = max_waiting
+        self.target_latency = target_latency
+        self.acceptable_load = acceptable_load
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.latency = 0.0
+
+    def begin(self, kind):
+        """Count a poll or upload in progress."""
+        self.lock.acquire()
+        try:
+            self.in_flight[kind] = self.in_flight.get(kind, 0) + 1
+        finally:
+            self.lock.release()
+
+    def begin_wait(self, rand=random.random):
+        """
+        Count a long poll that is about to wait for new requests, or
+        raise Fault 503 with a retry hint if too many are waiting.
+        Waiting long polls keep a server thread busy, so they count
+        as in flight.
+        """
+        self.lock.acquire()
+        try:
+            waiting = self.in_flight.get('wait', 0)
+            if waiting < self.max_waiting:
+                self.in_flight['wait'] = waiting + 1
+                return
+        finally:
+            self.lock.release()
+        factor = float(waiting + 1) / self.max_waiting
+        raise Fault(503, RETRY_FORMAT % retry_after(factor, rand))
+
+    def end(self, kind, seconds=None):
+        """
+        Count a finished poll or upload. If seconds is given, update
+        the moving average of database latency.
+        """
+        self.lock.acquire()
+        try:
+            self.in_flight[kind] -= 1
+            if seconds is not None:
+                self.latency += LATENCY_WEIGHT * (seconds - self.latency)
+        finally:
+            self.lock.release()
+
+    def track(self, kind, measure=False):
+        """
+        Decorator to count calls of a function as in progress, and
+        optionally measure their duration as database latency.
+        """
+
+        def decorator(func):
+            """Wrap the function."""
+
+            def wrapper(*args, **kwargs):
+                """Count this call while it's running."""
+                started = time.time()
+                self.begin(kind)
+                seconds = None
+                try:
+                    result = func(*args, **kwargs)
+                    if measure:
+                        seconds = time.time() - started
+                    return result
+                finally:
+                    self.end(kind, seconds)
+
+            wrapper.__name__ = func.__name__
+            wrapper.__doc__ = func.__doc__
+            return wrapper
+
+        return decorator
+
+    def load_factor(self):
+        """
+        Get the usage of the scarcest resource, 1.0 at capacity.
+        """
+        try:
+            system_load = max(os.getloadavg()) / self.acceptable_load
+        except (AttributeError, OSError):
+            system_load = 0.0
+        in_flight = sum(self.in_flight.values())
+        return max(float(in_flight) / self.max_in_flight,
+                   self.latency / self.target_latency,
+                   system_load)
+
+    def check(self, priority=False, rand=random.random):
+        """
+        Raise Fault 503 with a retry hint, with a probability that
+        rises smoothly with the overload.
+        """
+        factor = self.load_factor()
+        if priority:
+            factor /= 2
+        if factor * rand() > 1.0:
+            raise Fault(503, RETRY_FORMAT % retry_after(factor, rand))
+
+
+def retry_after(factor, rand=random.random):
+    """
+    Get a randomized retry hint in seconds for an overload factor.
+
+    >>> retry_after(1.0, lambda: 0.5)
+    30
+    >>> retry_after(2.0, lambda: 0.0)
+    30
+    >>> retry_after(100, lambda: 1.0)
+    900
+    """
+    seconds = min(MAX_RETRY, BASE_RETRY * factor)
+    return int(round(seconds * (1.0 - JITTER + 2 * JITTER * rand())))
+
+
+admission = AdmissionController(
+    getattr(settings, 'ADMISSION_MAX_IN_FLIGHT', MAX_IN_FLIGHT),
+    getattr(settings, 'ADMISSION_TARGET_LATENCY', TARGET_LATENCY),
+    getattr(settings, 'ACCEPTABLE_SERVER_LOAD', ACCEPTABLE_SERVER_LOAD),
+    getattr(settings, 'ADMISSION_MAX_WAITING', MAX_WAITING))
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
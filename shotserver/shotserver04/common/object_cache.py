@@ -115,6 +115,32 @@ def update(object):
     cache.set(cache_key, object)
 
 
+def get_derived(object, name):
+    """
+    Get cached data that was derived from an object and related rows,
+    or None if it is not in the cache.
+    """
+    cache_key = KEY_FORMAT % (object._meta.db_table, name, object.id)
+    value = cache.get(cache_key)
+    if DEBUG: print value is None and 'missed' or 'hit', cache_key
+    return value
+
+
+def set_derived(object, name, value):
+    """
+    Store data that was derived from an object and related rows.
+    """
+    cache_key = KEY_FORMAT % (object._meta.db_table, name, object.id)
+    cache.set(cache_key, value)
+
+
+def delete_derived(model, id, name):
+    """
+    Remove derived data from the cache, e.g. after related rows changed.
+    """
+    cache.delete(KEY_FORMAT % (model._meta.db_table, name, id))
+
+
 def preload_foreign_keys(instances, **kwargs):
     """
     Preload the object cache for some foreign key fields.
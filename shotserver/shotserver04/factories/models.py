@@ -23,7 +23,10 @@ __date__ = "$Date$"
 __author__ = "$Author$"
 
 from xmlrpclib import Fault
+from datetime import datetime, timedelta
 from django.db import models
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
 from django.utils.translation import ugettext_lazy as _
 from django.utils.text import capfirst
 from django.utils.http import urlquote
@@ -32,13 +35,19 @@ from django.contrib.auth.models import User
 from shotserver04.platforms.models import OperatingSystem
 from shotserver04.sponsors.models import Sponsor
 from shotserver04.common.templatetags import human
-from shotserver04.common import granular_update, last_error_timeout
+from shotserver04.common import granular_update, object_cache
+from shotserver04.common import last_error_timeout, ERROR_TIMEOUT
+from shotserver04.features.models import version_id_q
 
 FACTORY_FIELDS = (
     'name', 'operating_system', 'last_poll', 'last_upload',
     'uploads_per_hour', 'uploads_per_day', 'queue_estimate')
 FACTORY_FIELDS_SECONDS = ('queue_estimate')
 FACTORY_FIELDS_TIMESINCE = ('last_poll', 'last_upload', 'created')
+CAPABILITIES_VERSION = 1 # increment when the cached profile changes
+# A per-process cache would keep stale profiles in other processes.
+CACHE_CAPABILITIES = not settings.CACHE_BACKEND.startswith(
+    ('locmem:', 'dummy:', 'simple:'))
 
 
 class Factory(models.Model):
@@ -102,41 +111,114 @@ class Factory(models.Model):
     def platform_q(self):
         """Get SQL query to match requested platforms."""
         return (models.Q(platform__isnull=True) |
-                models.Q(platform__id=self.operating_system.platform.id))
+                models.Q(platform__id=self.capabilities()['platform']))
 
     def browsers_q(self):
         """Get SQL query to match requested browsers."""
         q = models.Q()
-        browsers = self.browser_set.filter(active=True)
-        if not browsers.count():
-            raise Fault(404,
-                u"No active browsers registered for factory %s." % self.name)
-        browsers = browsers.filter(
-            models.Q(last_error__isnull=True) |
-            models.Q(last_error__lt=last_error_timeout()))
-        if not len(browsers):
-            raise Fault(204,
-u"All active browsers on %s are temporarily blocked because of errors." %
-self.name)
-        for browser in browsers:
-            q |= browser.features_q()
+        for browser in self.capabilities()['browsers']:
+            major = browser['major']
+            minor = browser['minor']
+            q |= (models.Q(browser_group__id=browser['browser_group_id']) &
+                  (models.Q(major__isnull=True) | models.Q(major=major)) &
+                  (models.Q(minor__isnull=True) | models.Q(minor=minor)) &
+                  version_id_q('javascript', browser['javascript_id'],
+                               browser['javascript_version']) &
+                  version_id_q('java', browser['java_id'],
+                               browser['java_version']) &
+                  version_id_q('flash', browser['flash_id'],
+                               browser['flash_version']))
         return q
 
     def screensizes_q(self):
         """Get SQL query to match requested screen sizes."""
         q = models.Q(request_group__width__isnull=True)
-        for screensize in self.screensize_set.all():
-            q |= models.Q(request_group__width=screensize.width)
+        for width in self.capabilities()['widths']:
+            q |= models.Q(request_group__width=width)
         return q
 
     def colordepths_q(self):
         """Get SQL query to match requested color depths."""
         q = models.Q(request_group__bits_per_pixel__isnull=True)
-        for colordepth in self.colordepth_set.all():
-            q |= models.Q(request_group__bits_per_pixel=
-                          colordepth.bits_per_pixel)
+        for bits_per_pixel in self.capabilities()['depths']:
+            q |= models.Q(request_group__bits_per_pixel=bits_per_pixel)
         return q
 
+    def capabilities(self):
+        """
+        Get supported platform, screen sizes, color depths and browsers
+        from the cache, so that polls don't need to query the browser,
+        screen size and color depth tables. The profile is only cached
+        if the cache is shared between processes, otherwise it's loaded
+        from the database every time. Raise Fault if there are no
+        browsers available at the moment.
+        """
+        profile = None
+        if CACHE_CAPABILITIES:
+            profile = object_cache.get_derived(self, 'capabilities')
+        if (profile is None or
+            profile['version'] != CAPABILITIES_VERSION or
+            (profile['expires'] and profile['expires'] <= datetime.now())):
+            profile = self.build_capabilities()
+            if CACHE_CAPABILITIES:
+                object_cache.set_derived(self, 'capabilities', profile)
+        if profile['fault']:
+            raise Fault(*profile['fault'])
+        return profile
+
+    def build_capabilities(self):
+        """
+        Load the capability profile from the database. It expires when
+        the first blocked browser may be used again.
+        """
+        profile = {
+            'version': CAPABILITIES_VERSION,
+            'fault': None,
+            'expires': None,
+            'platform': self.operating_system.platform_id,
+            'screen_sizes': [(screensize.width, screensize.height)
+                             for screensize in self.screensize_set.all()],
+            'depths': [colordepth.bits_per_pixel
+                       for colordepth in self.colordepth_set.all()],
+            'browsers': [],
+            }
+        profile['widths'] = set([width for width, height
+                                 in profile['screen_sizes']])
+        browsers = self.browser_set.filter(active=True).select_related()
+        timeout = last_error_timeout()
+        blocked = []
+        for browser in browsers:
+            if (browser.last_error is not None and
+                browser.last_error >= timeout):
+                blocked.append(browser.last_error)
+                continue
+            profile['browsers'].append({
+                'id': browser.id,
+                'name': browser.browser_group.name,
+                'browser_group_id': browser.browser_group_id,
+                'version': browser.version,
+                'major': browser.major,
+                'minor': browser.minor,
+                'command': browser.command,
+                'javascript_id': browser.javascript_id,
+                'javascript_version': browser.javascript.version,
+                'java_id': browser.java_id,
+                'java_version': browser.java.version,
+                'flash_id': browser.flash_id,
+                'flash_version': browser.flash.version,
+                })
+        if blocked:
+            profile['expires'] = min(blocked) + timedelta(
+                minutes=ERROR_TIMEOUT)
+        if not len(browsers):
+            profile['fault'] = (404,
+                u"No active browsers registered for factory %s." % self.name)
+        elif not profile['browsers']:
+            profile['fault'] = (204,
+u"All active browsers on %s are temporarily blocked because of errors." %
+self.name)
+        return profile
+
     @classmethod
     def table_header(cls):
         """
@@ -206,7 +288,17 @@ self.name)
         return self.colordepth_set.filter(
             bits_per_pixel=bits_per_pixel).count() >= 1
 
-    update_fields = granular_update.update_fields
+    def update_fields(self, **kwargs):
+        """
+        Update selected fields in the database. Forget the cached
+        capabilities if the operating system changes.
+        """
+        granular_update.update_fields(self, **kwargs)
+        if 'operating_system' in kwargs:
+            forget_capabilities(self.id)
+
+    update_fields.alters_data = True
+
 
 class ScreenSize(models.Model):
     """
@@ -266,3 +358,26 @@ class ScreenshotCount(models.Model):
                 self.screenshots, self.factory, self.date.strftime('%Y-%m-%d'))
 
     update_fields = granular_update.update_fields
+
+
+def forget_capabilities(factory_id):
+    """
+    Remove the cached capability profile for a factory.
+    """
+    object_cache.delete_derived(Factory, factory_id, 'capabilities')
+
+
+def capabilities_changed(sender, instance, **kwargs):
+    """
+    Signal handler to forget the cached capability profile when the
+    factory or its screen sizes, color depths or browsers change.
+    """
+    if sender is Factory:
+        forget_capabilities(instance.id)
+    else:
+        forget_capabilities(instance.factory_id)
+
+
+for model in (Factory, ScreenSize, ColorDepth):
+    post_save.connect(capabilities_changed, sender=model)
+    post_delete.connect(capabilities_changed, sender=model)
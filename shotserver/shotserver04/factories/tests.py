@@ -24,10 +24,14 @@ __author__ = "$Author$"
 
 from psycopg import IntegrityError, DatabaseError
 from unittest import TestCase
+from xmlrpclib import Fault
 from django.db import transaction
 from django.contrib.auth.models import User
 from shotserver04.platforms.models import Platform, OperatingSystem
+from shotserver04.common import object_cache
+from shotserver04.factories import models
 from shotserver04.factories.models import Factory, ScreenSize, ColorDepth
+from shotserver04.browsers.models import Engine, Browser
 
 
 class FactoriesTestCase(TestCase):
@@ -131,6 +135,52 @@ class FactoriesTestCase(TestCase):
         finally:
             transaction.rollback()
 
+    def testCapabilitiesNoBrowsers(self):
+        try:
+            self.factory.capabilities()
+            self.fail("Expected fault for factory without browsers.")
+        except Fault, fault:
+            self.assertEqual(fault.faultCode, 404)
+
+    def testCapabilitiesInvalidated(self):
+        profile = self.factory.build_capabilities()
+        self.assertEqual(profile['widths'], set([640, 800, 1024]))
+        self.assertEqual(profile['depths'], [16, 24])
+        object_cache.set_derived(self.factory, 'capabilities', profile)
+        size_1280 = ScreenSize.objects.create(
+            factory=self.factory, width=1280, height=1024)
+        self.assertEqual(
+            object_cache.get_derived(self.factory, 'capabilities'), None)
+        profile = self.factory.build_capabilities()
+        self.assertEqual(profile['widths'], set([640, 800, 1024, 1280]))
+        size_1280.delete()
+
+    def testCapabilitiesBrowserDeactivated(self):
+        cache_capabilities = models.CACHE_CAPABILITIES
+        models.CACHE_CAPABILITIES = False # e.g. with locmem:///
+        browser = Browser.objects.create(
+            factory=self.factory,
+            user_agent="Firefox/2.0.0.4 Gecko/20061201",
+            browser_group_id=1,
+            version='2.0.0.4', major=2, minor=0,
+            command='firefox',
+            engine=Engine.objects.get(pk=1),
+            engine_version='20061201',
+            javascript_id=1,
+            java_id=1,
+            flash_id=1,
+            active=True)
+        try:
+            profile = self.factory.capabilities()
+            self.assertEqual([item['id'] for item in profile['browsers']],
+                             [browser.id])
+            # Deactivated in the admin, handled by another process
+            Browser.objects.filter(id=browser.id).update(active=False)
+            self.assertRaises(Fault, self.factory.capabilities)
+        finally:
+            browser.delete()
+            models.CACHE_CAPABILITIES = cache_capabilities
+
 
 class ForeignKeyTestCase(TestCase):
 
@@ -38,19 +38,26 @@ def version_unicode(self):
         return self.version
 
 
-def version_q(self):
+def version_id_q(module_name, id, version):
     """
-    SQL query to match requests for a given factory.
+    SQL query to match requests for an installed feature version.
     """
-    field = 'request_group__' + self._meta.module_name
+    field = 'request_group__' + module_name
     result = models.Q(**{field + '__isnull': True})
-    result |= models.Q(**{field: self.id})
+    result |= models.Q(**{field: id})
     # Specific installed versions match requests for 'enabled' too.
-    if self.version not in ('disabled', 'enabled'):
+    if version not in ('disabled', 'enabled'):
         result |= models.Q(**{field: 2}) # 2 means 'enabled'
     return result
 
 
+def version_q(self):
+    """
+    SQL query to match requests for a given factory.
+    """
+    return version_id_q(self._meta.module_name, self.id, self.version)
+
+
 class Javascript(models.Model):
     """
     Javascript versions.
@@ -15,7 +15,7 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 """
-Create random nonces.
+Create random nonces and signed session tokens.
 """
 
 __revision__ = "$Rev$"
@@ -23,10 +23,14 @@ __date__ = "$Date$"
 __author__ = "$Author$"
 
 import md5
+import hmac
+import hashlib
 import random
 import time
 import os
 
+SESSION_PREFIX = 'session_'
+
 
 def random_md5():
     """
@@ -39,5 +43,56 @@ def random_md5():
     return digest.hexdigest()
 
 
+def session_signature(secret, name, ip, expires):
+    """
+    HMAC-SHA1 signature for a session token.
+    """
+    message = '|'.join((name, ip, str(expires)))
+    return hmac.new(secret, message, hashlib.sha1).hexdigest()
+
+
+def session_token(secret, name, ip, expires):
+    """
+    Make a session token that is bound to a name and an IP address,
+    and expires at the given time (seconds since the epoch).
+
+    >>> session_token('secret', 'factory', '127.0.0.1', 1234567890)
+    'session_1234567890_f7ff6e0da8f295115c2bb3f0a3a0d93ccec3ce33'
+    """
+    return '%s%d_%s' % (SESSION_PREFIX, expires,
+                        session_signature(secret, name, ip, expires))
+
+
+def session_expires(secret, name, ip, token):
+    """
+    Check the signature of a session token. Return the expiration
+    time, or None if the token is invalid for this name and address.
+
+    >>> token = session_token('secret', 'factory', '127.0.0.1', 1234567890)
+    >>> session_expires('secret', 'factory', '127.0.0.1', token)
+    1234567890
+    >>> session_expires('secret', 'factory', '127.0.0.2', token)
+    >>> session_expires('secret', 'other', '127.0.0.1', token)
+    """
+    if not token.startswith(SESSION_PREFIX):
+        return None
+    parts = token[len(SESSION_PREFIX):].split('_')
+    if len(parts) != 2 or not parts[0].isdigit():
+        return None
+    expires = int(parts[0])
+    expected = session_signature(secret, name, ip, expires)
+    # Compare all characters to avoid leaking timing information.
+    if len(parts[1]) != len(expected):
+        return None
+    difference = 0
+    for a, b in zip(parts[1], expected):
+        difference |= ord(a) ^ ord(b)
+    if difference:
+        return None
+    return expires
+
+
 if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
     print random_md5()
@@ -22,11 +22,16 @@ __revision__ = "$Rev$"
 __date__ = "$Date$"
 __author__ = "$Author$"
 
+import time
 from unittest import TestCase
+from xmlrpclib import Fault
 from psycopg import IntegrityError, ProgrammingError, DatabaseError
 from django.db import transaction
+from django.conf import settings
 from django.contrib.auth.models import User
 from shotserver04.nonces.models import Nonce
+from shotserver04.nonces import crypto
+from shotserver04.nonces import xmlrpc as nonces
 from shotserver04.platforms.models import Platform, OperatingSystem
 from shotserver04.factories.models import Factory
 
@@ -102,3 +107,41 @@ class NonceTestCase(TestCase):
                               factory_id=-1)
         finally:
             transaction.rollback()
+
+
+class FakeHttpRequest:
+
+    def __init__(self, ip='127.0.0.1'):
+        self.META = {'REMOTE_ADDR': ip}
+
+
+class SessionTestCase(TestCase):
+
+    def setUp(self):
+        self.factory = Factory(name='factory')
+
+    def token(self, seconds=60, ip='127.0.0.1'):
+        return crypto.session_token(settings.SECRET_KEY, 'factory', ip,
+                                    int(time.time()) + seconds)
+
+    def assertFaultCode(self, code, token, ip='127.0.0.1'):
+        try:
+            nonces.verify(FakeHttpRequest(ip), self.factory, token)
+            self.fail("Session token should be rejected.")
+        except Fault, fault:
+            self.assertEqual(fault.faultCode, code)
+
+    def testValidToken(self):
+        self.assertTrue(
+            nonces.verify(FakeHttpRequest(), self.factory, self.token()))
+
+    def testExpiredToken(self):
+        self.assertFaultCode(408, self.token(seconds=-1))
+
+    def testDifferentIP(self):
+        self.assertFaultCode(401, self.token(), ip='127.0.0.2')
+
+    def testForgedToken(self):
+        token = self.token()
+        self.assertFaultCode(401, token[:-1] + 'x')
+        self.assertFaultCode(401, 'session_1_2_3')
@@ -22,13 +22,17 @@ __revision__ = "$Rev$"
 __date__ = "$Date$"
 __author__ = "$Author$"
 
+import time
 from xmlrpclib import Fault
+from django.conf import settings
 from django.contrib.auth.models import User
 from shotserver04.xmlrpc import signature, factory_xmlrpc
 from shotserver04.nonces import crypto
 from shotserver04.nonces.models import Nonce
 from datetime import datetime, timedelta
 
+SESSION_TIMEOUT = 60 # minutes before a session token expires
+
 
 @factory_xmlrpc
 @signature(dict, str)
@@ -94,8 +98,14 @@ def verify(http_request, factory, encrypted_password):
     for the inner hash. The result of each hash function call must be
     formatted as lowercase hexadecimal. The calls to nonces.challenge
     and nonces.verify must be made from the same IP address.
+
+    Instead of the encrypted password, you can also send a session
+    token from nonces.session.
     """
     ip = http_request.META['REMOTE_ADDR']
+    # Check session token without database access
+    if encrypted_password.startswith(crypto.SESSION_PREFIX):
+        return verify_session(factory, ip, encrypted_password)
     # Get password hash from database
     password = factory.admin.password
     if password.count('$'):
@@ -123,6 +133,60 @@ def verify(http_request, factory, encrypted_password):
     return True
 
 
+def verify_session(factory, ip, token):
+    """
+    Check a signed session token from nonces.session.
+    """
+    expires = crypto.session_expires(
+        settings.SECRET_KEY, factory.name, ip, token)
+    if expires is None:
+        raise Fault(401, "Authentication failed (invalid session token).")
+    if expires < time.time():
+        raise Fault(408, "Authentication failed (session expired).")
+    return True
+
+
+@factory_xmlrpc
+@signature(dict, str, str)
+def session(http_request, factory, encrypted_password):
+    """
+    Get a session token to save authentication round trips.
+
+    Arguments
+    ~~~~~~~~~
+    * factory_name string (lowercase, normally from hostname)
+    * encrypted_password string (lowercase hexadecimal, length 32)
+
+    See nonces.verify for how to encrypt your password.
+
+    Return value
+    ~~~~~~~~~~~~
+    * session dict
+
+    The return value is a dict with the following keys:
+
+    * token string (use instead of encrypted_password)
+    * expires int (seconds until the token expires)
+
+    Until it expires, you can send the token instead of the encrypted
+    password to requests.poll, screenshots.upload and the redirect
+    URL, without calling nonces.challenge first. The token is only
+    valid for this factory and for requests from the same IP address.
+    If it expires, you get a fault with code 408. Then simply get a
+    new token.
+    """
+    ip = http_request.META['REMOTE_ADDR']
+    if encrypted_password.startswith(crypto.SESSION_PREFIX):
+        raise Fault(400, "Please use an encrypted password, not a token.")
+    verify(http_request, factory, encrypted_password)
+    expires = int(time.time()) + SESSION_TIMEOUT * 60
+    return {
+        'token': crypto.session_token(
+            settings.SECRET_KEY, factory.name, ip, expires),
+        'expires': SESSION_TIMEOUT * 60,
+        }
+
+
 @signature(dict, str)
 def challengeUser(http_request, username):
     """
@@ -27,6 +27,7 @@ import os
 from xmlrpclib import Fault
 from django.conf import settings
 from django.db import models
+from django.db.models.signals import post_save
 from django.utils.translation import ugettext_lazy as _
 from django.utils.timesince import timesince, timeuntil
 from django.utils.text import capfirst
@@ -44,6 +45,8 @@ from shotserver04.common import lock_timeout, last_poll_timeout
 from shotserver04.common.object_cache import preload_foreign_keys
 from shotserver04.common import granular_update
 from shotserver04.features import satisfies
+from shotserver04.requests.pending import request_saved
+from shotserver04.requests.usage import count_request
 
 
 class RequestGroup(models.Model):
@@ -459,3 +462,7 @@ class Request(models.Model):
 def bracket_link(href, text):
     """Replace square brackets with a HTML link."""
     return text.replace('[', u'<a href="%s">' % href).replace(']', '</a>')
+
+
+post_save.connect(request_saved, sender=Request)
+post_save.connect(count_request, sender=Request)
@@ -0,0 +1,454 @@
+# browsershots.org - Test your web design in different browsers
+# Copyright (C) 2007 Johann C. Rocholl <johann@browsershots.org>
+#
+# Browsershots is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Browsershots is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+In-memory index of pending screenshot requests.
+
+Factory polls look up matching requests here with a few dictionary
+probes instead of a big SQL query. The database stays authoritative:
+the caller claims the chosen request with a conditional UPDATE, and
+drops the entry from the index if that fails.
+
+Requests created in this process are added when the transaction
+that created them is committed (see PendingIndexMiddleware), so that
+factories never try to claim rows that they can't see yet. Requests
+from other server processes show up on the next periodic reload.
+
+Long polls from factories wait for an event that is set when a new
+request is added to one of the buckets that the factory can serve.
+"""
+
+__revision__ = "$Rev$"
+__date__ = "$Date$"
+__author__ = "$Author$"
+
+import time
+import bisect
+import threading
+from datetime import datetime
+from django.db import connection, transaction
+from shotserver04.features import satisfies
+
+REFRESH_INTERVAL = 10 # seconds between reloads from the database
+
+
+class PendingRequest:
+    """
+    Index entry for one pending screenshot request.
+    """
+
+    __slots__ = ('id', 'request_group_id', 'bucket', 'features',
+                 'sort_key', 'expire', 'locked', 'own_user_id', 'changed')
+
+    def __init__(self, id, request_group_id, bucket, features,
+                 priority, submitted, expire, locked, own_user_id):
+        self.id = id
+        self.request_group_id = request_group_id
+        self.bucket = bucket
+        self.features = features
+        self.sort_key = (-priority, submitted, id)
+        self.expire = expire
+        self.locked = locked
+        self.own_user_id = own_user_id
+        self.changed = 0 # PendingIndex.generation of the last change
+
+    def __cmp__(self, other):
+        return cmp(self.sort_key, other.sort_key)
+
+
+def compatible(features, browser, widths, depths):
+    """
+    Check if a browser on a factory can handle requested features.
+
+    >>> browser = {'major': 2, 'minor': 0, 'javascript_id': 3,
+    ...            'java_id': 1, 'flash_id': 5}
+    >>> compatible((2, None, None, 24, None, None, 2),
+    ...            browser, set([1024]), set([24]))
+    True
+    >>> compatible((3, None, None, None, None, None, None),
+    ...            browser, set([1024]), set([24]))
+    False
+    """
+    major, minor, width, bits_per_pixel, javascript, java, flash = features
+    return ((major is None or major == browser['major']) and
+            (minor is None or minor == browser['minor']) and
+            (width is None or width in widths) and
+            (bits_per_pixel is None or bits_per_pixel in depths) and
+            satisfies(browser['javascript_id'], javascript) and
+            satisfies(browser['java_id'], java) and
+            satisfies(browser['flash_id'], flash))
+
+
+class PendingIndex:
+    """
+    Pending requests, keyed by (platform, browser_group) and then by
+    (major, minor, width, bits_per_pixel, javascript, java, flash).
+    Each key maps to a list of entries sorted by priority and
+    submission time, just like the ORDER BY of the old SQL query.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.waiters = {}
+        self.local = threading.local()
+        self.generation = 0 # counts changes, see load
+        self.clear()
+
+    def clear(self):
+        """Remove all entries."""
+        self.buckets = {}
+        self.entries = {}
+        self.groups = {}
+        self.loaded = None
+
+    def add_waiter(self, buckets):
+        """
+        Get an event that will be set when a new request is added to
+        one of these buckets.
+        """
+        event = threading.Event()
+        self.lock.acquire()
+        try:
+            for bucket in buckets:
+                self.waiters.setdefault(bucket, set()).add(event)
+        finally:
+            self.lock.release()
+        return event
+
+    def remove_waiter(self, buckets, event):
+        """Stop notifying an event from add_waiter."""
+        self.lock.acquire()
+        try:
+            for bucket in buckets:
+                events = self.waiters.get(bucket)
+                if events is None:
+                    continue
+                events.discard(event)
+                if not events:
+                    del self.waiters[bucket]
+        finally:
+            self.lock.release()
+
+    def notify(self, bucket):
+        """Wake up long polls that wait for this bucket."""
+        for event in self.waiters.get(bucket, ()):
+            event.set()
+
+    def touch(self, entry):
+        """Mark an entry as changed, call with the lock held."""
+        self.generation += 1
+        entry.changed = self.generation
+
+    def add(self, entry):
+        """Insert a new entry, or replace an existing one."""
+        self.lock.acquire()
+        try:
+            self.discard(entry.id)
+            self.touch(entry)
+            keys = self.buckets.setdefault(entry.bucket, {})
+            bisect.insort(keys.setdefault(entry.features, []), entry)
+            self.entries[entry.id] = entry
+            self.groups.setdefault(
+                entry.request_group_id, set()).add(entry.id)
+        finally:
+            self.lock.release()
+
+    def discard(self, request_id):
+        """Remove an entry, if it exists."""
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(request_id, None)
+            if entry is None:
+                return
+            keys = self.buckets[entry.bucket]
+            entries = keys[entry.features]
+            entries.remove(entry)
+            if not entries:
+                del keys[entry.features]
+                if not keys:
+                    del self.buckets[entry.bucket]
+            group = self.groups[entry.request_group_id]
+            group.discard(request_id)
+            if not group:
+                del self.groups[entry.request_group_id]
+        finally:
+            self.lock.release()
+
+    def lock_request(self, request_id, locked):
+        """Remember that a request was locked by a factory."""
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(request_id)
+            if entry is not None:
+                entry.locked = locked
+                self.touch(entry)
+        finally:
+            self.lock.release()
+
+    def expire_group(self, request_group_id, expire):
+        """Update expiration time for all requests in a group."""
+        self.lock.acquire()
+        try:
+            for request_id in self.groups.get(request_group_id, ()):
+                self.entries[request_id].expire = expire
+                self.touch(self.entries[request_id])
+        finally:
+            self.lock.release()
+
+    def make_entry(self, request):
+        """
+        Make an index entry for a new request, or return None if it
+        should not be processed by factories.
+        """
+        if request.priority < 0:
+            return # Ignore shock sites
+        group = request.request_group
+        own_user_id = None
+        if group.own_factories_only:
+            own_user_id = group.user_id
+        entry = PendingRequest(
+            request.id, group.id,
+            (request.platform_id, request.browser_group_id),
+            (request.major, request.minor,
+             group.width, group.bits_per_pixel,
+             group.javascript_id, group.java_id, group.flash_id),
+            request.priority, group.submitted, group.expire,
+            request.locked, own_user_id)
+        return entry
+
+    def add_request(self, request):
+        """Add a new request, if it should be processed by factories."""
+        entry = self.make_entry(request)
+        if entry is None:
+            return
+        self.lock.acquire()
+        try:
+            self.add(entry)
+            self.notify(entry.bucket)
+        finally:
+            self.lock.release()
+
+    def defer_request(self, request):
+        """
+        Remember a new request from an open transaction, to be added
+        by publish after commit.
+        """
+        entry = self.make_entry(request)
+        if entry is None:
+            return
+        if not hasattr(self.local, 'uncommitted'):
+            self.local.uncommitted = []
+        self.local.uncommitted.append(entry)
+
+    def publish(self):
+        """Add requests from the committed transaction of this thread."""
+        entries = getattr(self.local, 'uncommitted', None)
+        if not entries:
+            return
+        self.local.uncommitted = []
+        self.lock.acquire()
+        try:
+            for entry in entries:
+                self.add(entry)
+            for bucket in set([entry.bucket for entry in entries]):
+                self.notify(bucket)
+        finally:
+            self.lock.release()
+
+    def forget(self):
+        """Drop requests from a transaction that was rolled back."""
+        self.local.uncommitted = []
+
+    def query(self):
+        """
+        Get all pending requests from the database.
+        """
+        cursor = connection.cursor()
+        cursor.execute("""
+SELECT r.id, r.request_group_id, r.platform_id, r.browser_group_id,
+       r.major, r.minor, r.priority, r.locked,
+       g.width, g.bits_per_pixel, g.javascript_id, g.java_id, g.flash_id,
+       g.own_factories_only, g.user_id, g.submitted, g.expire
+FROM requests_request r
+JOIN requests_requestgroup g ON g.id = r.request_group_id
+WHERE r.screenshot_id IS NULL
+AND r.priority >= 0
+AND g.expire > %s
+""", [datetime.now()])
+        return cursor.fetchall()
+
+    def load(self):
+        """
+        Reload all pending requests from the database. Entries that
+        were added or changed by this process while the query was
+        running are newer than the rows, so they are kept.
+        """
+        self.lock.acquire()
+        try:
+            started = self.generation
+        finally:
+            self.lock.release()
+        rows = self.query()
+        self.lock.acquire()
+        try:
+            previous = self.entries
+            self.clear()
+            for (id, request_group_id, platform_id, browser_group_id,
+                 major, minor, priority, locked,
+                 width, bits_per_pixel, javascript_id, java_id, flash_id,
+                 own_factories_only, user_id, submitted, expire) in rows:
+                own_user_id = None
+                if own_factories_only:
+                    own_user_id = user_id
+                self.add(PendingRequest(
+                    id, request_group_id,
+                    (platform_id, browser_group_id),
+                    (major, minor, width, bits_per_pixel,
+                     javascript_id, java_id, flash_id),
+                    priority, submitted, expire, locked, own_user_id))
+            for entry in previous.itervalues():
+                if entry.changed > started:
+                    self.add(entry)
+            # Wake up long polls for requests from other processes
+            for bucket in set([entry.bucket
+                               for entry in self.entries.itervalues()
+                               if entry.id not in previous]):
+                self.notify(bucket)
+            self.loaded = time.time()
+        finally:
+            self.lock.release()
+
+    def refresh(self):
+        """
+        Reload from the database if the index is older than
+        REFRESH_INTERVAL seconds.
+        """
+        if self.loaded is None or time.time() - self.loaded > REFRESH_INTERVAL:
+            self.load()
+
+    def find(self, capabilities, admin_id, lock_timeout):
+        """
+        Get the id of the best matching request for a factory, or
+        None if there is no match. Requests that are reserved for the
+        factory admin's own factories take precedence.
+        """
+        now = datetime.now()
+        expired = []
+        best_own = best_other = None
+        widths = capabilities['widths']
+        depths = capabilities['depths']
+        self.lock.acquire()
+        try:
+            for browser in capabilities['browsers']:
+                for platform_id in (capabilities['platform'], None):
+                    keys = self.buckets.get(
+                        (platform_id, browser['browser_group_id']))
+                    if not keys:
+                        continue
+                    for features, entries in keys.iteritems():
+                        if not compatible(features, browser, widths, depths):
+                            continue
+                        own, other = self.first_available(
+                            entries, admin_id, now, lock_timeout, expired)
+                        if own is not None and (
+                            best_own is None or own < best_own):
+                            best_own = own
+                        if other is not None and (
+                            best_other is None or other < best_other):
+                            best_other = other
+            for entry in expired:
+                self.discard(entry.id)
+        finally:
+            self.lock.release()
+        best = best_own or best_other
+        if best is not None:
+            return best.id
+
+    def first_available(self, entries, admin_id, now, lock_timeout,
+                        expired):
+        """
+        Find the first unlocked entry in a sorted list, separately for
+        requests reserved to this admin and for public requests.
+        """
+        own = other = None
+        for entry in entries:
+            if entry.expire <= now:
+                expired.append(entry)
+                continue
+            if entry.locked is not None and entry.locked >= lock_timeout:
+                continue
+            if entry.own_user_id is None:
+                if other is None:
+                    other = entry
+            elif entry.own_user_id == admin_id:
+                if own is None:
+                    own = entry
+            if other is not None and own is not None:
+                break
+        return own, other
+
+
+def capability_buckets(capabilities):
+    """
+    Get the index buckets that a factory can serve.
+
+    >>> capability_buckets({'platform': 2, 'browsers': [
+    ...     {'browser_group_id': 1}, {'browser_group_id': 3}]})
+    [(2, 1), (None, 1), (2, 3), (None, 3)]
+    """
+    buckets = []
+    for browser in capabilities['browsers']:
+        for platform_id in (capabilities['platform'], None):
+            buckets.append((platform_id, browser['browser_group_id']))
+    return buckets
+
+
+pending_index = PendingIndex()
+
+
+def request_saved(sender, instance, created, **kwargs):
+    """
+    Signal handler to add new requests to the index. Inside a managed
+    transaction, wait until PendingIndexMiddleware sees the commit.
+    """
+    if not created:
+        return
+    if transaction.is_managed():
+        pending_index.defer_request(instance)
+    else:
+        pending_index.add_request(instance)
+
+
+class PendingIndexMiddleware(object):
+    """
+    Add new requests to the index after the transaction is committed.
+    Must be listed before TransactionMiddleware in MIDDLEWARE_CLASSES,
+    so that process_response runs after the commit.
+    """
+
+    def process_response(self, request, response):
+        """Publish requests from the committed transaction."""
+        pending_index.publish()
+        return response
+
+    def process_exception(self, request, exception):
+        """The transaction is rolled back, forget its requests."""
+        pending_index.forget()
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -23,6 +23,7 @@ __date__ = "$Date$"
 __author__ = "$Author$"
 
 import os
+import time
 from md5 import md5
 from datetime import datetime, timedelta
 from psycopg import IntegrityError
@@ -37,6 +38,11 @@ from shotserver04.browsers.models import Engine, BrowserGroup, Browser
 from shotserver04.websites.models import Domain, Website
 from shotserver04.requests.models import RequestGroup, Request
 from shotserver04.requests import xmlrpc as requests
+from shotserver04.requests.pending import PendingIndex, PendingRequest
+from shotserver04.requests.pending import capability_buckets
+from shotserver04.common.admission import AdmissionController
+from shotserver04.requests.usage import UsageCounters, request_keys
+from shotserver04.requests.usage import BUCKET_SECONDS
 from shotserver04.nonces import xmlrpc as nonces
 from shotserver04.factories import xmlrpc as factories
 
@@ -135,3 +141,241 @@ class PollTestCase(TestCase):
             transaction.rollback()
             if fault.faultString != 'No matching request.':
                 raise
+
+    def testLongPoll(self):
+        # A matching request is returned right away.
+        try:
+            result = requests.longPoll(self.http_request, self.factory,
+                                       self.encrypted_password(), 10)
+        except Fault, fault:
+            transaction.rollback()
+            raise
+        # Wait a second for another request, then give up.
+        try:
+            result = requests.longPoll(self.http_request, self.factory,
+                                       self.encrypted_password(), 1)
+            self.fail("Unexpected matching request.")
+        except Fault, fault:
+            transaction.rollback()
+            if fault.faultString != 'No matching request.':
+                raise
+
+
+class FakeRequestGroup:
+    id = 1
+    width = bits_per_pixel = None
+    javascript_id = java_id = flash_id = None
+    own_factories_only = False
+    user_id = 1
+    submitted = datetime.now()
+    expire = submitted + timedelta(minutes=30)
+
+
+class FakeRequest:
+    major = minor = locked = None
+    priority = 0
+    platform_id = 1
+    request_group = FakeRequestGroup()
+
+    def __init__(self, id, browser_group_id):
+        self.id = id
+        self.browser_group_id = browser_group_id
+
+
+class PendingIndexTestCase(TestCase):
+
+    def setUp(self):
+        self.index = PendingIndex()
+        self.now = datetime.now()
+        self.capabilities = {
+            'platform': 1,
+            'widths': set([1024]),
+            'depths': set([24]),
+            'browsers': [{'browser_group_id': 1, 'major': 2, 'minor': 0,
+                          'javascript_id': 3, 'java_id': 1, 'flash_id': 5}],
+            }
+
+    def add(self, id, priority=0, minutes=0, own_user_id=None, **features):
+        self.index.add(PendingRequest(
+            id, 1, (1, features.get('browser_group', 1)),
+            (features.get('major'), features.get('minor'),
+             features.get('width'), features.get('bits_per_pixel'),
+             features.get('javascript'), features.get('java'),
+             features.get('flash')),
+            priority, self.now + timedelta(minutes=minutes),
+            self.now + timedelta(minutes=30), None, own_user_id))
+
+    def find(self, admin_id=1):
+        return self.index.find(self.capabilities, admin_id,
+                               self.now - timedelta(minutes=5))
+
+    def testEmpty(self):
+        self.assertEqual(self.find(), None)
+
+    def testOrder(self):
+        self.add(1, minutes=2)
+        self.add(2, minutes=1)
+        self.add(3, priority=1, minutes=3)
+        self.assertEqual(self.find(), 3)
+        self.index.lock_request(3, self.now)
+        self.assertEqual(self.find(), 2)
+        self.index.discard(2)
+        self.assertEqual(self.find(), 1)
+
+    def testFeatures(self):
+        self.add(1, browser_group=2)
+        self.add(2, major=3)
+        self.add(3, width=800)
+        self.add(4, javascript=4)
+        self.assertEqual(self.find(), None)
+        self.add(5, major=2, minor=0, width=1024, bits_per_pixel=24,
+                 javascript=2, java=1, flash=5)
+        self.assertEqual(self.find(), 5)
+
+    def testOwnFactoriesOnly(self):
+        self.add(1)
+        self.add(2, minutes=1, own_user_id=1)
+        self.add(3, own_user_id=2)
+        self.assertEqual(self.find(admin_id=1), 2)
+        self.assertEqual(self.find(admin_id=2), 3)
+        self.assertEqual(self.find(admin_id=3), 1)
+
+    def testExpire(self):
+        self.add(1)
+        self.index.expire_group(1, self.now)
+        self.assertEqual(self.find(), None)
+        self.assertEqual(self.index.entries, {})
+
+    def testWaiter(self):
+        buckets = capability_buckets(self.capabilities)
+        event = self.index.add_waiter(buckets)
+        self.index.add_request(FakeRequest(1, browser_group_id=2))
+        self.assertFalse(event.isSet())
+        self.index.add_request(FakeRequest(2, browser_group_id=1))
+        self.assertTrue(event.isSet())
+        self.index.remove_waiter(buckets, event)
+        self.assertEqual(self.index.waiters, {})
+
+    def testDeferred(self):
+        buckets = capability_buckets(self.capabilities)
+        event = self.index.add_waiter(buckets)
+        self.index.defer_request(FakeRequest(1, browser_group_id=1))
+        self.assertFalse(event.isSet())
+        self.assertEqual(self.find(), None)
+        self.index.publish()
+        self.assertTrue(event.isSet())
+        self.assertEqual(self.find(), 1)
+        self.index.defer_request(FakeRequest(2, browser_group_id=1))
+        self.index.forget()
+        self.index.publish()
+        self.assertEqual(self.index.entries.keys(), [1])
+        self.index.remove_waiter(buckets, event)
+
+    def testLoadWhileChanging(self):
+        self.add(1)
+        row = (1, 1, 1, 1, None, None, 0, None,
+               None, None, None, None, None,
+               False, None, self.now, self.now + timedelta(minutes=30))
+
+        def query():
+            # Other threads add and lock requests during the query
+            self.add(2, minutes=1)
+            self.index.lock_request(1, self.now)
+            return [row]
+
+        self.index.query = query
+        self.index.load()
+        self.assertEqual(sorted(self.index.entries.keys()), [1, 2])
+        self.assertEqual(self.index.entries[1].locked, self.now)
+        self.assertEqual(self.find(), 2)
+
+
+class AdmissionTestCase(TestCase):
+
+    def setUp(self):
+        self.controller = AdmissionController(
+            max_in_flight=2, target_latency=0.5, acceptable_load=1e6,
+            max_waiting=2)
+
+    def testIdle(self):
+        self.assertTrue(self.controller.load_factor() < 0.01)
+        self.controller.check(rand=lambda: 1.0)
+
+    def testInFlight(self):
+        for index in range(4):
+            self.controller.begin('poll')
+        self.assertEqual(self.controller.load_factor(), 2.0)
+        self.controller.check(rand=lambda: 0.5)
+        self.controller.check(priority=True, rand=lambda: 1.0)
+        try:
+            self.controller.check(rand=lambda: 1.0)
+            self.fail("Expected overload fault.")
+        except Fault, fault:
+            self.assertEqual(fault.faultCode, 503)
+            self.assertTrue('try again in 90 seconds' in fault.faultString)
+        for index in range(4):
+            self.controller.end('poll')
+        self.assertTrue(self.controller.load_factor() < 0.01)
+
+    def testWaiting(self):
+        self.controller.begin_wait()
+        self.assertEqual(self.controller.load_factor(), 0.5)
+        self.controller.begin_wait()
+        try:
+            self.controller.begin_wait(rand=lambda: 0.5)
+            self.fail("Expected overload fault.")
+        except Fault, fault:
+            self.assertEqual(fault.faultCode, 503)
+            self.assertTrue('try again in 45 seconds' in fault.faultString)
+        self.assertEqual(self.controller.in_flight, {'wait': 2})
+        self.controller.end('wait')
+        self.controller.end('wait')
+        self.assertTrue(self.controller.load_factor() < 0.01)
+
+    def testLatency(self):
+        slow = self.controller.track('poll', measure=True)(
+            lambda: time.sleep(0.1))
+        slow()
+        self.assertTrue(0.01 < self.controller.latency < 0.1)
+        self.assertEqual(self.controller.in_flight, {'poll': 0})
+
+
+class FakeCache(dict):
+
+    def add(self, key, value, timeout=None):
+        self.setdefault(key, value)
+
+    def set(self, key, value, timeout=None):
+        self[key] = value
+
+    def get_many(self, keys):
+        return dict([(key, self[key]) for key in keys if key in self])
+
+
+class UsageCountersTestCase(TestCase):
+
+    def setUp(self):
+        self.counters = UsageCounters(FakeCache())
+        self.start = 1000 * BUCKET_SECONDS
+        self.day = 24 * BUCKET_SECONDS
+
+    def testNotCovered(self):
+        self.counters.add(['ip=1.2.3.4'], now=self.start)
+        self.assertEqual(
+            self.counters.count('ip=1.2.3.4', now=self.start + 60), None)
+
+    def testWindow(self):
+        keys = request_keys(12, 4, 3, '1.2.3.4')
+        self.counters.add(keys, now=self.start)
+        self.counters.add(keys, amount=4, now=self.start + self.day / 2)
+        now = self.start + self.day
+        self.assertEqual(self.counters.count('website=12,user=3', now), 5)
+        self.assertEqual(self.counters.count('domain=4', now), 5)
+        self.assertEqual(self.counters.count('website=13', now), 0)
+        # The oldest bucket slides out of the window
+        now += BUCKET_SECONDS / 4
+        self.assertEqual(self.counters.count('user=3', now), 5)
+        now += BUCKET_SECONDS / 2
+        self.assertEqual(self.counters.count('user=3', now), 4)
+        now += BUCKET_SECONDS
+        self.assertEqual(self.counters.count('user=3', now), 4)
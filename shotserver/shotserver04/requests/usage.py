@@ -0,0 +1,151 @@
+# browsershots.org - Test your web design in different browsers
+# Copyright (C) 2007 Johann C. Rocholl <johann@browsershots.org>
+#
+# Browsershots is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Browsershots is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Sliding-window counters for the daily usage limits.
+
+Each new screenshot request increments hourly buckets in the cache,
+for its website, domain, and user or IP address. The number of
+requests in the last 24 hours is the sum of the last 24 buckets, plus
+the part of the oldest bucket that is still inside the window.
+
+The counters are only trusted if the cache is shared by all server
+processes and has been counting for at least 24 hours. Otherwise,
+count returns None and the caller falls back to a database query.
+"""
+
+__revision__ = "$Rev$"
+__date__ = "$Date$"
+__author__ = "$Author$"
+
+import time
+from django.conf import settings
+from django.core.cache import cache
+
+BUCKET_SECONDS = 3600 # one counter per hour and key
+WINDOW_BUCKETS = 24 # the usage limits are per day
+KEY_FORMAT = 'usage:%s:%d' # e.g. usage:website=123:398765
+STARTED_KEY = 'usage:started' # when the counters were first used
+STARTED_TIMEOUT = 30 * 24 * 3600 # longest memcached expiration time
+TIMEOUT = (WINDOW_BUCKETS + 2) * BUCKET_SECONDS
+# Counters in a per-process cache would miss other processes.
+USE_USAGE_COUNTERS = not settings.CACHE_BACKEND.startswith(
+    ('locmem:', 'dummy:', 'simple:'))
+
+
+def usage_key(website=None, domain=None, user=None, ip=None):
+    """
+    Make a counter key for a combination of limit criteria.
+
+    >>> usage_key(website=12, user=3)
+    'website=12,user=3'
+    >>> usage_key(ip='127.0.0.1')
+    'ip=127.0.0.1'
+    """
+    parts = []
+    for name, value in (('website', website), ('domain', domain),
+                        ('user', user), ('ip', ip)):
+        if value is not None:
+            parts.append('%s=%s' % (name, getattr(value, 'id', value)))
+    return ','.join(parts)
+
+
+def request_keys(website_id, domain_id, user_id, ip):
+    """
+    Get all counter keys that a new request counts for, as used by
+    start.views.check_usage_limits.
+
+    >>> request_keys(12, 4, None, '127.0.0.1')
+    ['website=12', 'domain=4', 'ip=127.0.0.1']
+    """
+    keys = [usage_key(website=website_id), usage_key(domain=domain_id),
+            usage_key(ip=ip)]
+    if user_id is not None:
+        keys.extend([usage_key(website=website_id, user=user_id),
+                     usage_key(domain=domain_id, user=user_id),
+                     usage_key(user=user_id)])
+    return keys
+
+
+class UsageCounters:
+    """
+    Hourly request counters in the cache backend.
+    """
+
+    def __init__(self, backend=cache):
+        self.cache = backend
+
+    def add(self, keys, amount=1, now=None):
+        """
+        Count new requests. The cache has no atomic increment, so
+        concurrent submissions may rarely be undercounted.
+        """
+        if now is None:
+            now = time.time()
+        self.cache.add(STARTED_KEY, now, STARTED_TIMEOUT)
+        bucket = int(now // BUCKET_SECONDS)
+        cache_keys = [KEY_FORMAT % (key, bucket) for key in keys]
+        counts = self.cache.get_many(cache_keys)
+        for cache_key in cache_keys:
+            self.cache.set(cache_key, counts.get(cache_key, 0) + amount,
+                           TIMEOUT)
+
+    def covered(self, now):
+        """Check if the counters have been running for a full day."""
+        started = self.cache.get(STARTED_KEY)
+        return (started is not None and
+                started <= now - WINDOW_BUCKETS * BUCKET_SECONDS)
+
+    def count(self, key, now=None):
+        """
+        Estimate the number of requests in the last 24 hours, or
+        return None if the counters aren't reliable yet.
+        """
+        if now is None:
+            now = time.time()
+        if not self.covered(now):
+            return None
+        bucket = int(now // BUCKET_SECONDS)
+        oldest = bucket - WINDOW_BUCKETS
+        cache_keys = [KEY_FORMAT % (key, number)
+                      for number in range(oldest, bucket + 1)]
+        counts = self.cache.get_many(cache_keys)
+        total = 0.0
+        for cache_key in cache_keys[1:]:
+            total += counts.get(cache_key, 0)
+        # The oldest bucket is partly outside the window.
+        outside = (now % BUCKET_SECONDS) / float(BUCKET_SECONDS)
+        total += counts.get(cache_keys[0], 0) * (1.0 - outside)
+        return int(round(total))
+
+
+usage_counters = UsageCounters()
+
+
+def count_request(sender, instance, created, **kwargs):
+    """
+    Signal handler to count new requests.
+    """
+    if not created or not USE_USAGE_COUNTERS:
+        return
+    group = instance.request_group
+    usage_counters.add(request_keys(
+        group.website_id, group.website.domain_id, group.user_id, group.ip))
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -30,6 +30,7 @@ from django.shortcuts import render_to_response, get_object_or_404
 from django.utils.translation import ugettext as _
 from shotserver04.common import last_poll_timeout, error_page
 from shotserver04.requests.models import Request, RequestGroup
+from shotserver04.requests.pending import pending_index
 from shotserver04.platforms.models import Platform
 from shotserver04.factories.models import Factory
 from shotserver04.browsers.models import BrowserGroup, Browser
@@ -151,6 +152,7 @@ def extend(http_request):
     if 'cancel' in http_request.POST and http_request.POST['cancel']:
         if request_group.expire > datetime.now():
             request_group.update_fields(expire=datetime.now())
+            pending_index.expire_group(request_group.id, request_group.expire)
         return HttpResponseRedirect(request_group.website.get_absolute_url())
     if request_group.expire < datetime.now():
         delta = datetime.now() - request_group.expire
@@ -161,4 +163,5 @@ def extend(http_request):
                 urllib.quote(request_group.website.url.encode('utf-8')),
                 _("Request new screenshots?")))
     request_group.update_fields(expire=datetime.now() + timedelta(minutes=30))
+    pending_index.expire_group(request_group.id, request_group.expire)
     return HttpResponseRedirect(request_group.website.get_absolute_url())
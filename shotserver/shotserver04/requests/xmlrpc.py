@@ -22,55 +22,81 @@ __revision__ = "$Rev$"
 __date__ = "$Date$"
 __author__ = "$Author$"
 
-import os
-import random
+import time
 from xmlrpclib import Fault
-from django.db import models
+from django.db import models, connection, transaction
 from django.conf import settings
 from django.contrib.auth.models import User
-from shotserver04.common import serializable, int_or_none, lock_timeout
+from shotserver04.common import serializable, read_committed, LOCK_FREE
+from shotserver04.common import int_or_none, lock_timeout
 from shotserver04.common.object_cache import preload_foreign_keys
+from shotserver04.common.admission import admission
 from shotserver04.xmlrpc import signature, factory_xmlrpc
 from shotserver04.nonces import xmlrpc as nonces
 from shotserver04.websites import normalize_url, extract_domain
 from shotserver04.websites.models import Domain, Website
-from shotserver04.factories.models import Factory, ScreenSize, ColorDepth
+from shotserver04.factories.models import Factory
+from shotserver04.features import satisfies
 from shotserver04.platforms.models import Platform
-from shotserver04.browsers.models import BrowserGroup, Browser
+from shotserver04.browsers.models import BrowserGroup
 from shotserver04.requests.models import RequestGroup, Request
+from shotserver04.requests.pending import pending_index, capability_buckets
+from shotserver04.requests.pending import REFRESH_INTERVAL
 from datetime import datetime, timedelta
-# import time # For test_overload.py
 
 # Priority for e.g. Mac OS X because there are few factories.
 PRIORITY_PLATFORMS = []
-ACCEPTABLE_SERVER_LOAD = 8.0
+# Match requests in memory rather than with SQL (see pending.py).
+USE_PENDING_INDEX = True
+# Longest wait for requests.longPoll, each waiting factory keeps a
+# server thread busy. Override with settings.LONG_POLL_MAX_SECONDS.
+LONG_POLL_MAX_SECONDS = 60
 
 
-@serializable
-def find_and_lock_request(factory, features):
+def matching_requests(factory, features):
     """
-    Find a matching screenshot request and lock it.
+    Get matching screenshot requests, best first. Requests that are
+    reserved for the factory admin's own factories take precedence.
     """
-    # Find matching request
     now = datetime.now()
-    five_minutes_ago = now - timedelta(0, 300)
     matches = Request.objects.all()
     matches = matches.filter(features)
     matches = matches.filter(screenshot__isnull=True)
     matches = matches.filter(request_group__expire__gt=now)
     matches = matches.filter(
-        models.Q(locked__isnull=True) | models.Q(locked__lt=five_minutes_ago))
+        models.Q(locked__isnull=True) | models.Q(locked__lt=lock_timeout()))
     matches = matches.filter(priority__gte=0) # Ignore shock sites
     matches = matches.order_by(
         '-priority', 'requests_requestgroup.submitted')
     own_matches = matches.filter(
         request_group__own_factories_only=True,
         request_group__user=factory.admin_id)
+    other_matches = matches.filter(request_group__own_factories_only=False)
+    return own_matches, other_matches
+
+
+def find_and_lock_request(factory, features):
+    """
+    Find a matching screenshot request and lock it.
+    """
+    if LOCK_FREE:
+        return find_and_lock_request_skip_locked(factory, features)
+    else:
+        return find_and_lock_request_serializable(factory, features)
+
+
+@serializable
+def find_and_lock_request_serializable(factory, features):
+    """
+    Find a matching screenshot request and lock it, with transaction
+    isolation level serializable. Concurrent polls from different
+    factories may abort each other and will be retried.
+    """
+    own_matches, matches = matching_requests(factory, features)
     own_matches = own_matches[:1]
     if len(own_matches):
         matches = own_matches
     else:
-        matches = matches.filter(request_group__own_factories_only=False)
         matches = matches[:1]
     # time.sleep(0.1) # For test_overload.py
     if len(matches) == 0:
@@ -84,18 +110,96 @@ def find_and_lock_request(factory, features):
     return request
 
 
-def add_version(filters, value, name, exact=False):
+@read_committed
+def find_and_lock_request_skip_locked(factory, features):
     """
-    Update filters to get the browser for a matching request.
+    Find a matching screenshot request and lock it with a single
+    UPDATE statement. Rows that are being claimed by a concurrent
+    transaction are skipped, so polls never abort each other.
+    Needs PostgreSQL 9.5 or later for SKIP LOCKED.
     """
-    if value is None:
-        return
-    if hasattr(value, 'id'):
-        value = value.id
-    if value == 2 and not exact: # request for 'enabled'
-        filters[name + '__gte'] = 2 # match 'enabled' or version
-    else:
-        filters[name] = value # specific requested version
+    cursor = connection.cursor()
+    for matches in matching_requests(factory, features):
+        sql, params = matches.values('id')[:1].query.as_sql()
+        cursor.execute("""
+UPDATE requests_request SET factory_id = %s, browser_id = NULL, locked = %s
+WHERE id = (""" + sql + """ FOR UPDATE OF requests_request SKIP LOCKED)
+RETURNING id
+""", [factory.id, datetime.now()] + list(params))
+        row = cursor.fetchone()
+        if row is not None:
+            pending_index.lock_request(row[0], datetime.now())
+            return Request.objects.get(id=row[0])
+    raise Fault(204, 'No matching request.')
+
+
+@read_committed
+def claim_request(request_id, factory):
+    """
+    Lock a pending request with a single conditional UPDATE.
+    Return False if another factory was faster, or if the request
+    has been uploaded or expired in the meantime. Then update the
+    index entry, or remove it if the request is gone or closed.
+    """
+    now = datetime.now()
+    cursor = connection.cursor()
+    cursor.execute("""
+UPDATE requests_request SET factory_id = %s, browser_id = NULL, locked = %s
+WHERE id = %s
+AND screenshot_id IS NULL
+AND (locked IS NULL OR locked < %s)
+AND request_group_id IN (
+    SELECT id FROM requests_requestgroup WHERE expire > %s)
+""", [factory.id, now, request_id, lock_timeout(), now])
+    if cursor.rowcount == 1:
+        pending_index.lock_request(request_id, now)
+        return True
+    cursor.execute("""
+SELECT r.screenshot_id, r.locked, g.expire
+FROM requests_request r
+JOIN requests_requestgroup g ON g.id = r.request_group_id
+WHERE r.id = %s
+""", [request_id])
+    row = cursor.fetchone()
+    if row is None or row[0] is not None or row[2] <= now:
+        pending_index.discard(request_id)
+    elif row[1] is not None:
+        pending_index.lock_request(request_id, row[1])
+    return False
+
+
+def find_and_claim_request(factory):
+    """
+    Find a matching screenshot request in the pending index and lock
+    it. Same result as find_and_lock_request, without the big query.
+    """
+    pending_index.refresh()
+    capabilities = factory.capabilities()
+    tried = set()
+    while True:
+        request_id = pending_index.find(
+            capabilities, factory.admin_id, lock_timeout())
+        if request_id is None or request_id in tried:
+            raise Fault(204, 'No matching request.')
+        tried.add(request_id)
+        if claim_request(request_id, factory):
+            return Request.objects.get(id=request_id)
+
+
+def select_browser(capabilities, request):
+    """
+    Select a matching browser for this screenshot request.
+    """
+    request_group = request.request_group
+    for browser in capabilities['browsers']:
+        if (browser['browser_group_id'] == request.browser_group_id and
+            (request.major is None or browser['major'] == request.major) and
+            (request.minor is None or browser['minor'] == request.minor) and
+            satisfies(browser['javascript_id'], request_group.javascript_id)
+            and satisfies(browser['java_id'], request_group.java_id) and
+            satisfies(browser['flash_id'], request_group.flash_id)):
+            return browser
+    raise Fault(404, "No matching browser for selected request.")
 
 
 def version_or_empty(feature):
@@ -146,6 +250,46 @@ def poll(http_request, factory, encrypted_password):
     it is possible that somebody else will lock it. In this case, your
     upload will fail.
     """
+    check_poll(http_request, factory, encrypted_password)
+    return request_options(factory, find_request(factory))
+
+
+@factory_xmlrpc
+@signature(dict, str, str, int)
+def longPoll(http_request, factory, encrypted_password, seconds):
+    """
+    Wait until a matching screenshot request is available for a
+    given factory, but not longer than the given number of seconds.
+
+    Arguments
+    ~~~~~~~~~
+    * factory_name string (lowercase, normally from hostname)
+    * encrypted_password string (lowercase hexadecimal, length 32)
+    * seconds int (maximum wait, the server may limit it further)
+
+    Return value
+    ~~~~~~~~~~~~
+    * options dict (screenshot request configuration)
+
+    The options dict and the locking are the same as for
+    requests.poll. If no matching request is submitted before the
+    time is up, Fault 204 is raised, and the factory may call
+    requests.longPoll again right away.
+    If too many factories are waiting already, Fault 503 is raised
+    with a retry hint, as when the server is busy.
+    """
+    check_poll(http_request, factory, encrypted_password)
+    maximum = getattr(settings, 'LONG_POLL_MAX_SECONDS',
+                      LONG_POLL_MAX_SECONDS)
+    seconds = max(0, min(seconds, maximum))
+    return request_options(factory, wait_for_request(factory, seconds))
+
+
+def check_poll(http_request, factory, encrypted_password):
+    """
+    Verify authentication, update the last_poll timestamp, and make
+    sure that the factory isn't blocked and the server isn't busy.
+    """
     # Verify authentication
     nonces.verify(http_request, factory, encrypted_password)
     # Update last_poll timestamp
@@ -158,83 +302,121 @@ def poll(http_request, factory, encrypted_password):
                 raise Fault(205, ' '.join((
 "Sorry, your screenshot factory is blocked for a few minutes.",
 "Please check your email for error messages from Browsershots.")))
-    # Check server load
-    randomized_load = max(os.getloadavg()) * random.random()
-    if factory.operating_system.platform_id in PRIORITY_PLATFORMS:
-        randomized_load /= 2
-    if randomized_load > ACCEPTABLE_SERVER_LOAD:
-        raise Fault(503,
-"The server is currently overloaded. Please try again in a minute.")
-    # Get matching request
-    request = find_and_lock_request(factory, factory.features_q())
-    # Get matching browser
-    filters = {'factory': factory,
-               'browser_group': request.browser_group,
-               'active': True}
-    add_version(filters, request.major, 'major', exact=True)
-    add_version(filters, request.minor, 'minor', exact=True)
-    add_version(filters, request.request_group.javascript, 'javascript__id')
-    add_version(filters, request.request_group.java, 'java__id')
-    add_version(filters, request.request_group.flash, 'flash__id')
+    # Check server capacity, raise Fault 503 with a retry hint
+    admission.check(
+        factory.operating_system.platform_id in PRIORITY_PLATFORMS)
+
+
+@admission.track('poll', measure=True)
+def find_request(factory):
+    """
+    Find and lock a matching screenshot request, or raise Fault 204.
+    """
+    if USE_PENDING_INDEX:
+        return find_and_claim_request(factory)
+    return find_and_lock_request(factory, factory.features_q())
+
+
+def wait_for_request(factory, seconds):
+    """
+    Find and lock a matching screenshot request, and wait for new
+    requests in the pending index if there is none yet. Requests
+    submitted to other server processes are found when the index
+    is reloaded, so check again every REFRESH_INTERVAL seconds.
+    While waiting, the long poll counts as in flight for admission
+    control, and Fault 503 is raised if too many are waiting.
+    """
+    deadline = time.time() + seconds
+    buckets = capability_buckets(factory.capabilities())
+    event = pending_index.add_waiter(buckets)
+    waiting = False
     try:
-        browser = Browser.objects.select_related().get(**filters)
-    except Browser.DoesNotExist:
-        raise Fault(404, "No matching browser for selected request.")
-    # Build result dict
-    screen_size = select_screen_size(factory, request)
-    color_depth = select_color_depth(factory, request)
+        while True:
+            event.clear()
+            try:
+                return find_request(factory)
+            except Fault, fault:
+                if fault.faultCode != 204:
+                    raise
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise fault
+            if not waiting:
+                admission.begin_wait()
+                waiting = True
+            # Don't keep the factory row locked while waiting
+            if transaction.is_dirty():
+                transaction.commit()
+            else:
+                transaction.rollback()
+            event.wait(min(remaining, REFRESH_INTERVAL))
+    finally:
+        if waiting:
+            admission.end('wait')
+        pending_index.remove_waiter(buckets, event)
+
+
+def request_options(factory, request):
+    """
+    Get the configuration for a locked screenshot request.
+    """
+    # Get matching browser, screen size and color depth
+    capabilities = factory.capabilities()
+    browser = select_browser(capabilities, request)
+    width, height = select_screen_size(capabilities, request)
     return {
         'request': request.id,
-        'browser': browser.browser_group.name,
-        'version': browser.version,
-        'major': browser.major,
-        'minor': browser.minor,
-        'command': browser.command,
-        'width': screen_size.width,
-        'height': screen_size.height,
-        'bpp': color_depth.bits_per_pixel,
+        'browser': browser['name'],
+        'version': browser['version'],
+        'major': browser['major'],
+        'minor': browser['minor'],
+        'command': browser['command'],
+        'width': width,
+        'height': height,
+        'bpp': select_color_depth(capabilities, request),
         'javascript': version_or_empty(request.request_group.javascript),
         'java': version_or_empty(request.request_group.java),
         'flash': version_or_empty(request.request_group.flash),
         }
 
 
-def select_screen_size(factory, request):
+def select_screen_size(capabilities, request):
     """
-    Select a matching screen size for this screenshot request.
+    Select a matching screen size (width, height) for this request.
     """
-    screen_sizes = ScreenSize.objects.filter(factory=factory)
+    screen_sizes = capabilities['screen_sizes']
     if request.request_group.width:
-        screen_sizes = screen_sizes.filter(width=request.request_group.width)
+        screen_sizes = [(width, height) for width, height in screen_sizes
+                        if width == request.request_group.width]
     if request.request_group.height:
-        screen_sizes = screen_sizes.filter(height=request.request_group.height)
+        screen_sizes = [(width, height) for width, height in screen_sizes
+                        if height == request.request_group.height]
     # Fallback to default size if factory configuration incomplete
     if not len(screen_sizes):
-        return ScreenSize(factory=factory, width=1024, height=768)
+        return (1024, 768)
     # Try most popular screen sizes first
     if len(screen_sizes) > 1:
         for popular in (1024, 800, 1152, 1280, 640):
             for screen_size in screen_sizes:
-                if screen_size.width == popular:
+                if screen_size[0] == popular:
                     return screen_size
     # Return the smallest matching screen size
     return screen_sizes[0]
 
 
-def select_color_depth(factory, request):
+def select_color_depth(capabilities, request):
     """
-    Select a matching color depth for this screenshot request.
+    Select a matching color depth (bits per pixel) for this request.
     """
-    color_depths = ColorDepth.objects.filter(factory=factory)
-    color_depths = color_depths.order_by('-bits_per_pixel')
+    color_depths = capabilities['depths']
     if request.request_group.bits_per_pixel:
-        color_depths = color_depths.filter(
-            bits_per_pixel=request.request_group.bits_per_pixel)
+        color_depths = [bits_per_pixel for bits_per_pixel in color_depths
+            if bits_per_pixel == request.request_group.bits_per_pixel]
     # Fallback to default depth if factory configuration incomplete
     if not len(color_depths):
-        return ColorDepth(factory=factory, bits_per_pixel=24)
+        return 24
     # Return greatest matching color depth
-    return color_depths[0]
+    return max(color_depths)
 
 
 def find_by_name(candidates, name):
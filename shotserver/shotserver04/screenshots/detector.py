@@ -0,0 +1,362 @@
+# browsershots.org - Test your web design in different browsers
+# Copyright (C) 2007 Johann C. Rocholl <johann@browsershots.org>
+#
+# Browsershots is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Browsershots is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Detect known problems in screenshots, like dialog boxes in front of
+the browser window, or a blank screen.
+
+This does the same as the ppmfg | pbmgrep pipeline (see the pbmgrep
+folder in the source tree), but in-process, one scanline at a time:
+
+* Foreground: each 12x12 block is converted to greyscale, and pixels
+  that differ from the most frequent grey value are foreground.
+* Features: small PBM images of known dialog texts are indexed by the
+  32 pixels at the start of their bottom row, like the multimap in
+  pbmgrep.cpp. Candidate positions are found with str.find on rows of
+  '0' and '1' characters, and then the whole feature is compared.
+* Blank screen checks for error codes 701 to 704.
+
+The feature set is loaded once per process and shared by all uploads.
+"""
+
+__revision__ = "$Rev$"
+__date__ = "$Date$"
+__author__ = "$Author$"
+
+import os
+import re
+import glob
+import threading
+
+SQUARE_SIZE = 12 # pixels per side of foreground blocks, like ppmfg
+BOTTOM_ROWS = 8
+TASK_BAR = 40 # pixels at the bottom, ignored by blank checks
+FEATURE_PATTERN = '6??_*.pbm'
+BLANK_WORDS = set(['0' * 32, '0001' * 8, '0010' * 8, '0100' * 8,
+                   '1000' * 8, '01' * 16, '10' * 16])
+
+split_pixels = re.compile('...', re.DOTALL).findall
+pbm_token = re.compile(r'(?:\s+|#[^\n]*)*(\S+)').match
+
+
+class LuminanceCache(dict):
+    """
+    Map RGB pixels (strings of three bytes) to greyscale characters,
+    computed like PPM_LUMIN in netpbm.
+    """
+
+    def __missing__(self, rgb):
+        red, green, blue = [ord(byte) for byte in rgb]
+        grey = chr(int(0.299 * red + 0.587 * green + 0.114 * blue))
+        self[rgb] = grey
+        return grey
+
+
+def signed_char(char):
+    """
+    Sort key like the C type char, which ppmfg uses to break ties.
+
+    >>> [signed_char(c) for c in '\\x00\\x7f\\x80\\xff']
+    [0, 127, -128, -1]
+    """
+    value = ord(char)
+    if value >= 128:
+        value -= 256
+    return value
+
+
+# Translation tables: the given grey value becomes '0', all others '1'.
+FOREGROUND_TABLES = [''.join([('1', '0')[value == index]
+                              for value in range(256)])
+                     for index in range(256)]
+
+
+BYTE_BITS = [''.join([str((value >> bit) & 1) for bit in range(7, -1, -1)])
+             for value in range(256)]
+
+
+def read_pbm(filename):
+    """
+    Read a PBM file. Return width, height and rows as strings of '0'
+    and '1' characters, where '1' is black.
+    """
+    data = file(filename, 'rb').read()
+    tokens = []
+    pos = 0
+    while len(tokens) < 3:
+        match = pbm_token(data, pos)
+        if match is None:
+            raise ValueError("%s: incomplete PBM header" % filename)
+        tokens.append(match.group(1))
+        pos = match.end()
+    magic, width, height = tokens[0], int(tokens[1]), int(tokens[2])
+    rows = []
+    if magic == 'P4':
+        pos += 1 # Single whitespace after header
+        row_bytes = (width + 7) / 8
+        for y in range(height):
+            row = data[pos + y * row_bytes:pos + (y + 1) * row_bytes]
+            if len(row) < row_bytes:
+                raise ValueError("%s: not enough pixel data" % filename)
+            bits = ''.join([BYTE_BITS[ord(byte)] for byte in row])
+            rows.append(bits[:width])
+    elif magic == 'P1':
+        bits = re.sub(r'#[^\n]*|\s', '', data[pos:])
+        for y in range(height):
+            rows.append(bits[y * width:(y + 1) * width])
+    else:
+        raise ValueError("%s: unsupported PBM format %s" % (filename, magic))
+    return width, height, rows
+
+
+def problem_from_filename(filename):
+    """
+    Get error code and message from a feature filename.
+
+    >>> problem_from_filename('/x/651_You_have_requested_a_page.Mac.pbm')
+    (651, 'You have requested a page.')
+    """
+    name = os.path.basename(filename).split('.')[0]
+    parts = name.split('_')
+    message = ' '.join(parts[1:]) + '.'
+    return int(parts[0]), message[:1].upper() + message[1:]
+
+
+class Feature:
+    """
+    A known dialog text, from a PBM file.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.cols, self.rows, self.bits = read_pbm(filename)
+        self.cols32 = (self.cols + 31) / 32
+        self.bottom_left = self.bits[-1][:32].ljust(32, '0')
+        self.code, self.message = problem_from_filename(filename)
+
+    def match(self, window, x):
+        """
+        Check if the feature is in the window of scanlines (bottom row
+        last) at horizontal position x.
+        """
+        cols = self.cols
+        offset = len(window) - self.rows
+        for row, bits in enumerate(self.bits):
+            if window[offset + row][x:x + cols] != bits:
+                return False
+        return True
+
+
+class FeatureIndex:
+    """
+    All features, keyed by the bottom left 32 pixels.
+    """
+
+    def __init__(self, filenames):
+        self.features = {}
+        self.max_rows = 0
+        filenames = list(filenames)
+        filenames.sort()
+        for filename in filenames:
+            feature = Feature(filename)
+            if '1' not in feature.bottom_left:
+                continue # Never matches, like in pbmgrep.cpp
+            self.features.setdefault(feature.bottom_left, []).append(feature)
+            self.max_rows = max(self.max_rows, feature.rows)
+        self.keys = self.features.keys()
+        self.keys.sort()
+
+    def __len__(self):
+        return sum([len(features) for features in self.features.values()])
+
+    def candidates(self, bits):
+        """
+        Find all positions in a scanline where the bottom left of a
+        feature matches. Return a sorted list of (x, key).
+        """
+        result = []
+        for key in self.keys:
+            x = bits.find(key)
+            while x != -1:
+                result.append((x, key))
+                x = bits.find(key, x + 1)
+        result.sort()
+        return result
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def load_features(folder, pattern=FEATURE_PATTERN):
+    """
+    Load and index all feature files in a folder, only once per process.
+    """
+    _indexes_lock.acquire()
+    try:
+        key = (folder, pattern)
+        if key not in _indexes:
+            _indexes[key] = FeatureIndex(
+                glob.glob(os.path.join(folder, pattern)))
+        return _indexes[key]
+    finally:
+        _indexes_lock.release()
+
+
+class Detector:
+    """
+    Check a screenshot for known problems, one RGB scanline at a time.
+    After close, the result attribute is None if nothing was found, or
+    a tuple (code, message, x, y, width, height).
+    """
+
+    def __init__(self, width, height, index):
+        self.width = width
+        self.height = height
+        self.index = index
+        self.cols32 = width / 32
+        self.aligned = self.cols32 * 32
+        self.cycle_rows = max(BOTTOM_ROWS, index.max_rows)
+        self.window = []
+        self.strip = []
+        self.luminance = LuminanceCache()
+        self.y = 0
+        self.result = None
+        self.vertical = 0
+        self.pattern_background = True
+        self.left_background = True
+        self.right_background = True
+
+    def add_row(self, row):
+        """Add the next decoded RGB scanline."""
+        if self.result is not None:
+            return # Already found a problem
+        data = row.tostring()
+        if data == data[:3] * self.width:
+            grey = self.luminance[data[:3]] * self.width
+        else:
+            grey = ''.join(map(self.luminance.__getitem__,
+                               split_pixels(data)))
+        self.strip.append(grey)
+        if len(self.strip) == SQUARE_SIZE:
+            self.process_strip()
+
+    def process_strip(self):
+        """
+        Find foreground pixels in a strip of scanlines, and scan them.
+        """
+        strip = self.strip
+        self.strip = []
+        segments = [[] for grey in strip]
+        for x in range(0, self.width, SQUARE_SIZE):
+            parts = [grey[x:x + SQUARE_SIZE] for grey in strip]
+            block = ''.join(parts)
+            first = block[0]
+            if block.count(first) == len(block):
+                background = '0' * len(parts[0])
+                for bits in segments:
+                    bits.append(background)
+                continue
+            most = None
+            for char in set(block):
+                key = (-block.count(char), signed_char(char))
+                if most is None or key < most:
+                    most = key
+                    char_most = char
+            table = FOREGROUND_TABLES[ord(char_most)]
+            for part, bits in zip(parts, segments):
+                bits.append(part.translate(table))
+        for bits in segments:
+            if self.result is None:
+                self.scan(''.join(bits))
+
+    def scan(self, bits):
+        """
+        Look for features that end in this row of foreground pixels,
+        and collect statistics for the blank screen checks.
+        """
+        y = self.y
+        self.y += 1
+        window = self.window
+        window.append(bits)
+        if len(window) > self.cycle_rows:
+            del window[0]
+        aligned = bits[:self.aligned]
+        if y >= 4 and self.pattern_background:
+            if aligned != window[-5][:self.aligned]:
+                self.pattern_background = False
+        if 4 < y < self.height - TASK_BAR and self.cols32:
+            if '1' in aligned:
+                self.vertical |= int(aligned, 2)
+            previous = window[-5]
+            self.left_background = (self.left_background and
+                                    aligned[:32] == previous[:32])
+            self.right_background = (self.right_background and
+                aligned[-32:] == previous[self.aligned - 32:self.aligned])
+        if '1' not in bits:
+            return
+        for x, key in self.index.candidates(bits):
+            for feature in self.index.features[key]:
+                if y < feature.rows - 1:
+                    continue
+                if x / 32 >= self.cols32 - feature.cols32:
+                    continue
+                if feature.match(window, x):
+                    self.result = (feature.code, feature.message,
+                        x, y - feature.rows + 1, feature.cols, feature.rows)
+                    return
+
+    def close(self):
+        """Process the last rows and run the blank screen checks."""
+        if self.strip and self.result is None:
+            self.process_strip()
+        if self.result is None:
+            self.result = self.check_blank()
+
+    def abort(self):
+        """Stop checking."""
+        self.strip = []
+        self.window = []
+
+    def check_blank(self):
+        """
+        Check if the screen is blank, or the left, right or bottom side.
+        """
+        width, height, cols32 = self.width, self.height, self.cols32
+        if not cols32:
+            return None
+        totally_blank = height > TASK_BAR and self.vertical == 0
+        if totally_blank or self.pattern_background:
+            return (701, "The screen is blank.", 0, 0, width, height)
+        left = self.vertical >> (32 * (cols32 - 1))
+        right = self.vertical & 0xffffffffL
+        if height > TASK_BAR and (left == 0 or self.left_background):
+            return (702, "The left side of the screen is blank.",
+                    0, 0, 32, height)
+        if height > TASK_BAR and (right == 0 or self.right_background):
+            return (703, "The right side of the screen is blank.",
+                    32 * (cols32 - 1), 0, 32, height)
+        for bits in self.window[-BOTTOM_ROWS:]:
+            for x in range(0, self.aligned, 32):
+                if bits[x:x + 32] not in BLANK_WORDS:
+                    return None
+        return (704, "The bottom of the screen is blank.",
+                0, height - 4, width, 4)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
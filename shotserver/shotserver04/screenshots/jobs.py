@@ -0,0 +1,232 @@
+# browsershots.org - Test your web design in different browsers
+# Copyright (C) 2007 Johann C. Rocholl <johann@browsershots.org>
+#
+# Browsershots is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Browsershots is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Queue for work after screenshot upload.
+
+Each job is a small text file in PNG_ROOT/queue, named after the
+screenshot hashkey. It lists the remaining tasks, one per line:
+
+previews 512 160
+s3 original 512 160
+
+The worker process (shotserver04_worker.py) runs the tasks in order
+and removes each task from the file when it is done, so that nothing
+is lost if the worker is restarted. Failed jobs are retried later,
+and moved to PNG_ROOT/queue/failed after too many attempts.
+"""
+
+__revision__ = "$Rev$"
+__date__ = "$Date$"
+__author__ = "$Author$"
+
+import os
+import time
+from xmlrpclib import Fault
+from django.conf import settings
+from shotserver04.screenshots import storage
+
+QUEUE_FOLDER = 'queue'
+FAILED_FOLDER = 'failed'
+MAX_ATTEMPTS = 10
+RETRY_DELAY = 60 # seconds, doubled after each failed attempt
+MAX_RETRY_DELAY = 3600 # seconds
+PERMANENT_FAULTS = (415, ) # Retry doesn't help if PNG file is broken
+
+
+def queue_path(folder=None):
+    """Get the full filesystem path for the job queue."""
+    path = os.path.join(settings.PNG_ROOT, QUEUE_FOLDER)
+    if folder:
+        path = os.path.join(path, folder)
+    return path
+
+
+def job_filename(hashkey, folder=None):
+    """Get the full filesystem path for a job file."""
+    return os.path.join(queue_path(folder), hashkey)
+
+
+def is_queued(hashkey):
+    """Check if there is unfinished work for a screenshot."""
+    return os.path.exists(job_filename(hashkey))
+
+
+def is_failed(hashkey):
+    """Check if a job was given up after too many attempts."""
+    return os.path.exists(job_filename(hashkey, FAILED_FOLDER))
+
+
+def retry_delay(attempts):
+    """
+    Seconds to wait before the next attempt.
+
+    >>> [retry_delay(attempts) for attempts in range(1, 8)]
+    [60, 120, 240, 480, 960, 1920, 3600]
+    """
+    return min(MAX_RETRY_DELAY, RETRY_DELAY * 2 ** (attempts - 1))
+
+
+class Job:
+    """
+    Remaining tasks for one uploaded screenshot.
+    """
+
+    def __init__(self, hashkey, tasks, attempts=0, retry=0):
+        self.hashkey = hashkey
+        self.tasks = tasks
+        self.attempts = attempts
+        self.retry = retry
+        self.transfers = []
+
+    def save(self):
+        """Write the job file atomically, or remove it if done."""
+        filename = job_filename(self.hashkey)
+        if not self.tasks:
+            if os.path.exists(filename):
+                os.unlink(filename)
+            return
+        storage.makedirs(queue_path())
+        lines = ['attempts %d' % self.attempts, 'retry %d' % self.retry]
+        lines.extend(self.tasks)
+        temp = filename + '.tmp'
+        outfile = file(temp, 'w')
+        outfile.write('\n'.join(lines) + '\n')
+        outfile.close()
+        os.rename(temp, filename)
+
+    def run(self):
+        """
+        Run the remaining tasks in order. If a task fails, schedule
+        another attempt (or give up) and raise the error again.
+        """
+        while self.tasks:
+            try:
+                self.transfers.extend(run_task(self.hashkey, self.tasks[0]))
+            except Fault, fault:
+                if fault.faultCode in PERMANENT_FAULTS:
+                    self.fail()
+                    raise
+                self.postpone()
+                raise
+            except Exception:
+                self.postpone()
+                raise
+            self.tasks.pop(0)
+            self.save()
+
+    def postpone(self):
+        """Schedule another attempt, or give up after MAX_ATTEMPTS."""
+        self.attempts += 1
+        if self.attempts >= MAX_ATTEMPTS:
+            self.fail()
+            return
+        self.retry = int(time.time()) + retry_delay(self.attempts)
+        self.save()
+
+    def fail(self):
+        """Move the job file to the failed folder."""
+        storage.makedirs(queue_path(FAILED_FOLDER))
+        self.save()
+        os.rename(job_filename(self.hashkey),
+                  job_filename(self.hashkey, FAILED_FOLDER))
+
+
+def submit(hashkey, preview_sizes, s3=False):
+    """
+    Queue previews and S3 upload for a new screenshot.
+    """
+    sizes = ' '.join([str(size) for size in preview_sizes])
+    tasks = ['previews ' + sizes]
+    if s3:
+        tasks.append('s3 %s %s' % (storage.ORIGINAL_SIZE, sizes))
+    job = Job(hashkey, tasks)
+    job.save()
+    return job
+
+
+def load(hashkey):
+    """Read a job file from the queue."""
+    attempts = retry = 0
+    tasks = []
+    for line in file(job_filename(hashkey)):
+        line = line.strip()
+        if line.startswith('attempts '):
+            attempts = int(line.split()[1])
+        elif line.startswith('retry '):
+            retry = int(line.split()[1])
+        elif line:
+            tasks.append(line)
+    return Job(hashkey, tasks, attempts, retry)
+
+
+def pending(now=None):
+    """
+    Get hashkeys of jobs that are ready to run, oldest first.
+    """
+    if now is None:
+        now = time.time()
+    path = queue_path()
+    if not os.path.isdir(path):
+        return []
+    candidates = []
+    for hashkey in os.listdir(path):
+        if len(hashkey) != 32:
+            continue # Failed folder or temporary file
+        try:
+            mtime = os.path.getmtime(job_filename(hashkey))
+        except OSError:
+            continue # Removed by another worker
+        candidates.append((mtime, hashkey))
+    candidates.sort()
+    result = []
+    for mtime, hashkey in candidates:
+        try:
+            job = load(hashkey)
+        except IOError:
+            continue
+        if job.retry <= now:
+            result.append(hashkey)
+    return result
+
+
+def run_task(hashkey, task):
+    """
+    Run one task from a job file. Return a list of S3 transfers.
+    """
+    parts = task.split()
+    if parts[0] == 'previews':
+        make_previews(hashkey, [int(size) for size in parts[1:]])
+        return []
+    elif parts[0] == 's3':
+        return storage.s3_upload(hashkey, parts[1:])
+    else:
+        raise Fault(400, "Unknown task %s." % parts[0])
+
+
+def make_previews(hashkey, sizes):
+    """
+    Decode the original PNG file and make all preview images.
+    """
+    width, height, rows = storage.decode(hashkey)
+    consumers = [storage.Preview(hashkey, size, width, height)
+                 for size in sizes]
+    storage.process(hashkey, rows, consumers)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -34,7 +34,7 @@ from django.contrib.auth.models import User
 from shotserver04.websites.models import Website
 from shotserver04.factories.models import Factory
 from shotserver04.browsers.models import Browser
-from shotserver04.screenshots import storage
+from shotserver04.screenshots import storage, jobs
 
 PROBLEM_CHOICES = {
     811: _("This is not the requested browser."),
@@ -144,7 +144,11 @@ class Screenshot(models.Model):
 
     def get_png_url(self, size='original'):
         """URL for screenshot images of different sizes."""
-        if (self.user_id is not None and
+        if jobs.is_queued(self.hashkey) or jobs.is_failed(self.hashkey):
+            # Previews or S3 upload not finished, use local files
+            if not os.path.exists(storage.png_filename(self.hashkey, size)):
+                size = storage.ORIGINAL_SIZE
+        elif (self.user_id is not None and
             self.uploaded > S3_DEPLOYMENT_DATE and
             hasattr(settings, 'S3_BUCKETS') and
             str(size) in settings.S3_BUCKETS):
@@ -0,0 +1,296 @@
+# browsershots.org - Test your web design in different browsers
+# Copyright (C) 2007 Johann C. Rocholl <johann@browsershots.org>
+#
+# Browsershots is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Browsershots is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Upload files to Amazon S3 in parallel over keep-alive connections.
+
+The client keeps a pool of open HTTP connections, so that uploading
+the original and all preview sizes doesn't need a new TCP connection
+for each file. Failed uploads are retried with exponential backoff.
+Each upload returns a Transfer object with throughput metrics.
+"""
+
+__revision__ = "$Rev$"
+__date__ = "$Date$"
+__author__ = "$Author$"
+
+import os
+import time
+import socket
+import httplib
+import urllib
+import threading
+from xmlrpclib import Fault
+from shotserver04.screenshots import s3
+
+CONCURRENCY = 4 # parallel uploads and open connections
+BUFFER_SIZE = 64 * 1024 # bytes per send call
+MAX_ATTEMPTS = 4 # per file
+BACKOFF = 1.0 # seconds before the first retry, doubled after each
+NETWORK_ERRORS = (socket.error, httplib.HTTPException)
+
+
+class Transfer:
+    """
+    Metrics for one uploaded file.
+    """
+
+    def __init__(self, bucket, key, filename):
+        self.bucket = bucket
+        self.key = key
+        self.filename = filename
+        self.bytes = 0
+        self.seconds = 0.0
+        self.attempts = 0
+
+    def throughput(self):
+        """Kilobytes per second."""
+        if not self.seconds:
+            return 0.0
+        return self.bytes / 1024.0 / self.seconds
+
+    def __str__(self):
+        return '%s/%s %d bytes in %.2f seconds (%.1f KB/s, %d attempts)' % (
+            self.bucket, self.key, self.bytes, self.seconds,
+            self.throughput(), self.attempts)
+
+
+class ConnectionPool:
+    """
+    Keep-alive HTTP connections to one server, shared by threads.
+    At most size connections are in use at the same time.
+    """
+
+    def __init__(self, host, port, size):
+        self.host = host
+        self.port = port
+        self.idle = []
+        self.lock = threading.Lock()
+        self.slots = threading.Semaphore(size)
+        self.created = 0
+
+    def get(self, fresh=False):
+        """
+        Wait for a free slot and return (connection, reused). A new
+        connection is made if there is no idle one, or if fresh=True.
+        """
+        self.slots.acquire()
+        self.lock.acquire()
+        try:
+            if self.idle and not fresh:
+                return self.idle.pop(), True
+            self.created += 1
+        finally:
+            self.lock.release()
+        return httplib.HTTPConnection(self.host, self.port), False
+
+    def put(self, connection, reuse=True):
+        """Return a connection to the pool, or close it."""
+        if reuse:
+            self.lock.acquire()
+            try:
+                self.idle.append(connection)
+            finally:
+                self.lock.release()
+        else:
+            connection.close()
+        self.slots.release()
+
+    def close(self):
+        """Close all idle connections."""
+        self.lock.acquire()
+        try:
+            for connection in self.idle:
+                connection.close()
+            self.idle = []
+        finally:
+            self.lock.release()
+
+
+class Client:
+    """
+    Pooled S3 client for uploading files with PUT.
+    """
+
+    def __init__(self, aws_access_key_id, aws_secret_access_key,
+                 host=s3.DEFAULT_HOST, port=80,
+                 concurrency=CONCURRENCY, buffer_size=BUFFER_SIZE,
+                 max_attempts=MAX_ATTEMPTS, backoff=BACKOFF):
+        self.aws_access_key_id = aws_access_key_id
+        self.aws_secret_access_key = aws_secret_access_key
+        self.host = host
+        self.concurrency = concurrency
+        self.buffer_size = buffer_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.pool = ConnectionPool(host, port, concurrency)
+        self.lock = threading.Lock()
+        self.files = self.bytes = self.retries = 0
+        self.seconds = 0.0
+
+    def sign(self, headers, method, bucket, key):
+        """Add Date and Authorization headers."""
+        if 'Date' not in headers:
+            headers['Date'] = time.strftime(
+                "%a, %d %b %Y %H:%M:%S GMT", time.gmtime())
+        headers['Authorization'] = "AWS %s:%s" % (
+            self.aws_access_key_id,
+            s3.encode(self.aws_secret_access_key,
+                      s3.canonical_string(method, bucket, key, {}, headers)))
+
+    def put_file(self, bucket, key, filename, headers=None):
+        """
+        Upload a file, with retries. Return a Transfer object.
+        """
+        transfer = Transfer(bucket, key, filename)
+        started = time.time()
+        while True:
+            transfer.attempts += 1
+            try:
+                self.send(transfer, headers or {})
+                break
+            except NETWORK_ERRORS:
+                if transfer.attempts >= self.max_attempts:
+                    raise
+            except Fault, fault:
+                if (fault.faultCode < 500 or
+                    transfer.attempts >= self.max_attempts):
+                    raise
+            time.sleep(self.backoff * 2 ** (transfer.attempts - 1))
+        transfer.seconds = time.time() - started
+        self.record(transfer)
+        return transfer
+
+    def send(self, transfer, extra_headers):
+        """
+        Send one PUT request. If an idle keep-alive connection was
+        closed by the server, try again once with a fresh connection.
+        """
+        fresh = False
+        while True:
+            connection, reused = self.pool.get(fresh)
+            reuse = False
+            try:
+                try:
+                    status, body, reuse = self.send_request(
+                        connection, transfer, extra_headers)
+                except NETWORK_ERRORS:
+                    if reused and not fresh:
+                        fresh = True
+                        continue
+                    raise
+            finally:
+                self.pool.put(connection, reuse)
+            if status not in (200, 204):
+                raise Fault(status, body)
+            return
+
+    def send_request(self, connection, transfer, extra_headers):
+        """
+        Stream the file in large chunks, return status, response body
+        and whether the connection can be reused.
+        """
+        infile = file(transfer.filename, 'rb')
+        try:
+            bytes_total = os.fstat(infile.fileno()).st_size
+            headers = {
+                'User-Agent': 'shotserver/0.4',
+                'Host': self.host,
+                'Content-Length': str(bytes_total),
+                }
+            headers.update(extra_headers)
+            self.sign(headers, 'PUT', transfer.bucket, transfer.key)
+            path = '/%s/%s' % (transfer.bucket,
+                               urllib.quote_plus(transfer.key))
+            connection.putrequest('PUT', path,
+                                  skip_host=True, skip_accept_encoding=True)
+            for header_key, header_value in headers.iteritems():
+                connection.putheader(header_key, header_value)
+            connection.endheaders()
+            bytes_sent = 0
+            while True:
+                data = infile.read(self.buffer_size)
+                if not data:
+                    break
+                connection.send(data)
+                bytes_sent += len(data)
+        finally:
+            infile.close()
+        response = connection.getresponse()
+        body = response.read()
+        transfer.bytes = bytes_sent
+        return response.status, body, not response.will_close
+
+    def record(self, transfer):
+        """Add a finished transfer to the totals."""
+        self.lock.acquire()
+        try:
+            self.files += 1
+            self.bytes += transfer.bytes
+            self.seconds += transfer.seconds
+            self.retries += transfer.attempts - 1
+        finally:
+            self.lock.release()
+
+    def statistics(self):
+        """Totals for all finished transfers."""
+        throughput = 0.0
+        if self.seconds:
+            throughput = self.bytes / 1024.0 / self.seconds
+        return ('%d files, %d bytes, %.1f KB/s per transfer, '
+                '%d retries, %d connections') % (
+            self.files, self.bytes, throughput, self.retries,
+            self.pool.created)
+
+    def put_files(self, files, headers=None):
+        """
+        Upload many files in parallel. The files argument is a list
+        of (bucket, key, filename). Return a list of Transfer objects
+        in the same order. After an error, no more uploads are started,
+        and the error is raised when the running ones are finished.
+        """
+        results = [None] * len(files)
+        errors = []
+        queue = list(enumerate(files))
+        queue.reverse()
+        lock = threading.Lock()
+
+        def work():
+            while True:
+                lock.acquire()
+                try:
+                    if not queue or errors:
+                        return
+                    index, (bucket, key, filename) = queue.pop()
+                finally:
+                    lock.release()
+                try:
+                    results[index] = self.put_file(
+                        bucket, key, filename, headers)
+                except Exception, error:
+                    lock.acquire()
+                    errors.append(error)
+                    lock.release()
+
+        threads = [threading.Thread(target=work)
+                   for index in range(min(self.concurrency, len(files)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return results
@@ -0,0 +1,147 @@
+# browsershots.org - Test your web design in different browsers
+# Copyright (C) 2007 Johann C. Rocholl <johann@browsershots.org>
+#
+# Browsershots is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Browsershots is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Scale screenshots to preview size, one scanline at a time.
+
+Each output pixel is the average of the input area that it covers,
+like pnmscale from netpbm. All weights are integers, so the result
+is exact up to the final rounding.
+"""
+
+__revision__ = "$Rev$"
+__date__ = "$Date$"
+__author__ = "$Author$"
+
+from array import array
+from itertools import izip
+
+
+def spans(size, new_size):
+    """
+    Find the input pixels that are covered by each output pixel.
+
+    Return a list of (first, last, first_weight, last_weight) for
+    each output pixel. Pixels between first and last are fully
+    covered, with weight new_size. The weights for each output pixel
+    add up to size.
+
+    >>> spans(3, 2)
+    [(0, 1, 2, 1), (1, 2, 1, 2)]
+    >>> spans(4, 2)
+    [(0, 1, 2, 2), (2, 3, 2, 2)]
+    >>> spans(1, 2)
+    [(0, 0, 1, 1), (0, 0, 1, 1)]
+    """
+    result = []
+    for index in range(new_size):
+        start = index * size
+        stop = start + size
+        first = start / new_size
+        last = (stop - 1) / new_size
+        if first == last:
+            result.append((first, last, size, size))
+        else:
+            result.append((first, last,
+                           (first + 1) * new_size - start,
+                           stop - last * new_size))
+    return result
+
+
+class Scaler:
+    """
+    Shrink (or enlarge) an image to a new width, keeping the aspect
+    ratio. Feed input scanlines to add_row, which returns finished
+    output scanlines as soon as they are complete.
+
+    >>> scaler = Scaler(4, 2, 2, planes=1)
+    >>> scaler.new_height
+    1
+    >>> scaler.add_row(array('B', [0, 2, 4, 6]))
+    []
+    >>> scaler.add_row(array('B', [2, 4, 6, 8]))
+    [array('B', [2, 6])]
+    """
+
+    def __init__(self, width, height, new_width, planes=3):
+        self.width = width
+        self.height = height
+        self.new_width = new_width
+        self.new_height = max(1, (height * new_width + width / 2) / width)
+        self.planes = planes
+        self.columns = spans(width, new_width)
+        self.divisor = width * height
+        self.pending = {}
+        self.y = 0
+
+    def scale_row(self, row):
+        """
+        Scale one scanline horizontally. Return a list of weighted
+        sums, one for each sample in the output row.
+        """
+        planes = self.planes
+        full = self.new_width
+        result = []
+        append = result.append
+        for first, last, first_weight, last_weight in self.columns:
+            first *= planes
+            last *= planes
+            for plane in range(planes):
+                if first == last:
+                    append(row[first + plane] * first_weight)
+                    continue
+                a = row[first + plane]
+                b = row[last + plane]
+                total = sum(row[first + plane:last + plane + 1:planes])
+                append(total * full -
+                       (full - first_weight) * a -
+                       (full - last_weight) * b)
+        return result
+
+    def add_row(self, row):
+        """
+        Add the next input scanline. Return a list of finished output
+        scanlines, which may be empty.
+        """
+        sums = self.scale_row(row)
+        height = self.height
+        start = self.y * self.new_height
+        stop = start + self.new_height
+        finished = []
+        for y in range(start / height, (stop - 1) / height + 1):
+            weight = min(stop, (y + 1) * height) - max(start, y * height)
+            if y in self.pending:
+                self.pending[y] = [total + value * weight for total, value
+                                   in izip(self.pending[y], sums)]
+            else:
+                self.pending[y] = [value * weight for value in sums]
+            if (y + 1) * height <= stop:
+                finished.append(self.finish(self.pending.pop(y)))
+        self.y += 1
+        return finished
+
+    def finish(self, sums):
+        """
+        Convert weighted sums to an output scanline.
+        """
+        divisor = self.divisor
+        half = divisor / 2
+        return array('B', [(total + half) / divisor for total in sums])
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -22,19 +22,31 @@ __revision__ = "$Rev$"
 __date__ = "$Date$"
 __author__ = "$Author$"
 
-import re
 import os
-import httplib
-import urllib
-import tempfile
+import md5
+import zlib
+import time
+import struct
+import threading
+from array import array
 from xmlrpclib import Fault
 from django.conf import settings
 from shotserver04.nonces import crypto
+from shotserver04.screenshots import scaling
+import png
 
 ORIGINAL_SIZE = 'original'
-HEADER_MATCH = re.compile(r'(\S\S)\s+(\d+)\s+(\d+)\s+').match
-BUFFER_SIZE = 4096
-DEBUG_HEADERS = False
+UPLOAD_FOLDER = 'upload' # partial uploads from screenshots.uploadChunk
+UPLOAD_EXPIRE = 3600 # seconds after the last chunk, for abandoned uploads
+COPY_BLOCK_SIZE = 64 * 1024
+DECODE_ERRORS = (png.Error, ValueError, struct.error, zlib.error)
+S3_HEADERS = {
+    'x-amz-acl': 'public-read',
+    'Content-Type': 'image/png',
+    }
+
+_s3_client = None
+_s3_lock = threading.Lock()
 
 
 def png_path(hashkey, size=ORIGINAL_SIZE):
@@ -72,129 +84,221 @@ def save_upload(screenshot):
     return hashkey
 
 
-def pngtoppm(hashkey):
-    """
-    Decode PNG file and return temporary PPM filename.
-    """
-    pngname = png_filename(hashkey)
-    ppmhandle, ppmname = tempfile.mkstemp()
-    os.close(ppmhandle)
-    error = os.system('pngtopnm "%s" > "%s"' % (pngname, ppmname))
-    if error:
-        makedirs(png_path(hashkey, 'error'))
-        errorname = png_filename(hashkey, 'error')
-        os.system('mv "%s" "%s"' % (pngname, errorname))
-        raise Fault(415,
-            "Could not decode uploaded PNG file (hashkey %s)." % hashkey)
-    if not os.path.exists(ppmname):
-        raise Fault(500, "Decoded screenshot file not found.")
-    if os.path.getsize(ppmname) == 0:
-        raise Fault(500, "Decoded screenshot file is empty.")
-    return ppmname
-
-
-def read_pnm_header(ppmname):
-    """
-    Try to read PNM header from decoded screenshot.
-    """
-    header = file(ppmname, 'rb').read(1024)
-    match = HEADER_MATCH(header)
-    if match is None:
-        raise Fault(500,
-            "Could not read PNM header after decoding uploaded PNG file.")
-    return (
-        match.group(1),
-        int(match.group(2)),
-        int(match.group(3)),
-        )
-
-
-def scale(ppmname, width, hashkey):
-    """
-    Make small preview image from uploaded screenshot.
-    """
-    makedirs(png_path(hashkey, size=width))
-    pngname = png_filename(hashkey, size=width)
-    error = os.system('pnmscale -width=%d "%s" | pnmtopng > %s' %
-                      (width, ppmname, pngname))
-    if error:
-        raise Fault(500,
-            "Could not create scaled preview image.")
-
-
-def s3_upload(hashkey, size=ORIGINAL_SIZE):
-    """
-    Upload a screenshot PNG file to Amazon S3.
-
-    This uses httplib directly and transfers the file in small chunks,
-    so we don't have to load the whole PNG file into RAM.
-    """
-
-    from shotserver04.screenshots import s3
-    aws = s3.AWSAuthConnection(
-        settings.AWS_ACCESS_KEY_ID, settings.AWS_SECRET_ACCESS_KEY,
-        is_secure=False)
-    s3_bucket = settings.S3_BUCKETS[str(size)]
-    s3_key = hashkey + '.png'
-    server = s3.DEFAULT_HOST
-    method = 'PUT'
-    path = '/%s/%s' % (s3_bucket, urllib.quote_plus(s3_key))
-
-    filename = png_filename(hashkey, size)
-    f = file(filename, 'rb')
-    f.seek(0, 2) # os.SEEK_END for Python < 2.5
-    bytes_total = f.tell()
-    f.seek(0, 0) # os.SEEK_SET for Python < 2.5
-
-    headers = {
-        'User-Agent': 'shotserver/0.4',
-        'Host': server,
-        'x-amz-acl': 'public-read',
-        'Content-Type': 'image/png',
-        'Content-Length': str(bytes_total),
-        }
-    query_args = {}
-    aws._add_aws_auth_header(headers, method, s3_bucket, s3_key, query_args)
-
-    host = '%s:%d' % (server, 80)
-    conn = httplib.HTTPConnection(host)
-    conn.putrequest(method, path)
-    for header_key, header_value in headers.iteritems():
-        conn.putheader(header_key, header_value)
-    conn.endheaders()
-
-    bytes_sent = 0
-    while True:
-        bytes = f.read(BUFFER_SIZE)
-        if not bytes:
-            break
-        conn.send(bytes)
-        bytes_sent += len(bytes)
-        # print 'sent', bytes_sent, 'of', bytes_total, 'bytes',
-        # print '(%.1f%%)' % (100.0 * bytes_sent / bytes_total)
-    assert bytes_sent == bytes_total
-    f.close()
-
-    response = conn.getresponse()
-    if response.status != 200:
-        raise Fault(response.status, response.read())
-    # print 'http://%s/%s' % (s3_bucket, s3_key)
-
-    # Write response from S3 to tempfile for debugging
-    if DEBUG_HEADERS and str(size) == '160':
-        tempfile = file('/tmp/%s.txt' % hashkey, 'w')
-        tempfile.write('==== Request headers ====\n')
-        tempfile.write('%s %s HTTP/1.1\n' % (method, path))
-        for header, value in headers.iteritems():
-            tempfile.write('%s: %s\n' % (header, value))
-        tempfile.write('\n')
-        tempfile.write('==== Response headers ====\n')
-        tempfile.write('HTTP/1.1 %s %s\n' % (response.status, response.reason))
-        for header, value in response.getheaders():
-            tempfile.write('%s: %s\n' % (header, value))
-        tempfile.write('\n')
-        tempfile.write(response.read())
-        # tempfile.write(response.msg)
-        tempfile.close()
-
-    conn.close()
+def upload_filename(factory_name, request_id):
+    """Get the full filesystem path for a partial upload."""
+    return os.path.join(settings.PNG_ROOT, UPLOAD_FOLDER,
+                        '%s-%d.png' % (factory_name, request_id))
+
+
+def save_chunk(filename, offset, data):
+    """
+    Write part of an upload at the given offset and return the number
+    of bytes received so far. Anything after the offset is discarded,
+    so a chunk can be sent again after a network error.
+    """
+    if os.path.exists(filename):
+        size = os.path.getsize(filename)
+        outfile = file(filename, 'r+b')
+    else:
+        makedirs(os.path.dirname(filename))
+        size = 0
+        outfile = file(filename, 'wb')
+    try:
+        if offset > size:
+            raise Fault(416,
+                "Upload offset %d is after the %d bytes received so far." %
+                (offset, size))
+        outfile.seek(offset)
+        outfile.write(data)
+        outfile.truncate()
+    finally:
+        outfile.close()
+    return offset + len(data)
+
+
+def expire_uploads(now=None):
+    """
+    Remove partial uploads that haven't received a chunk for a while,
+    because the factory gave up. Return the number of removed files.
+    """
+    if now is None:
+        now = time.time()
+    path = os.path.join(settings.PNG_ROOT, UPLOAD_FOLDER)
+    if not os.path.isdir(path):
+        return 0
+    removed = 0
+    for name in os.listdir(path):
+        filename = os.path.join(path, name)
+        try:
+            if os.path.getmtime(filename) + UPLOAD_EXPIRE < now:
+                os.unlink(filename)
+                removed += 1
+        except OSError:
+            pass # Finished or removed in the meantime
+    return removed
+
+
+def finish_upload(filename, bytes, md5_hexdigest):
+    """
+    Check size and checksum of a partial upload, move it to the
+    original size folder and return the new hashkey.
+    """
+    if not os.path.exists(filename):
+        raise Fault(404, "No partial upload found.")
+    size = os.path.getsize(filename)
+    if size != bytes:
+        raise Fault(416, "Received %d bytes, expected %d." % (size, bytes))
+    checksum = md5.new()
+    infile = file(filename, 'rb')
+    try:
+        while True:
+            block = infile.read(COPY_BLOCK_SIZE)
+            if not block:
+                break
+            checksum.update(block)
+    finally:
+        infile.close()
+    if checksum.hexdigest() != md5_hexdigest.lower():
+        os.unlink(filename)
+        raise Fault(400, "Upload checksum mismatch, please try again.")
+    hashkey = crypto.random_md5()
+    makedirs(png_path(hashkey))
+    os.rename(filename, png_filename(hashkey))
+    return hashkey
+
+
+def decode_error(hashkey):
+    """
+    Move an undecodable PNG file out of the way and raise a fault.
+    """
+    makedirs(png_path(hashkey, 'error'))
+    os.rename(png_filename(hashkey), png_filename(hashkey, 'error'))
+    raise Fault(415,
+        "Could not decode uploaded PNG file (hashkey %s)." % hashkey)
+
+
+def decode(hashkey):
+    """
+    Start decoding an uploaded PNG file. Return width, height and an
+    iterator over RGB scanlines, which are read from disk and decoded
+    on demand.
+    """
+    reader = png.Reader(filename=png_filename(hashkey))
+    try:
+        width, height, rows, metadata = reader.read_rows()
+    except DECODE_ERRORS:
+        decode_error(hashkey)
+    return width, height, rgb_scanlines(rows, reader.planes, reader.bps)
+
+
+def rgb_scanlines(rows, planes, bytes_per_sample):
+    """
+    Convert scanlines to 8-bit RGB without alpha channel.
+    """
+    for row in rows:
+        if bytes_per_sample == 2:
+            row = row[::2] # Keep only the most significant byte
+        if planes == 3:
+            yield row
+            continue
+        pixels = len(row) / planes
+        rgb = array('B', [0]) * (pixels * 3)
+        if planes == 4: # RGBA
+            for plane in range(3):
+                rgb[plane::3] = row[plane::4]
+        else: # Greyscale, maybe with alpha
+            grey = row[::planes]
+            for plane in range(3):
+                rgb[plane::3] = grey
+        yield rgb
+
+
+def process(hashkey, rows, consumers):
+    """
+    Feed each decoded scanline to all consumers, which must have
+    add_row, close and abort methods.
+    """
+    try:
+        for row in rows:
+            for consumer in consumers:
+                consumer.add_row(row)
+    except DECODE_ERRORS:
+        for consumer in consumers:
+            consumer.abort()
+        decode_error(hashkey)
+    for consumer in consumers:
+        consumer.close()
+
+
+class Preview:
+    """
+    Make small preview image from uploaded screenshot, by scaling
+    and compressing the scanlines as they are decoded.
+    """
+
+    def __init__(self, hashkey, size, width, height):
+        self.filename = png_filename(hashkey, size)
+        self.scaler = scaling.Scaler(width, height, size)
+        self.writer = png.Writer(size, self.scaler.new_height)
+        self.compressor = zlib.compressobj()
+        self.data = array('B')
+        makedirs(png_path(hashkey, size))
+        self.outfile = file(self.filename, 'wb')
+        self.writer.write_preamble(self.outfile)
+
+    def add_row(self, row):
+        """Scale the next scanline and compress finished output rows."""
+        for scanline in self.scaler.add_row(row):
+            self.data.append(0) # No filter
+            self.data.extend(scanline)
+        if len(self.data) > self.writer.chunk_limit:
+            self.write_idat(self.compressor.compress(self.data.tostring()))
+            self.data = array('B')
+
+    def write_idat(self, compressed):
+        """Write compressed image data, if any."""
+        if compressed:
+            self.writer.write_chunk(self.outfile, 'IDAT', compressed)
+
+    def close(self):
+        """Write remaining image data and close the PNG file."""
+        self.write_idat(self.compressor.compress(self.data.tostring()) +
+                        self.compressor.flush())
+        self.writer.write_chunk(self.outfile, 'IEND', '')
+        self.outfile.close()
+
+    def abort(self):
+        """Remove the incomplete PNG file."""
+        self.outfile.close()
+        os.unlink(self.filename)
+
+
+def s3_client():
+    """
+    Get the shared S3 client, with a pool of keep-alive connections.
+    """
+    global _s3_client
+    _s3_lock.acquire()
+    try:
+        if _s3_client is None:
+            from shotserver04.screenshots import s3, replication
+            _s3_client = replication.Client(
+                settings.AWS_ACCESS_KEY_ID, settings.AWS_SECRET_ACCESS_KEY,
+                host=getattr(settings, 'S3_HOST', s3.DEFAULT_HOST),
+                port=getattr(settings, 'S3_PORT', 80),
+                concurrency=getattr(settings, 'S3_CONCURRENCY',
+                                    replication.CONCURRENCY))
+        return _s3_client
+    finally:
+        _s3_lock.release()
+
+
+def s3_upload(hashkey, sizes=(ORIGINAL_SIZE, )):
+    """
+    Upload screenshot PNG files to Amazon S3, all sizes in parallel.
+    Return a list of Transfer objects with throughput metrics.
+    """
+    files = [(settings.S3_BUCKETS[str(size)], hashkey + '.png',
+              png_filename(hashkey, size))
+             for size in sizes]
+    return s3_client().put_files(files, S3_HEADERS)
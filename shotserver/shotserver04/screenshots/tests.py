@@ -22,17 +22,31 @@ __revision__ = "$Rev$"
 __date__ = "$Date$"
 __author__ = "$Author$"
 
+import os
+import md5
+import shutil
+import tempfile
+import time
+import threading
+import BaseHTTPServer
+import SocketServer
+from xmlrpclib import Fault
 from datetime import datetime
+from array import array
 from psycopg import IntegrityError
 from unittest import TestCase
 from django.db import transaction
+from django.conf import settings
 from django.contrib.auth.models import User
 from shotserver04.platforms.models import Platform, OperatingSystem
 from shotserver04.factories.models import Factory
 from shotserver04.screenshots.models import Screenshot
+from shotserver04.screenshots.scaling import Scaler, spans
+from shotserver04.screenshots import storage, jobs, replication, detector
 from shotserver04.browsers.models import Engine, BrowserGroup, Browser
 from shotserver04.requests.models import RequestGroup, Request
 from shotserver04.websites.models import Domain, Website
+import png
 
 VALID_SIZES = [
     (640, 480),
@@ -142,3 +156,299 @@ class SizeTestCase(TestCase):
     def testInvalidSizes(self):
         for width, height in INVALID_SIZES:
             self.assertSizeInvalid(width, height)
+
+
+class ScalingTestCase(TestCase):
+
+    def testSpans(self):
+        for size, new_size in [(1024, 512), (1024, 160), (800, 160)]:
+            columns = spans(size, new_size)
+            self.assertEqual(len(columns), new_size)
+            for first, last, first_weight, last_weight in columns:
+                total = (first_weight + last_weight +
+                         (last - first - 1) * new_size)
+                self.assertEqual(total, size)
+
+    def testPreviewSizes(self):
+        for width, height, new_width, new_height in [
+            (1024, 768, 512, 384),
+            (1024, 768, 160, 120),
+            (800, 3200, 160, 640),
+            (1024, 4095, 160, 640),
+            ]:
+            scaler = Scaler(width, height, new_width)
+            self.assertEqual(scaler.new_height, new_height)
+            color = array('B', [10, 128, 250]) * width
+            output = []
+            for y in range(height):
+                output.extend(scaler.add_row(color))
+            self.assertEqual(len(output), new_height)
+            for row in output:
+                self.assertEqual(row, array('B', [10, 128, 250]) * new_width)
+
+
+FEATURE_PBM = """P1
+# 699_Test_dialog.pbm
+12 3
+1 1 0 0 1 1 1 0 1 0 1 1
+1 0 1 0 1 0 0 0 1 0 1 0
+1 1 0 1 1 0 1 1 1 0 1 1
+"""
+
+
+class DetectorTestCase(TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        outfile = file(os.path.join(self.folder, '699_Test_dialog.pbm'), 'w')
+        outfile.write(FEATURE_PBM)
+        outfile.close()
+        self.index = detector.FeatureIndex(
+            [os.path.join(self.folder, '699_Test_dialog.pbm')])
+        self.feature = self.index.features.values()[0][0]
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def screen(self, width, height, feature_at=None):
+        """Light grey screen with black text, maybe with the feature."""
+        rows = []
+        for y in range(height):
+            row = array('B', [220, 220, 220]) * width
+            if y % 10 < 5:
+                for x in range(3, width - 3, 17):
+                    row[x * 3:x * 3 + 3] = array('B', [0, 0, 0])
+            rows.append(row)
+        if feature_at:
+            left, top = feature_at
+            for y, bits in enumerate(self.feature.bits):
+                row = rows[top + y] = array('B', [220, 220, 220]) * width
+                for x, bit in enumerate(bits):
+                    if bit == '1':
+                        pixel = (left + x) * 3
+                        row[pixel:pixel + 3] = array('B', [0, 0, 0])
+        return rows
+
+    def detect(self, width, height, rows):
+        check = detector.Detector(width, height, self.index)
+        for row in rows:
+            check.add_row(row)
+        check.close()
+        return check.result
+
+    def testFeature(self):
+        self.assertEqual(self.feature.code, 699)
+        result = self.detect(640, 480, self.screen(640, 480, (301, 203)))
+        self.assertEqual(result, (699, 'Test dialog.', 301, 203, 12, 3))
+
+    def testNoProblem(self):
+        self.assertEqual(self.detect(640, 480, self.screen(640, 480)), None)
+
+    def testBlank(self):
+        rows = [array('B', [255, 255, 255]) * 640] * 480
+        self.assertEqual(self.detect(640, 480, rows)[0], 701)
+
+
+class JobsTestCase(TestCase):
+
+    def setUp(self):
+        self.png_root = settings.PNG_ROOT
+        settings.PNG_ROOT = tempfile.mkdtemp()
+        self.hashkey = '0123456789abcdef0123456789abcdef'
+        storage.makedirs(storage.png_path(self.hashkey))
+        outfile = file(storage.png_filename(self.hashkey), 'wb')
+        png.Writer(64, 48).write(outfile,
+            [array('B', [y, 100, 200]) * 64 for y in range(48)])
+        outfile.close()
+
+    def tearDown(self):
+        shutil.rmtree(settings.PNG_ROOT)
+        settings.PNG_ROOT = self.png_root
+
+    def testSubmit(self):
+        jobs.submit(self.hashkey, [32, 16], s3=True)
+        self.assertTrue(jobs.is_queued(self.hashkey))
+        job = jobs.load(self.hashkey)
+        self.assertEqual(job.tasks, ['previews 32 16', 's3 original 32 16'])
+        self.assertEqual(jobs.pending(), [self.hashkey])
+
+    def testRun(self):
+        jobs.submit(self.hashkey, [32, 16])
+        jobs.load(self.hashkey).run()
+        self.assertFalse(jobs.is_queued(self.hashkey))
+        width, height, pixels, metadata = png.Reader(
+            filename=storage.png_filename(self.hashkey, 16)).read()
+        self.assertEqual((width, height), (16, 12))
+
+    def testRetry(self):
+        job = jobs.submit(self.hashkey, [32])
+        job.tasks.append('unknown')
+        job.save()
+        self.assertRaises(Exception, jobs.load(self.hashkey).run)
+        job = jobs.load(self.hashkey)
+        self.assertEqual(job.attempts, 1)
+        self.assertEqual(job.tasks, ['unknown'])
+        self.assertEqual(jobs.pending(), [])
+        self.assertEqual(jobs.pending(time.time() + 3600), [self.hashkey])
+
+    def testBrokenFile(self):
+        file(storage.png_filename(self.hashkey), 'wb').write('broken')
+        jobs.submit(self.hashkey, [32])
+        self.assertRaises(Exception, jobs.load(self.hashkey).run)
+        self.assertFalse(jobs.is_queued(self.hashkey))
+        self.assertTrue(jobs.is_failed(self.hashkey))
+
+    def testTruncatedWithoutConsumers(self):
+        filename = storage.png_filename(self.hashkey)
+        data = file(filename, 'rb').read()
+        file(filename, 'wb').write(data[:len(data) / 2])
+        width, height, rows = storage.decode(self.hashkey)
+        self.assertRaises(Fault, storage.process, self.hashkey, rows, [])
+
+
+class ChunkedUploadTestCase(TestCase):
+
+    def setUp(self):
+        self.png_root = settings.PNG_ROOT
+        settings.PNG_ROOT = tempfile.mkdtemp()
+        self.filename = storage.upload_filename('factory', 123)
+        self.data = ''.join([chr(index % 256) for index in range(10000)])
+
+    def tearDown(self):
+        shutil.rmtree(settings.PNG_ROOT)
+        settings.PNG_ROOT = self.png_root
+
+    def send(self, chunk_size):
+        offset = 0
+        while offset < len(self.data):
+            chunk = self.data[offset:offset + chunk_size]
+            offset = storage.save_chunk(self.filename, offset, chunk)
+        return offset
+
+    def testChunks(self):
+        self.assertEqual(self.send(3000), 10000)
+        hashkey = storage.finish_upload(
+            self.filename, 10000, md5.new(self.data).hexdigest())
+        self.assertFalse(os.path.exists(self.filename))
+        self.assertEqual(file(storage.png_filename(hashkey), 'rb').read(),
+                         self.data)
+
+    def testResend(self):
+        storage.save_chunk(self.filename, 0, self.data[:6000])
+        # The response got lost, send the second chunk again
+        self.assertEqual(
+            storage.save_chunk(self.filename, 3000, self.data[3000:6000]),
+            6000)
+        storage.save_chunk(self.filename, 6000, self.data[6000:])
+        self.assertEqual(file(self.filename, 'rb').read(), self.data)
+
+    def testRestart(self):
+        self.send(4000)
+        self.send(7000)
+        self.assertEqual(os.path.getsize(self.filename), 10000)
+
+    def testGap(self):
+        storage.save_chunk(self.filename, 0, self.data[:3000])
+        try:
+            storage.save_chunk(self.filename, 4000, self.data[4000:])
+            self.fail("Expected fault 416.")
+        except Fault, fault:
+            self.assertEqual(fault.faultCode, 416)
+        self.assertEqual(os.path.getsize(self.filename), 3000)
+
+    def testIncomplete(self):
+        storage.save_chunk(self.filename, 0, self.data[:3000])
+        self.assertRaises(Fault, storage.finish_upload,
+            self.filename, 10000, md5.new(self.data).hexdigest())
+
+    def testChecksum(self):
+        self.send(5000)
+        self.assertRaises(Fault, storage.finish_upload,
+            self.filename, 10000, md5.new('wrong').hexdigest())
+        self.assertFalse(os.path.exists(self.filename))
+
+    def testExpire(self):
+        storage.save_chunk(self.filename, 0, self.data[:3000])
+        self.assertEqual(storage.expire_uploads(), 0)
+        self.assertTrue(os.path.exists(self.filename))
+        self.assertEqual(storage.expire_uploads(
+            time.time() + storage.UPLOAD_EXPIRE + 1), 1)
+        self.assertFalse(os.path.exists(self.filename))
+
+
+class FakeS3Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_PUT(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        server.clients.add(self.client_address)
+        if server.failures:
+            server.failures -= 1
+            status = 500
+        else:
+            status = server.status
+            server.uploads[self.path] = body
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeS3Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class ReplicationTestCase(TestCase):
+
+    def setUp(self):
+        self.server = FakeS3Server(('127.0.0.1', 0), FakeS3Handler)
+        self.server.uploads = {}
+        self.server.clients = set()
+        self.server.failures = 0
+        self.server.status = 200
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.client = replication.Client('key', 'secret',
+            host='127.0.0.1', port=self.server.server_address[1],
+            concurrency=2, buffer_size=1000, backoff=0.01)
+        self.tempdir = tempfile.mkdtemp()
+        self.files = []
+        for index in range(6):
+            filename = os.path.join(self.tempdir, '%d.png' % index)
+            file(filename, 'wb').write(str(index) * 5000)
+            self.files.append(('bucket', '%d.png' % index, filename))
+
+    def tearDown(self):
+        self.client.pool.close()
+        self.server.shutdown()
+        shutil.rmtree(self.tempdir)
+
+    def testParallel(self):
+        transfers = self.client.put_files(self.files)
+        self.assertEqual(len(transfers), 6)
+        for index, transfer in enumerate(transfers):
+            self.assertEqual(transfer.bytes, 5000)
+            self.assertEqual(transfer.attempts, 1)
+            self.assertEqual(self.server.uploads['/bucket/%d.png' % index],
+                             str(index) * 5000)
+        # Keep-alive: no more connections than concurrent uploads
+        self.assertTrue(len(self.server.clients) <= 2)
+        self.assertTrue(self.client.pool.created <= 2)
+
+    def testRetry(self):
+        self.server.failures = 2
+        transfer = self.client.put_file(*self.files[0])
+        self.assertEqual(transfer.attempts, 3)
+        self.assertEqual(self.client.retries, 2)
+
+    def testForbidden(self):
+        self.server.status = 403
+        try:
+            self.client.put_file(*self.files[0])
+            self.fail("Expected fault 403.")
+        except Fault, fault:
+            self.assertEqual(fault.faultCode, 403)
@@ -23,23 +23,27 @@ __date__ = "$Date$"
 __author__ = "$Author$"
 
 import os
-import commands
 from xmlrpclib import Fault, Binary
 from datetime import datetime
-from django.utils.text import capfirst
+from django.db import connection
 from django.conf import settings
-from shotserver04.common import serializable, get_or_fault
+from shotserver04.common import serializable, read_committed, LOCK_FREE
+from shotserver04.common import get_or_fault
+from shotserver04.common.admission import admission
 from shotserver04.xmlrpc import signature, factory_xmlrpc
 from shotserver04.nonces import xmlrpc as nonces
 from shotserver04.factories.models import Factory
 from shotserver04.browsers.models import Browser
 from shotserver04.requests.models import Request
+from shotserver04.requests.pending import pending_index
 from shotserver04.screenshots.models import Screenshot
-from shotserver04.screenshots import storage
+from shotserver04.screenshots import storage, jobs, detector
 
 PREVIEW_SIZES = [512, 160]
 # PREVIEW_SIZES = [512, 240, 160, 116, 92, 77, 57, 44, 32]
 # PREVIEW_SIZES = [640, 316, 208, 154, 100, 64, 46]
+QUEUE_JOBS = True # make previews in shotserver04_worker.py
+PBMGREP_FOLDER = '/usr/local/etc/pbmgrep'
 
 
 class ExtraFault(Fault):
@@ -49,11 +53,22 @@ class ExtraFault(Fault):
             setattr(self, key, extra[key])
 
 
-@serializable
 def close_request(request_id, factory, screenshot):
     """
     Close a screenshot request after it has been completed.
     """
+    if LOCK_FREE:
+        close_request_conditional(request_id, factory, screenshot)
+    else:
+        close_request_serializable(request_id, factory, screenshot)
+
+
+@serializable
+def close_request_serializable(request_id, factory, screenshot):
+    """
+    Close a screenshot request, with transaction isolation level
+    serializable.
+    """
     # Check again that no other factory has locked the request
     request = get_or_fault(Request, pk=request_id)
     try:
@@ -63,10 +78,35 @@ def close_request(request_id, factory, screenshot):
         raise
     # Close the request
     request.update_fields(screenshot=screenshot)
+    pending_index.discard(request.id)
+
+
+@read_committed
+def close_request_conditional(request_id, factory, screenshot):
+    """
+    Close a screenshot request with a single conditional UPDATE, which
+    only succeeds if the request is still locked by this factory.
+    """
+    cursor = connection.cursor()
+    cursor.execute("""
+UPDATE requests_request SET screenshot_id = %s
+WHERE id = %s AND factory_id = %s
+""", [screenshot.id, request_id, factory.id])
+    if cursor.rowcount != 1:
+        # Find out what went wrong
+        request = get_or_fault(Request, pk=request_id)
+        try:
+            request.check_factory_lock(factory)
+        except Fault:
+            screenshot.delete()
+            raise
+        raise Fault(409, u"Request %d was not locked." % request_id)
+    pending_index.discard(request_id)
 
 
 @factory_xmlrpc
 @signature(str, str, str, int, Binary)
+@admission.track('upload')
 def upload(http_request, factory, encrypted_password, request, screenshot):
     """
     Submit a multi-page screenshot as a lossless PNG file.
@@ -89,14 +129,89 @@ def upload(http_request, factory, encrypted_password, request, screenshot):
     """
     # Verify authentication
     nonces.verify(http_request, factory, encrypted_password)
-    request_id = request
-    request = get_or_fault(Request, pk=request_id)
-    request_group = request.request_group
-    # Make sure the request was locked by this factory
-    request.check_factory_lock(factory)
+    request = locked_request(factory, request)
     # Store and check screenshot file
     hashkey = storage.save_upload(screenshot)
-    bytes = storage.png_filesize(hashkey)
+    return process_upload(factory, request, hashkey, len(screenshot.data))
+
+
+@factory_xmlrpc
+@signature(int, str, str, int, int, Binary)
+@admission.track('upload')
+def uploadChunk(http_request, factory, encrypted_password, request,
+                offset, chunk):
+    """
+    Send part of a large PNG file, so that neither side needs to keep
+    the whole file in memory.
+
+    Arguments
+    ~~~~~~~~~
+    * factory_name string (lowercase, normally from hostname)
+    * encrypted_password string (lowercase hexadecimal, length 32)
+    * request int (from requests.poll)
+    * offset int (position of this chunk in the PNG file)
+    * chunk binary (BASE64-encoded part of the PNG file)
+
+    Return value
+    ~~~~~~~~~~~~
+    * bytes int (received so far, the offset for the next chunk)
+
+    Start with offset 0, then send the following chunks in order.
+    Data after the offset is discarded, so after a network error you
+    can simply send the same chunk again. When all chunks are done,
+    call screenshots.uploadFinish.
+    """
+    nonces.verify(http_request, factory, encrypted_password)
+    request = locked_request(factory, request)
+    return storage.save_chunk(
+        storage.upload_filename(factory.name, request.id), offset, chunk.data)
+
+
+@factory_xmlrpc
+@signature(str, str, str, int, int, str)
+@admission.track('upload')
+def uploadFinish(http_request, factory, encrypted_password, request,
+                 bytes, checksum):
+    """
+    Submit a screenshot that was sent with screenshots.uploadChunk.
+
+    Arguments
+    ~~~~~~~~~
+    * factory_name string (lowercase, normally from hostname)
+    * encrypted_password string (lowercase hexadecimal, length 32)
+    * request int (from requests.poll)
+    * bytes int (size of the PNG file)
+    * checksum string (MD5 of the PNG file, lowercase hexadecimal)
+
+    Return value
+    ~~~~~~~~~~~~
+    * hashkey string (lowercase hexadecimal, length 32)
+
+    The result is the same as for screenshots.upload.
+    """
+    nonces.verify(http_request, factory, encrypted_password)
+    request = locked_request(factory, request)
+    hashkey = storage.finish_upload(
+        storage.upload_filename(factory.name, request.id), bytes, checksum)
+    return process_upload(factory, request, hashkey, bytes)
+
+
+def locked_request(factory, request_id):
+    """
+    Get a screenshot request, and make sure that it was locked by
+    this factory.
+    """
+    request = get_or_fault(Request, pk=request_id)
+    request.check_factory_lock(factory)
+    return request
+
+
+def process_upload(factory, request, hashkey, bytes):
+    """
+    Check a stored screenshot file, save it in the database and close
+    the request. Return the hashkey.
+    """
+    request_group = request.request_group
     # Make sure the request was redirected by the browser
     browser = request.browser
     if browser is None or browser.factory_id != factory.id:
@@ -108,36 +223,37 @@ def upload(http_request, factory, encrypted_password, request, screenshot):
         raise ExtraFault(406,
             u"The browser has not visited the requested website.",
             request=request, hashkey=hashkey, browser=guessed[0])
-    # Unpack PNG file and run more checks
-    ppmname = storage.pngtoppm(hashkey)
-    try:
-        magic, width, height = storage.read_pnm_header(ppmname)
-        if request_group.width and request_group.width != width:
-            raise ExtraFault(412,
-                u"The screenshot is %d pixels wide, not %d as requested." %
-                (width, request_group.width),
-                request=request, hashkey=hashkey, browser=browser)
-        if height > width * 4:
-            raise ExtraFault(413,
-                u"The screenshot is too tall (more than 4 times the width).",
-                request=request, hashkey=hashkey, browser=browser)
-        if height < width / 2:
-            raise ExtraFault(414,
-                u"The screenshot is too short (less than half the width).",
-                request=request, hashkey=hashkey, browser=browser)
-        if os.path.exists('/usr/local/etc/pbmgrep'):
-            check_ppm_problems(ppmname, request, hashkey, browser)
-        # Make smaller preview images
-        for size in PREVIEW_SIZES:
-            storage.scale(ppmname, size, hashkey)
-    finally:
-        # Delete temporary PPM file
-        os.unlink(ppmname)
-    # Upload screenshots to Amazon S3 (but not for anonymous users)
-    if hasattr(settings, 'S3_BUCKETS') and request_group.user_id is not None:
-        storage.s3_upload(hashkey) # size='original'
-        for size in PREVIEW_SIZES:
-            storage.s3_upload(hashkey, size)
+    # Check image size before decoding the pixels
+    width, height, rows = storage.decode(hashkey)
+    if request_group.width and request_group.width != width:
+        raise ExtraFault(412,
+            u"The screenshot is %d pixels wide, not %d as requested." %
+            (width, request_group.width),
+            request=request, hashkey=hashkey, browser=browser)
+    if height > width * 4:
+        raise ExtraFault(413,
+            u"The screenshot is too tall (more than 4 times the width).",
+            request=request, hashkey=hashkey, browser=browser)
+    if height < width / 2:
+        raise ExtraFault(414,
+            u"The screenshot is too short (less than half the width).",
+            request=request, hashkey=hashkey, browser=browser)
+    # Decode once, check for problems and maybe make previews. All rows
+    # are decoded even without consumers, to reject broken PNG files.
+    consumers = []
+    problems = None
+    if os.path.exists(PBMGREP_FOLDER):
+        problems = detector.Detector(width, height,
+                                     detector.load_features(PBMGREP_FOLDER))
+        consumers.append(problems)
+    if not QUEUE_JOBS:
+        consumers.extend([storage.Preview(hashkey, size, width, height)
+                          for size in PREVIEW_SIZES])
+    storage.process(hashkey, rows, consumers)
+    if problems is not None and problems.result is not None:
+        code, message = problems.result[:2]
+        raise ExtraFault(code, message,
+                         request=request, hashkey=hashkey, browser=browser)
     # Save screenshot in database
     screenshot = Screenshot(hashkey=hashkey,
         user=request_group.user, website=request_group.website,
@@ -145,7 +261,14 @@ def upload(http_request, factory, encrypted_password, request, screenshot):
         width=width, height=height, bytes=bytes)
     screenshot.save()
     # Close the request
-    close_request(request_id, factory, screenshot)
+    close_request(request.id, factory, screenshot)
+    # Upload screenshots to Amazon S3 (but not for anonymous users)
+    s3 = hasattr(settings, 'S3_BUCKETS') and request_group.user_id is not None
+    if QUEUE_JOBS:
+        # Previews and S3 upload will be done by the worker process
+        jobs.submit(hashkey, PREVIEW_SIZES, s3)
+    elif s3:
+        storage.s3_upload(hashkey, [storage.ORIGINAL_SIZE] + PREVIEW_SIZES)
     # Update timestamps and estimates
     now = datetime.now()
     if request.priority == 0:
@@ -155,28 +278,3 @@ def upload(http_request, factory, encrypted_password, request, screenshot):
         factory.update_fields(last_upload=now)
     browser.update_fields(last_upload=now)
     return hashkey
-
-
-def check_ppm_problems(ppmname, request, hashkey, browser):
-    """
-    Check for known problems with pbmgrep.
-    """
-    command = ' '.join(('ppmfg', '<', ppmname, '|', 'pbmgrep',
-                        '/usr/local/etc/pbmgrep/6??_*.pbm'))
-    # print command
-    status, output = commands.getstatusoutput(command)
-    # print status, output
-    if status == 0:
-        return
-    lines = output.splitlines()
-    parts = lines[0].split('\t')
-    if len(parts) == 5:
-        filename = os.path.basename(parts[4]).split('.')[0]
-        filename_parts = filename.split('_')
-        code = int(filename_parts[0])
-        message = capfirst(' '.join(filename_parts[1:]) + '.')
-    else:
-        code = status
-        message = ' '.join(lines)
-    raise ExtraFault(code, message,
-                     request=request, hashkey=hashkey, browser=browser)
@@ -226,6 +226,7 @@ MIDDLEWARE_CLASSES = (
     'django.middleware.locale.LocaleMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.middleware.doc.XViewMiddleware',
+    'shotserver04.requests.pending.PendingIndexMiddleware',
     'django.middleware.transaction.TransactionMiddleware',
     # 'django.middleware.http.SetRemoteAddrFromForwardedFor',
 )
@@ -25,6 +25,7 @@ __author__ = "$Author$"
 import re
 import urlparse
 import socket
+import httplib
 from datetime import datetime
 from psycopg import IntegrityError
 from django import forms
@@ -35,16 +36,19 @@ from django.utils.translation import ugettext_lazy as _
 from django.utils.safestring import mark_safe
 from django.conf import settings
 from shotserver04.websites.utils import \
-     split_netloc, unsplit_netloc, http_get, count_profanities, \
+     split_netloc, unsplit_netloc, KeywordScanner, \
      HTTP_TIMEOUT, HTTPError, ConnectError, RedirectError, RequestError, \
      dotted_ip, long_ip, bit_mask, slash_mask
 from shotserver04.websites.models import Domain, Website
 from shotserver04.websites import normalize_url
+from shotserver04.websites.fetch import Fetcher
 from shotserver04.start.forms import robotexclusionrulesparser
 
 SUPPORTED_SCHEMES = ['http', 'https']
 
 scheme_match = re.compile(r'[A-Za-z0-9\.+-]+:').match
+keyword_scanner = KeywordScanner(settings.PROFANITIES_LIST,
+                                 settings.SHOCKSITE_KEYWORDS_LIST)
 
 
 class UrlForm(forms.Form):
@@ -65,8 +69,10 @@ class UrlForm(forms.Form):
         self.punycode_url()
         self.check_server_disallowed()
         self.add_slash()
-        self.robots_txt()
-        response = self.http_get()
+        fetcher = Fetcher(self.cleaned_data['url'])
+        fetcher.start(self.robots_txt_allows)
+        self.robots_txt(fetcher)
+        response = self.http_get(fetcher)
         self.cleaned_data['headers'] = response[0]
         self.cleaned_data['content'] = response[1]
         self.check_content_type()
@@ -163,7 +169,16 @@ class UrlForm(forms.Form):
             self.url_parts[2] = '/'
             self.cleaned_data['url'] = urlparse.urlunsplit(self.url_parts)
 
-    def robots_txt(self):
+    def robots_txt_allows(self, content):
+        """
+        Check if robots.txt content allows screenshots of the URL.
+        """
+        parser = robotexclusionrulesparser.RobotExclusionRulesParser()
+        parser.user_agent = 'Browsershots'
+        parser.parse(content)
+        return parser.is_allowed('Browsershots', self.cleaned_data['url'])
+
+    def robots_txt(self, fetcher):
         """
         Check if automatic screenshots are allowed by robots.txt
         for the requested URL on the remote server.
@@ -173,18 +188,16 @@ class UrlForm(forms.Form):
         robots_txt_link = '<a href="%s">%s/robots.txt</a>' % (
             robots_txt_url, self.url_parts[1])
         # print robots_txt_url
-        parser = robotexclusionrulesparser.RobotExclusionRulesParser()
-        parser.user_agent = 'Browsershots'
-        socket.setdefaulttimeout(HTTP_TIMEOUT)
         try:
-            parser.fetch(robots_txt_url)
+            allowed = self.robots_txt_allows(fetcher.robots_txt())
         except EOFError:
             return
-        except (IOError, socket.error, UnicodeError), error:
+        except (HTTPError, IOError, socket.error, httplib.HTTPException,
+                UnicodeError), error:
             raise ValidationError(mark_safe(u' '.join((
                 _("Could not read %(robots_txt_link)s.") % locals(),
                 human_error(error)))))
-        if not parser.is_allowed('Browsershots', self.cleaned_data['url']):
+        if not allowed:
             faq = u'<a href="%s/%s">FAQ</a>' % (
                 'http://trac.browsershots.org/wiki',
                 'FrequentlyAskedQuestions#Blockedbyrobots.txt')
@@ -193,12 +206,13 @@ _("Browsershots was blocked by %(robots_txt_link)s.") % locals(),
 _("Please read the %(faq)s.") % locals(),
 ))))
 
-    def http_get(self):
+    def http_get(self, fetcher):
         """
-        Load headers and content from remote HTTP server.
+        Load headers and content from remote HTTP server, or from the
+        cache.
         """
         try:
-            return http_get(self.cleaned_data['url'])
+            return fetcher.page()
         except HTTPError, error:
             if isinstance(error, ConnectError):
                 text = _("Could not connect to %(hostname)s.")
@@ -247,10 +261,9 @@ unicode(_("This service is for HTML or XHTML content.")))))
         """
         url_content = ' '.join(
             (self.cleaned_data['url'], self.cleaned_data['content']))
-        self.cleaned_data['profanities'] = \
-            count_profanities(settings.PROFANITIES_LIST, url_content)
-        self.cleaned_data['shocksite_keywords'] = \
-            count_profanities(settings.SHOCKSITE_KEYWORDS_LIST, url_content)
+        (self.cleaned_data['profanities'],
+         self.cleaned_data['shocksite_keywords']) = \
+            keyword_scanner.count(url_content)
 
     def get_or_create_domain(self):
         """
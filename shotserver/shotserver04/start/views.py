@@ -45,6 +45,9 @@ from shotserver04.factories.models import Factory
 from shotserver04.browsers.models import BrowserGroup, Browser
 from shotserver04.websites.models import Website
 from shotserver04.requests.models import RequestGroup, Request
+from shotserver04.requests.pending import pending_index
+from shotserver04.requests.usage import usage_counters, usage_key
+from shotserver04.requests.usage import USE_USAGE_COUNTERS
 from shotserver04.sponsors.models import Sponsor
 
 BROWSER_COLUMNS = 5
@@ -170,6 +173,7 @@ def start(http_request):
         # Previous request group is still pending, reuse it.
         request_group = existing[0]
         request_group.update_fields(expire=expire)
+        pending_index.expire_group(request_group.id, expire)
         if priority > request_group.priority:
             request_group.update_fields(priority=priority)
     else:
@@ -215,9 +219,19 @@ def check_usage_limit(result, http_request, message,
         kwargs['request_group__user'] = http_request.user
     if not kwargs:
         kwargs['request_group__ip'] = http_request.META['REMOTE_ADDR']
+    count = None
+    if USE_USAGE_COUNTERS:
+        count = usage_counters.count(usage_key(
+            website=kwargs.get('request_group__website'),
+            domain=kwargs.get('request_group__website__domain'),
+            user=kwargs.get('request_group__user'),
+            ip=kwargs.get('request_group__ip')))
+        if count is not None and count <= max_requests:
+            return
     yesterday = datetime.now() - timedelta(hours=24)
     kwargs['request_group__submitted__gte'] = yesterday
     requests = Request.objects.filter(**kwargs)
+    # Exact count if the counter is unavailable or over the limit
     count = requests.count()
     if count > max_requests:
         if 'request_group__website__domain' in kwargs:
@@ -0,0 +1,179 @@
+# browsershots.org - Test your web design in different browsers
+# Copyright (C) 2007 Johann C. Rocholl <johann@browsershots.org>
+#
+# Browsershots is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Browsershots is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Download robots.txt and page content for new websites, with caching.
+
+Popular websites are submitted many times per hour, so robots.txt is
+cached per server and page headers and content are cached per URL.
+If both must be downloaded, they are loaded in parallel threads, so
+that a slow server costs one timeout instead of two.
+"""
+
+__revision__ = "$Rev$"
+__date__ = "$Date$"
+__author__ = "$Author$"
+
+import md5
+import urlparse
+import threading
+from django.core.cache import cache
+from shotserver04.websites.utils import http_get, http_get_status, \
+     RedirectError, ResponseError
+
+ROBOTS_TXT_TIMEOUT = 6 * 3600 # seconds to cache robots.txt per server
+PAGE_TIMEOUT = 10 * 60 # seconds to cache headers and content per URL
+MAX_REDIRECTS = 3 # for robots.txt
+KEY_FORMATS = { # separate, so a page can't overwrite robots.txt
+    'robots.txt': 'robots:%s', # e.g. robots:<md5 hexdigest of the URL>
+    'page': 'page:%s',
+    }
+DISALLOW_ALL = u"User-agent: *\nDisallow: /"
+
+
+def robots_txt_url(url):
+    """
+    Get the location of robots.txt on the same server.
+
+    >>> robots_txt_url('https://user@example.com:8443/test/?a=1')
+    'https://user@example.com:8443/robots.txt'
+    """
+    url_parts = urlparse.urlsplit(url)
+    return ''.join((url_parts[0], '://', url_parts[1], '/robots.txt'))
+
+
+def cache_key(name, url):
+    """
+    Make a short cache key without spaces.
+
+    >>> cache_key('page', 'http://example.com/')
+    'page:a6bf1757fff057f266b697df9cf176fd'
+    >>> cache_key('robots.txt', 'http://example.com/robots.txt')
+    'robots:b4bcaa6c645175cd36f8d1de582a18fe'
+    """
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    return KEY_FORMATS[name] % md5.new(url).hexdigest()
+
+
+def fetch_robots_txt(url):
+    """
+    Download robots.txt and return its content. Like the fetch method
+    of RobotExclusionRulesParser, 401 and 403 disallow everything, 404
+    allows everything, and other errors are raised.
+    """
+    for redirects in range(MAX_REDIRECTS + 1):
+        try:
+            status, headers, content = http_get_status(url)
+        except RedirectError, error:
+            if not error.location or redirects == MAX_REDIRECTS:
+                raise
+            url = urlparse.urljoin(url, error.location)
+            continue
+        if status / 100 == 2:
+            return content
+        if status in (401, 403):
+            return DISALLOW_ALL
+        if status == 404:
+            return u''
+        raise ResponseError(hostname=urlparse.urlsplit(url)[1],
+                            message="HTTP status %d" % status)
+
+
+class Fetcher:
+    """
+    Get robots.txt and page content for a URL, from the cache or
+    from the remote server.
+    """
+
+    def __init__(self, url, backend=cache):
+        self.cache = backend
+        self.urls = {'robots.txt': robots_txt_url(url), 'page': url}
+        self.functions = {'robots.txt': fetch_robots_txt, 'page': http_get}
+        self.timeouts = {'robots.txt': ROBOTS_TXT_TIMEOUT,
+                         'page': PAGE_TIMEOUT}
+        self.results = {}
+        self.threads = {}
+
+    def start(self, allowed=None):
+        """
+        Start downloading what isn't cached. If robots.txt is cached
+        and allowed(content) returns False, the page is not loaded.
+        If allowed(content) raises an error, it is saved and raised by
+        robots_txt, like a download error.
+        """
+        content = self.cache.get(cache_key('robots.txt',
+                                           self.urls['robots.txt']))
+        if content is None:
+            self.download('robots.txt')
+        else:
+            self.results['robots.txt'] = (content, None)
+            if allowed is not None:
+                try:
+                    if not allowed(content):
+                        return
+                except Exception, error:
+                    self.results['robots.txt'] = (None, error)
+                    return
+        page = self.cache.get(cache_key('page', self.urls['page']))
+        if page is None:
+            self.download('page')
+        else:
+            self.results['page'] = (page, None)
+
+    def download(self, name):
+        """Download in a background thread."""
+
+        def run():
+            """Save the result or the error."""
+            try:
+                result = self.functions[name](self.urls[name])
+                self.results[name] = (result, None)
+            except Exception, error:
+                self.results[name] = (None, error)
+
+        self.threads[name] = threading.Thread(target=run)
+        self.threads[name].start()
+
+    def result(self, name):
+        """
+        Wait for a download and cache the result, or raise the error.
+        """
+        if name not in self.results and name not in self.threads:
+            self.download(name)
+        if name in self.threads:
+            self.threads.pop(name).join()
+            result, error = self.results[name]
+            if error is None:
+                self.cache.set(cache_key(name, self.urls[name]), result,
+                               self.timeouts[name])
+        result, error = self.results[name]
+        if error is not None:
+            raise error
+        return result
+
+    def robots_txt(self):
+        """Get the content of robots.txt."""
+        return self.result('robots.txt')
+
+    def page(self):
+        """Get headers and content of the page."""
+        return self.result('page')
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
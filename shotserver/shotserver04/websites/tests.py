@@ -22,11 +22,18 @@ __revision__ = "$Rev$"
 __date__ = "$Date$"
 __author__ = "$Author$"
 
+import random
+import threading
+import BaseHTTPServer
+import SocketServer
 from psycopg import IntegrityError, ProgrammingError
 from unittest import TestCase
 from django.db import transaction
 from shotserver04.websites import extract_domain
 from shotserver04.websites.models import Domain, Website
+from shotserver04.websites.fetch import Fetcher, DISALLOW_ALL
+from shotserver04.websites.utils import ResponseError, KeywordScanner
+from shotserver04.start.forms import robotexclusionrulesparser
 
 INVALID_URLS = [
     '',
@@ -167,3 +174,122 @@ class UrlTestCase(TestCase):
     def testValidUrls(self):
         for url in VALID_URLS:
             self.assertValid(url)
+
+
+class FakeCache(dict):
+
+    def set(self, key, value, timeout=None):
+        self[key] = value
+
+
+class FakeWebHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        status, content = self.server.responses.get(self.path, (404, ''))
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeWebServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class FetcherTestCase(TestCase):
+
+    def setUp(self):
+        self.server = FakeWebServer(('127.0.0.1', 0), FakeWebHandler)
+        self.server.paths = []
+        self.server.responses = {
+            '/robots.txt': (200, 'User-agent: *\nDisallow: /private/'),
+            '/': (200, '<html>home</html>'),
+            }
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+        self.cache = FakeCache()
+
+    def tearDown(self):
+        self.server.shutdown()
+
+    def testCached(self):
+        fetcher = Fetcher(self.url, self.cache)
+        fetcher.start()
+        self.assertTrue('/private/' in fetcher.robots_txt())
+        headers, content = fetcher.page()
+        self.assertEqual(content, '<html>home</html>')
+        self.assertEqual(sorted(self.server.paths), ['/', '/robots.txt'])
+        fetcher = Fetcher(self.url, self.cache)
+        fetcher.start()
+        self.assertTrue('/private/' in fetcher.robots_txt())
+        self.assertEqual(fetcher.page()[1], '<html>home</html>')
+        self.assertEqual(len(self.server.paths), 2)
+
+    def testDisallowed(self):
+        Fetcher(self.url, self.cache).robots_txt()
+        fetcher = Fetcher(self.url + 'private/', self.cache)
+        fetcher.start(lambda content: False)
+        fetcher.robots_txt()
+        self.assertEqual(self.server.paths, ['/robots.txt'])
+
+    def testRobotsTxtPage(self):
+        self.server.responses['/robots.txt'] = (200, 'User-agent: *')
+
+        def allowed(content):
+            parser = robotexclusionrulesparser.RobotExclusionRulesParser()
+            parser.parse(content)
+            return parser.is_allowed('Browsershots', self.url)
+
+        fetcher = Fetcher(self.url + 'robots.txt', self.cache)
+        fetcher.start(allowed)
+        self.assertEqual(fetcher.page()[1], 'User-agent: *')
+        fetcher = Fetcher(self.url, self.cache)
+        fetcher.start(allowed)
+        self.assertEqual(fetcher.robots_txt(), 'User-agent: *')
+        self.assertEqual(fetcher.page()[1], '<html>home</html>')
+
+    def testRobotsStatus(self):
+        del self.server.responses['/robots.txt']
+        self.assertEqual(Fetcher(self.url, FakeCache()).robots_txt(), '')
+        self.server.responses['/robots.txt'] = (403, '')
+        self.assertEqual(Fetcher(self.url, FakeCache()).robots_txt(),
+                         DISALLOW_ALL)
+        self.server.responses['/robots.txt'] = (500, '')
+        fetcher = Fetcher(self.url, self.cache)
+        self.assertRaises(ResponseError, fetcher.robots_txt)
+        self.assertEqual(len(self.cache), 0)
+
+
+class KeywordScannerTestCase(TestCase):
+
+    def substring_count(self, keywords, content):
+        content = content.lower()
+        return len([keyword for keyword in keywords if keyword in content])
+
+    def random_text(self, chars, minimum, maximum):
+        return ''.join([random.choice(chars)
+                        for index in range(random.randint(minimum, maximum))])
+
+    def testOverlapping(self):
+        scanner = KeywordScanner(['sex', 'xxx', 'sexx'], ['s', 'xx'])
+        self.assertEqual(scanner.count('SEXXX'), [3, 2])
+        self.assertEqual(scanner.count('sexy'), [1, 1])
+
+    def testSameCounts(self):
+        random.seed(0)
+        for attempt in range(1000):
+            lists = [[self.random_text('abc:', 1, 4)
+                      for index in range(random.randint(0, 6))]
+                     for index in range(2)]
+            scanner = KeywordScanner(*lists)
+            content = self.random_text('aAbBc: ', 0, 30)
+            self.assertEqual(scanner.count(content), [
+                self.substring_count(keywords, content)
+                for keywords in lists])
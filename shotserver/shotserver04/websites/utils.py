@@ -22,6 +22,7 @@ __revision__ = "$Rev$"
 __date__ = "$Date$"
 __author__ = "$Author$"
 
+import re
 import socket
 import struct
 import httplib
@@ -30,6 +31,8 @@ import urlparse
 HTTP_TIMEOUT = 20 # seconds
 MAX_RESPONSE_SIZE = 100000 # bytes
 
+keyword_scanners = {} # compiled by count_profanities, for each list
+
 
 class HTTPError(Exception):
     """
@@ -125,6 +128,21 @@ def unsplit_netloc(parts):
     return ''.join(result)
 
 
+def http_connection(scheme, hostname):
+    """
+    Make a HTTP or HTTPS connection with a timeout of HTTP_TIMEOUT.
+    """
+    if scheme == 'https':
+        connection_class = httplib.HTTPSConnection
+    else:
+        connection_class = httplib.HTTPConnection
+    try:
+        return connection_class(hostname, timeout=HTTP_TIMEOUT)
+    except TypeError: # No timeout argument before Python 2.6
+        socket.setdefaulttimeout(HTTP_TIMEOUT)
+        return connection_class(hostname)
+
+
 def http_get(url):
     """
     Try to download headers and content from a remote HTTP server.
@@ -136,7 +154,13 @@ def http_get(url):
     >>> '404' in http_get('http://www.example.com/test.html')[1]
     True
     """
-    socket.setdefaulttimeout(HTTP_TIMEOUT)
+    return http_get_status(url)[1:]
+
+
+def http_get_status(url):
+    """
+    Like http_get, but return the HTTP status code too.
+    """
     url_parts = urlparse.urlsplit(url)
     netloc_parts = split_netloc(url_parts[1])
     scheme = url_parts[0]
@@ -144,17 +168,14 @@ def http_get(url):
     if netloc_parts[3] is not None:
         hostname += ':' + netloc_parts[3]
     try:
-        if scheme == 'https':
-            connection = httplib.HTTPSConnection(hostname)
-        else:
-            connection = httplib.HTTPConnection(hostname)
+        connection = http_connection(scheme, hostname)
     except httplib.HTTPException, error:
         raise ConnectError(hostname=hostname, error=error)
     path = url_parts[2]
     if url_parts[3]:
         path += '?' + url_parts[3]
     try:
-        return http_get_path(connection, path)
+        return http_get_response(connection, path)
     finally:
         connection.close()
 
@@ -164,6 +185,13 @@ def http_get_path(connection, path):
     Try to get headers and content for this path through an existing
     connection.
     """
+    return http_get_response(connection, path)[1:]
+
+
+def http_get_response(connection, path):
+    """
+    Like http_get_path, but return the HTTP status code too.
+    """
     # Send request
     try:
         headers = {"User-Agent": "Browsershots"}
@@ -185,7 +213,7 @@ def http_get_path(connection, path):
         content = content.decode('utf8')
     except UnicodeDecodeError:
         content = content.decode('latin1')
-    return headers, content
+    return response.status, headers, content
 
 
 def count_profanities(profanities, content):
@@ -198,12 +226,84 @@ def count_profanities(profanities, content):
     >>> count_profanities('abc xyz'.split(), 'ABC XYZ abc')
     2
     """
-    result = 0
-    content = content.lower()
-    for word in profanities:
-        if word in content:
-            result += 1
-    return result
+    key = tuple(profanities)
+    if key not in keyword_scanners:
+        keyword_scanners[key] = KeywordScanner(profanities)
+    return keyword_scanners[key].count(content)[0]
+
+
+def trie_pattern(keywords):
+    """
+    Make a regular expression that matches the longest keyword at
+    the current position, with common prefixes merged like in a trie.
+
+    >>> trie_pattern(['ab', 'abc', 'b'])
+    '(?:ab(?:c)?|b)'
+    """
+    trie = {}
+    for keyword in keywords:
+        node = trie
+        for char in keyword:
+            node = node.setdefault(char, {})
+        node[''] = None # end of keyword
+    return trie_node_pattern(trie)
+
+
+def trie_node_pattern(node):
+    """Make the regular expression for one node of the trie."""
+    branches = [re.escape(char) + trie_node_pattern(node[char])
+                for char in sorted(node.keys()) if char]
+    if not branches:
+        return ''
+    if len(branches) == 1 and '' not in node:
+        return branches[0]
+    pattern = '(?:%s)' % '|'.join(branches)
+    if '' in node:
+        pattern += '?'
+    return pattern
+
+
+class KeywordScanner:
+    """
+    Count keywords from several lists in one pass over the content.
+
+    The regular expression is tried at every position of the
+    lowercase content, and finds the longest keyword there. Shorter
+    keywords inside each match are added afterwards, so the counts
+    are the same as with a substring search for each keyword.
+
+    >>> scanner = KeywordScanner(['abc', 'xyz', 'ab'], ['bc', 'x'])
+    >>> scanner.count('ABC and xx')
+    [2, 2]
+    >>> scanner.count('innocent')
+    [0, 0]
+    """
+
+    def __init__(self, *keyword_lists):
+        self.keyword_lists = [list(keywords) for keywords in keyword_lists]
+        keywords = set()
+        for keyword_list in self.keyword_lists:
+            keywords.update(keyword_list)
+        keywords.discard('') # always found, see count
+        self.regex = None
+        if keywords:
+            self.regex = re.compile('(?=(%s))' % trie_pattern(keywords))
+        self.contained = {}
+        for keyword in keywords:
+            self.contained[keyword] = [other for other in keywords
+                                       if other in keyword]
+
+    def count(self, content):
+        """
+        Count the keywords of each list that occur in the content.
+        """
+        found = set([''])
+        if self.regex is not None:
+            for match in set(self.regex.findall(content.lower())):
+                found.update(self.contained[match])
+        return [len([keyword for keyword in keyword_list
+                     if keyword in found])
+                for keyword_list in self.keyword_lists]
 
 
 def dotted_ip(long_ip):
@@ -102,14 +102,20 @@ class Dispatcher:
     def multicall(self, http_request, call_list):
         """
         Allows the caller to package multiple XML-RPC calls into a
-        single request.
+        single request. Each result is a list with one item, or a
+        fault struct if the call failed, so that the other calls can
+        still succeed.
         """
         results = []
         for call in call_list:
             method = call['methodName']
             params = call['params']
-            result = self.dispatch(method, http_request, params)
-            results.append([result])
+            try:
+                result = self.dispatch(method, http_request, params)
+                results.append(list(result))
+            except xmlrpclib.Fault, fault:
+                results.append({'faultCode': fault.faultCode,
+                                'faultString': fault.faultString})
         return results
 
     def dispatch(self, method, http_request, params):
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# browsershots.org - Test your web design in different browsers
+# Copyright (C) 2007 Johann C. Rocholl <johann@browsershots.org>
+#
+# Browsershots is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Browsershots is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Worker process for the post-upload job queue.
+
+Makes preview images and uploads screenshots to Amazon S3 after
+screenshots.upload has stored the original PNG file, and removes
+partial uploads that were abandoned by factories. Run one worker per
+server, for example in screen or from an init script.
+
+Usage: shotserver04_worker.py [--once] [--interval=seconds] [--threads=n]
+"""
+
+__revision__ = "$Rev$"
+__date__ = "$Date$"
+__author__ = "$Author$"
+
+import os
+os.environ['DJANGO_SETTINGS_MODULE'] = 'shotserver04.settings'
+import sys
+import time
+import threading
+from optparse import OptionParser
+from django.conf import settings
+from shotserver04.screenshots import storage, jobs
+
+EXPIRE_INTERVAL = 600 # seconds between checks for abandoned uploads
+
+
+def timestamp(when=None):
+    return '%04d-%02d-%02d %02d:%02d:%02d' % time.localtime(when)[:6]
+
+
+def run_job(hashkey):
+    """
+    Run one job and print the results.
+    """
+    try:
+        job = jobs.load(hashkey)
+    except IOError:
+        return # Removed in the meantime
+    started = time.time()
+    try:
+        job.run()
+    except Exception, error:
+        print timestamp(), hashkey, 'attempt', job.attempts, 'failed:',
+        print error.__class__.__name__, error
+        return
+    for transfer in job.transfers:
+        print timestamp(), transfer
+    print timestamp(), hashkey, 'done in %.2f seconds' % (
+        time.time() - started)
+
+
+def run_pending(threads=1):
+    """
+    Run all jobs that are ready, several at a time.
+    Return the number of jobs.
+    """
+    hashkeys = jobs.pending()
+    queue = hashkeys[:]
+    queue.reverse()
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            lock.acquire()
+            try:
+                if not queue:
+                    return
+                hashkey = queue.pop()
+            finally:
+                lock.release()
+            run_job(hashkey)
+
+    workers = [threading.Thread(target=work)
+               for index in range(min(threads, len(hashkeys)))]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return len(hashkeys)
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--once', action='store_true',
+        help="run pending jobs and exit")
+    parser.add_option('-i', '--interval', type='float', default=1.0,
+        metavar='<seconds>', help="wait between checks (default 1.0)")
+    parser.add_option('-t', '--threads', type='int', default=4,
+        metavar='<number>', help="jobs at the same time (default 4)")
+    options, args = parser.parse_args()
+    expired = 0
+    while True:
+        if time.time() > expired + EXPIRE_INTERVAL:
+            removed = storage.expire_uploads()
+            if removed:
+                print timestamp(), 'removed', removed, 'abandoned uploads'
+            expired = time.time()
+        count = run_pending(options.threads)
+        if count and hasattr(settings, 'S3_BUCKETS'):
+            print timestamp(), 'S3:', storage.s3_client().statistics()
+        if options.once:
+            break
+        if not count:
+            time.sleep(options.interval)
+
+
+if __name__ == '__main__':
+    main()
@@ -16,74 +16,144 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 """
-Test the @serializable decorator by overloading the server with
-factory poll requests.
+Benchmark concurrent factory polls against the request claiming code.
+
+Creates a batch of matching screenshot requests, then lets several
+threads claim them as fast as possible, and reports claims per second
+and serialization retries for each mode:
+
+* serializable: SELECT and UPDATE with @serializable retries
+* skip-locked: single UPDATE ... WHERE id = (SELECT ... SKIP LOCKED)
+* index: in-memory pending index with conditional UPDATE
+
+Usage: test_overload.py [options] [mode ...]
 """
 
 __revision__ = "$Rev$"
 __date__ = "$Date$"
 __author__ = "$Author$"
 
-import thread
-import sys
 import os
 os.environ['DJANGO_SETTINGS_MODULE'] = 'shotserver04.settings'
-from django.db import transaction
+import sys
+import time
+import threading
+from optparse import OptionParser
 from xmlrpclib import Fault
+from django.db import connection
+from shotserver04.common import serializable
 from shotserver04.factories.models import Factory
 from shotserver04.websites.models import Website
-from shotserver04.browsers.models import BrowserGroup
 from shotserver04.requests.models import RequestGroup, Request
 from shotserver04.requests import xmlrpc as requests
 from datetime import datetime, timedelta
-import time
 
+MODES = ('serializable', 'skip-locked', 'index')
 
-def generator():
-    factory = Factory.objects.get(pk=1)
-    browser_group = BrowserGroup.objects.get(pk=1)
-    website = Website.objects.all()[0]
+
+def create_requests(factory, count):
+    """
+    Create a request group with matching requests for this factory.
+    """
+    browser = factory.browser_set.filter(active=True)[0]
     request_group = RequestGroup.objects.create(
-        website=website,
+        website=Website.objects.all()[0],
+        ip='127.0.0.1',
         expire=datetime.now() + timedelta(1, 0, 0))
-    while True:
-        request = Request.objects.create(
+    for index in range(count):
+        Request.objects.create(
             request_group=request_group,
-            browser_group=browser_group,
-            major=2, minor=0,
-            )
-        sys.stdout.write('+')
+            platform=factory.operating_system.platform,
+            browser_group=browser.browser_group,
+            major=browser.major, minor=browser.minor,
+            priority=0)
+    return request_group
+
+
+class Overload(threading.Thread):
+    """
+    Poll for matching requests until there are none left.
+    """
+
+    def __init__(self, mode, factory_id):
+        threading.Thread.__init__(self)
+        self.mode = mode
+        self.factory_id = factory_id
+        self.claims = 0
+        self.errors = []
+
+    def claim(self, factory, features):
+        """Claim one request with the selected mode."""
+        if self.mode == 'serializable':
+            requests.find_and_lock_request_serializable(factory, features)
+        elif self.mode == 'skip-locked':
+            requests.find_and_lock_request_skip_locked(factory, features)
+        else:
+            requests.find_and_claim_request(factory)
+
+    def run(self):
+        try:
+            factory = Factory.objects.get(pk=self.factory_id)
+            features = factory.features_q()
+            while True:
+                try:
+                    self.claim(factory, features)
+                    self.claims += 1
+                except Fault, fault:
+                    if fault.faultCode != 204:
+                        self.errors.append(fault.faultString)
+                    break
+                except Exception, error:
+                    self.errors.append(str(error))
+                    break
+        finally:
+            connection.close()
+
+
+def benchmark(mode, factory, count, threads):
+    """
+    Run one benchmark and print the results.
+    """
+    request_group = create_requests(factory, count)
+    retries = serializable.retries
+    workers = [Overload(mode, factory.id) for index in range(threads)]
+    started = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - started
+    claims = sum([worker.claims for worker in workers])
+    errors = sum([len(worker.errors) for worker in workers])
+    print '%-12s %6d claims %8.1f claims/s %6d retries %4d errors' % (
+        mode, claims, claims / elapsed, serializable.retries - retries, errors)
+    for worker in workers:
+        for error in worker.errors[:1]:
+            print '   ', error
+    request_group.delete()
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] [mode ...]')
+    parser.add_option('-f', '--factory', metavar='<name>',
+                      help="poll as this factory (default: first)")
+    parser.add_option('-n', '--requests', type='int', default=500,
+                      metavar='<n>', help="requests to claim (default: 500)")
+    parser.add_option('-t', '--threads', type='int', default=8,
+                      metavar='<n>', help="concurrent polls (default: 8)")
+    options, args = parser.parse_args()
+    for mode in args:
+        if mode not in MODES:
+            parser.error("unknown mode %s (use %s)" % (
+                mode, ', '.join(MODES)))
+    if options.factory:
+        factory = Factory.objects.get(name=options.factory)
+    else:
+        factory = Factory.objects.all()[0]
+    for mode in args or MODES:
+        benchmark(mode, factory, options.requests, options.threads)
         sys.stdout.flush()
-        time.sleep(1)
-
-
-def overload(thread_id):
-    try:
-        transaction.enter_transaction_management()
-        transaction.managed()
-        factory = Factory.objects.get(pk=1)
-        features = factory.features_q()
-        transaction.rollback()
-        while True:
-            try:
-                request = requests.find_and_lock_request(factory, features)
-            except Fault, error:
-                if error.faultString != "No matching request.":
-                    print
-                    print message
-            sys.stdout.write(str(thread_id))
-            sys.stdout.flush()
-    finally:
-        transaction.leave_transaction_management()
 
 
 if __name__ == '__main__':
-    thread.start_new_thread(generator, ())
-    thread.start_new_thread(overload, (1, ))
-    thread.start_new_thread(overload, (2, ))
-    thread.start_new_thread(overload, (3, ))
-    thread.start_new_thread(overload, (4, ))
-    thread.start_new_thread(overload, (5, ))
-    thread.start_new_thread(overload, (6, ))
-    thread.start_new_thread(overload, (7, ))
-    sys.stdin.readline()
+    main()